@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+'''load_test.py
+
+Load generator that replays typing traces against /predict or
+/predict_stream. The editor only sends a request once the user stops typing
+for the debounce delay of app.js, so every simulated user sends bursts of
+requests for overlapping prefixes of the same text, with a session id, like
+the browser does.
+
+Traces are synthesized from Python-like code typed with random delays,
+pauses and backspaces, or read from a JSON lines file where every line is
+one user, {"events": [[seconds, text], ...]}, with the editor text after
+every keystroke.
+
+The report gives the throughput, the p50/p95/p99 latency, the time spent
+queued and decoding on the server (from the Server-Timing header or the
+done event of the stream), and the rate of stale responses: completions that
+arrive after the user already typed past the text they complete. The send
+lag is how late the load generator sent requests; when it grows, the
+generator itself is the bottleneck.
+
+Example:
+
+    To replay 20 synthesized users for 60 seconds against a running app:
+
+     $ python -m benchmarks.load_test -u 20 -d 60 --url http://localhost:8080
+
+    To test an archive in-process with the Flask test client instead, and
+    stream the completions, pass the model and any app.py options:
+
+     $ python -m benchmarks.load_test -u 20 -d 60 --model /path/to/archive --stream -b 16
+
+    Use --debounce 0 to send a request on every keystroke and --speed 2 to
+    replay the traces twice as fast. -o saves the report as JSON.
+
+Attributes:
+    None
+
+Todo:
+    *
+'''
+import bisect
+import io
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_source
+
+
+def synthesize_trace(duration, typing_delay=0.15, pause_probability=0.05,
+                     backspace_probability=0.03, seed=0):
+    '''Keystrokes of a user typing Python-like code for duration seconds, as a
+    list of (seconds, text) with the editor text after every keystroke'''
+    rng = np.random.default_rng(seed)
+    source = synthetic_source(int(4 * duration / typing_delay) + 100, seed=seed)
+
+    events = []
+    t = float(rng.uniform(0, 2))
+    position = 0
+    while t < duration and position < len(source):
+        if position and rng.random() < backspace_probability:
+            position -= 1
+        else:
+            position += 1
+        events.append((t, source[:position]))
+
+        t += float(rng.lognormal(np.log(typing_delay), 0.5))
+        if rng.random() < pause_probability:
+            t += float(rng.uniform(1, 4))
+    return events
+
+
+def load_traces(path):
+    '''Read the keystroke traces of a JSON lines file, one user per line'''
+    traces = []
+    with io.open(path, 'r') as infile:
+        for line in infile:
+            if line.strip():
+                traces.append([(float(t), text) for t, text in json.loads(line)['events']])
+    return traces
+
+
+def debounce(events, delay):
+    '''The requests the editor sends for a list of keystrokes: one delay
+    seconds after every keystroke that is not followed by another one within
+    delay. Returns (send time, keystroke time, text) tuples'''
+    requests = []
+    for i, (t, text) in enumerate(events):
+        if i + 1 == len(events) or events[i + 1][0] - t > delay:
+            requests.append((t + delay, t, text))
+    return requests
+
+
+def parse_server_timing(header):
+    '''Milliseconds of every metric of a Server-Timing header'''
+    timings = {}
+    for metric in (header or '').split(','):
+        name, _, duration = metric.strip().partition(';dur=')
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def read_events(lines):
+    '''Yield (event, data) of the server-sent events in an iterator of lines'''
+    event = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('event: '):
+            event = line[len('event: '):]
+        elif line.startswith('data: '):
+            yield event, json.loads(line[len('data: '):])
+            event = None
+
+
+class HttpTarget():
+    '''HttpTarget object that posts requests to a running app
+
+    Parameters:
+        url -- base URL of the app, such as http://localhost:8080
+        timeout -- seconds to wait for a response (default 30)
+    '''
+
+    def __init__(self, url, timeout=30.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def post(self, path, payload, stream=False):
+        '''Send a request and return (status, ms to the first chunk, outcome, timings)'''
+        request = urllib.request.Request(self.url + path, data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                if not stream:
+                    response.read()
+                    return (response.status, 1000 * (time.perf_counter() - start), 'ok',
+                            parse_server_timing(response.headers.get('Server-Timing')))
+                lines = (line.decode() for line in response)
+                return (response.status,) + stream_outcome(lines, start)
+        except urllib.error.HTTPError as e:
+            return e.code, None, status_outcome(e.code), {}
+        except OSError:
+            return None, None, 'error', {}
+
+
+class ClientTarget():
+    '''ClientTarget object that sends requests through the Flask test client
+
+    Parameters:
+        app -- the Flask app
+    '''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, payload, stream=False):
+        '''Send a request and return (status, ms to the first chunk, outcome, timings)'''
+        start = time.perf_counter()
+        response = self.client.post(path, json=payload, buffered=not stream)
+        if response.status_code != 200:
+            return response.status_code, None, status_outcome(response.status_code), {}
+        if not stream:
+            return (200, 1000 * (time.perf_counter() - start), 'ok',
+                    parse_server_timing(response.headers.get('Server-Timing')))
+
+        lines = (line for chunk in response.response
+                 for line in chunk.decode().splitlines(True))
+        try:
+            return (200,) + stream_outcome(lines, start)
+        finally:
+            response.close()
+
+
+def status_outcome(status):
+    '''Outcome of a request that failed with an HTTP status'''
+    return {409: 'superseded', 503: 'rejected'}.get(status, 'error')
+
+
+def stream_outcome(lines, start):
+    '''Read a stream of server-sent events and return (ms to the first
+    chunk, outcome, timings)'''
+    first = None
+    for event, data in read_events(lines):
+        if first is None:
+            first = 1000 * (time.perf_counter() - start)
+        if event == 'done':
+            return first, 'ok', data.get('timings_ms', {})
+        if event is not None:
+            return first, 'superseded' if event == 'superseded' else 'error', {}
+    return first, 'error', {}
+
+
+class LoadTest():
+    '''LoadTest object that replays typing traces from concurrent simulated users
+
+    Parameters:
+        target -- HttpTarget or ClientTarget the requests are sent to
+        traces -- keystroke traces, one list of (seconds, text) per user
+        stream -- request /predict_stream instead of /predict (default False)
+        debounce_delay -- seconds without a keystroke before a request is sent (default 1.0)
+        speed -- replay the traces this many times faster (default 1.0)
+        duration -- seconds after which no new request is sent (default None)
+        max_connections -- most requests in flight at once (default 256)
+
+    Attributes:
+        run -- replay the traces and return the report
+    '''
+
+    def __init__(self, target, traces, stream=False, debounce_delay=1.0, speed=1.0,
+                 duration=None, max_connections=256):
+        '''Create a LoadTest object'''
+        self.target = target
+        self.traces = traces
+        self.stream = stream
+        self.debounce_delay = debounce_delay
+        self.speed = speed
+        self.duration = duration
+        self.max_connections = max_connections
+        self.results = []
+        self.lock = threading.Lock()
+
+    def _send(self, session, keystrokes, keystroke_time, send_time, text, start):
+        '''Send one request and record its outcome and whether it is stale'''
+        sent = time.perf_counter()
+        status, first_ms, outcome, timings = self.target.post(
+            '/predict_stream' if self.stream else '/predict',
+            {'text': text, 'session': session}, stream=self.stream)
+        received = time.perf_counter()
+
+        # Stale when the user typed again between this keystroke and the response
+        arrived = (received - start) * self.speed
+        stale = bisect.bisect_right(keystrokes, arrived) > bisect.bisect_right(keystrokes,
+                                                                                keystroke_time)
+        with self.lock:
+            self.results.append({'status': status,
+                                 'outcome': outcome,
+                                 'latency_ms': 1000 * (received - sent),
+                                 'first_ms': first_ms,
+                                 'timings': timings,
+                                 'stale': stale,
+                                 'lag_ms': 1000 * (sent - start - send_time / self.speed)})
+
+    def _user(self, trace, executor, start, futures):
+        '''Schedule the requests of one user in real time'''
+        session = uuid.uuid4().hex
+        keystrokes = [t for t, _ in trace]
+        for send_time, keystroke_time, text in debounce(trace, self.debounce_delay):
+            if self.duration is not None and send_time / self.speed > self.duration:
+                break
+            delay = start + send_time / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(self._send, session, keystrokes,
+                                           keystroke_time, send_time, text, start))
+
+    def run(self):
+        '''Replay every trace and return the report as a dictionary'''
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            start = time.perf_counter()
+            users = [threading.Thread(target=self._user, args=(trace, executor, start, futures))
+                     for trace in self.traces]
+            for user in users:
+                user.start()
+            for user in users:
+                user.join()
+            for future in futures:
+                future.result()
+            elapsed = time.perf_counter() - start
+        return report(self.results, elapsed, len(self.traces))
+
+
+def distribution(values):
+    '''p50, p95 and p99 of values'''
+    if not values:
+        return None
+    return {'p%d' % q: float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def report(results, elapsed, n_users):
+    '''Summarize the recorded requests'''
+    completed = [result for result in results if result['outcome'] == 'ok']
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+
+    return {'users': n_users,
+            'seconds': elapsed,
+            'requests': len(results),
+            'completed': len(completed),
+            'throughput_rps': len(completed) / elapsed if elapsed else 0.0,
+            'outcomes': outcomes,
+            'latency_ms': distribution([result['latency_ms'] for result in completed]),
+            'first_chunk_ms': distribution([result['first_ms'] for result in completed
+                                            if result['first_ms'] is not None]),
+            'queue_ms': distribution([result['timings']['queue'] for result in completed
+                                      if 'queue' in result['timings']]),
+            'decode_ms': distribution([result['timings']['decode'] for result in completed
+                                       if 'decode' in result['timings']]),
+            'send_lag_ms': distribution([result['lag_ms'] for result in results]),
+            'stale_rate': (sum(result['stale'] for result in completed) / len(completed)
+                           if completed else 0.0)}
+
+
+def in_process_target(model_file, predict_n, app_args):
+    '''Load the webapp with a model and return a ClientTarget of it'''
+    sys.argv = ['app.py', model_file, str(predict_n)] + app_args
+    from webapp import app
+
+    app.load_objects()
+    return ClientTarget(app.app)
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete typing trace load test',
+                            epilog='Other options are passed to app.py with --model')
+    parser.add_argument('-u', type=int, default=10, action='store', dest='n_users',
+                        help='Simulated users, when the traces are synthesized')
+    parser.add_argument('-d', type=float, default=30, action='store', dest='duration',
+                        help='Seconds after which no new request is sent')
+    parser.add_argument('--url', action='store', dest='url',
+                        help='Base URL of a running app')
+    parser.add_argument('--model', action='store', dest='model_file',
+                        help='Model file or weight archive to serve in-process instead')
+    parser.add_argument('-n', type=int, default=25, action='store', dest='predict_n',
+                        help='Number of characters to predict, with --model')
+    parser.add_argument('--traces', action='store', dest='traces',
+                        help='JSON lines file of recorded keystroke traces')
+    parser.add_argument('--stream', action='store_true', dest='stream',
+                        help='Request /predict_stream instead of /predict')
+    parser.add_argument('--debounce', type=float, default=1.0, action='store', dest='debounce',
+                        help='Seconds without a keystroke before the editor sends a request')
+    parser.add_argument('--speed', type=float, default=1.0, action='store', dest='speed',
+                        help='Replay the traces this many times faster')
+    parser.add_argument('-o', action='store', dest='output',
+                        help='JSON file the report is written to')
+
+    settings, app_args = parser.parse_known_args()
+
+    if (settings.url is None) == (settings.model_file is None):
+        arg_error(parser, 'error: Give exactly one of --url and --model')
+
+    if settings.traces is not None and not os.path.isfile(settings.traces):
+        arg_error(parser, 'error: Trace file not found')
+
+    if settings.traces is not None:
+        traces = load_traces(settings.traces)
+    else:
+        traces = [synthesize_trace(settings.duration * settings.speed, seed=user)
+                  for user in range(settings.n_users)]
+
+    if settings.url is not None:
+        target = HttpTarget(settings.url)
+    else:
+        target = in_process_target(settings.model_file, settings.predict_n, app_args)
+
+    print('Replaying %d users for up to %.0f seconds...' % (len(traces), settings.duration))
+    results = LoadTest(target, traces, stream=settings.stream,
+                       debounce_delay=settings.debounce, speed=settings.speed,
+                       duration=settings.duration).run()
+
+    print(json.dumps(results, indent=1))
+    if settings.output is not None:
+        with io.open(settings.output, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
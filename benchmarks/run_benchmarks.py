@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+'''run_benchmarks.py
+
+Latency and throughput benchmarks of the data pipeline, training and
+serving, run on a synthetic corpus and small randomly initialised models so
+they need no GPU and no downloads. The suites measure:
+
+    encoding -- MB/s of char_encoding, CharVectorizer and PyCodeVectors
+    generators -- batches/s of every training data generator
+    training -- samples/s of train_on_batch on a pyCodeRNNBuilder model
+    decoding -- p50/p99 ms per decoded character of CodeGenerator, by
+                prompt length and batch size
+    serving -- requests/s and p50/p99 ms of the BatchingWorker behind /predict
+
+Suites whose dependencies are not installed, such as Keras for training,
+are recorded as skipped.
+
+Example:
+
+    To run every suite and save the results run:
+
+     $ python -m benchmarks.run_benchmarks results.json
+
+    To compare with a stored baseline, and exit with status 1 if a metric
+    is more than 20% worse, run:
+
+     $ python -m benchmarks.run_benchmarks results.json -b baseline.json -t 0.2
+
+    Use -s to run some suites only and -q for a quicker, noisier run.
+    Metrics ending in _per_second are better when higher and metrics ending
+    in _ms are better when lower; the others, such as counts, are listed as
+    not compared.
+
+Attributes:
+    SUITES -- names of the benchmark suites, in the order they run
+
+Todo:
+    *
+'''
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from benchmarks.synthetic import random_archive, synthetic_corpus, synthetic_source
+from pycodecomplete.ml.char_encoding import encode, lookup_table
+from pycodecomplete.ml.code_generation import CodeGenerator
+from pycodecomplete.ml.codetovec import CORPUS_CACHE, PyCodeVectors
+from pycodecomplete.ml.corpus import corpus_paths
+from pycodecomplete.ml.file_index import MANIFEST
+from pycodecomplete.ml.numpy_lstm import NumpyLSTM
+from pycodecomplete.ml.process_text import CharVectorizer
+from pycodecomplete.ml.sampling import Sampler
+from webapp.batching import BatchingWorker
+
+SUITES = ('encoding', 'generators', 'training', 'decoding', 'serving')
+SEQUENCE_LENGTH = 100
+ML_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'pycodecomplete', 'ml')
+
+
+def timed(function, min_time=0.5, min_repeat=3, max_repeat=100):
+    '''Call function until it ran for min_time seconds and at least
+    min_repeat times, and return the duration of every call in seconds'''
+    durations = []
+    total = 0.0
+    while len(durations) < max_repeat and (total < min_time or len(durations) < min_repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+        total += durations[-1]
+    return durations
+
+
+def throughput(durations, amount):
+    '''Median amount per second of calls that took durations seconds each'''
+    return amount / float(np.median(durations))
+
+
+def percentiles(durations):
+    '''p50 and p99 of durations in seconds, as milliseconds'''
+    return {'p50_ms': 1000 * float(np.percentile(durations, 50)),
+            'p99_ms': 1000 * float(np.percentile(durations, 99))}
+
+
+def batches_per_second(batches, batch_size, n_batches=None):
+    '''Batches and samples per second drawn from the iterator batches, for
+    n_batches batches or until it is exhausted'''
+    n_samples = 0
+    count = 0
+    start = time.perf_counter()
+    for batch in batches:
+        n_samples += len(batch[0])
+        count += 1
+        if count == n_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return {'batch_size': batch_size,
+            'batches_per_second': count / elapsed,
+            'samples_per_second': n_samples / elapsed}
+
+
+def bench_encoding(data, quick=False):
+    '''MB/s of the encoders'''
+    results = {}
+    mb = len(data['source']) / 2 ** 20
+    table = lookup_table(CharVectorizer().tokens)
+    results['char_encoding_encode'] = {
+        'mb_per_second': throughput(timed(lambda: encode(data['source'], table)), mb)}
+
+    char_vectorizer = CharVectorizer(sequence_length=SEQUENCE_LENGTH)
+    text = data['source'][:20000 if quick else 50000]
+    text_mb = len(text) / 2 ** 20
+    for sparse in (False, True):
+        name = 'char_vectorizer_encode_windows' + ('_sparse' if sparse else '')
+        results[name] = {'mb_per_second': throughput(
+            timed(lambda: char_vectorizer.encode_windows(text, sparse=sparse)), text_mb)}
+
+    corpus_mb = data['corpus_bytes'] / 2 ** 20
+    char_vectorizer = CharVectorizer(sequence_length=SEQUENCE_LENGTH, input='directorypath')
+    path = os.path.join(data['tmp'], 'windows')
+    results['char_vectorizer_transform_to_disk'] = {'mb_per_second': throughput(
+        timed(lambda: char_vectorizer.transform_to_disk(data['corpus'], path),
+              min_repeat=2, max_repeat=5), corpus_mb)}
+
+    cached = [os.path.join(data['corpus'], MANIFEST)] + list(corpus_paths(
+        os.path.join(data['corpus'], CORPUS_CACHE % SEQUENCE_LENGTH)))
+
+    def fit_cold():
+        for path in cached:
+            if os.path.exists(path):
+                os.remove(path)
+        PyCodeVectors(sequence_length=SEQUENCE_LENGTH).fit(data['corpus'])
+
+    results['pycodevectors_fit'] = {'mb_per_second': throughput(
+        timed(fit_cold, min_repeat=2, max_repeat=5), corpus_mb)}
+    results['pycodevectors_fit_indexed'] = {'mb_per_second': throughput(
+        timed(lambda: PyCodeVectors(sequence_length=SEQUENCE_LENGTH).fit(data['corpus']),
+              min_repeat=2, max_repeat=5), corpus_mb)}
+    return results
+
+
+def bench_generators(data, quick=False, batch_size=128):
+    '''Batches/s of the training data generators'''
+    results = {}
+    n_batches = 20 if quick else 100
+    pycodevectors = data['pycodevectors']
+
+    for sparse in (False, True):
+        suffix = '_sparse' if sparse else ''
+        results['data_generator' + suffix] = batches_per_second(
+            pycodevectors.data_generator(batch_size, sparse=sparse), batch_size, n_batches)
+        schedule = pycodevectors.tbptt_schedule(batch_size)
+        results['tbptt_generator' + suffix] = batches_per_second(
+            pycodevectors.tbptt_generator(schedule, sparse=sparse), batch_size, n_batches)
+
+    # Every file is encoded whole before its batches are served, so time a full pass
+    char_vectorizer = CharVectorizer(sequence_length=SEQUENCE_LENGTH, input='directorypath')
+    char_vectorizer.fit(data['corpus'])
+    for sparse in (False, True):
+        results['char_vectorizer_batch_generator' + ('_sparse' if sparse else '')] = (
+            batches_per_second(char_vectorizer.batch_generator(batch_size=batch_size,
+                                                               sparse=sparse),
+                               batch_size))
+
+    try:
+        from pycodecomplete.ml.window_sequence import WindowSequence
+    except ImportError as e:
+        results['window_sequence'] = {'skipped': str(e)}
+        return results
+
+    for sparse in (False, True):
+        sequence = WindowSequence(pycodevectors.source_indices, pycodevectors.file_offsets,
+                                  SEQUENCE_LENGTH, batch_size,
+                                  pycodevectors.vocabulary_length, sparse=sparse)
+        results['window_sequence' + ('_sparse' if sparse else '')] = batches_per_second(
+            (sequence[i % len(sequence)] for i in range(n_batches)), batch_size)
+    return results
+
+
+def bench_training(data, quick=False, batch_size=128):
+    '''Samples/s of train_on_batch on a small pyCodeRNNBuilder model'''
+    try:
+        sys.path.insert(0, ML_DIRECTORY)
+        from rnn import pyCodeRNNBuilder
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    results = {}
+    n_batches = 5 if quick else 20
+    for sparse in (False, True):
+        builder = pyCodeRNNBuilder(SEQUENCE_LENGTH, os.path.join(data['tmp'], 'models'),
+                                   data['corpus'], n_layers=2, hidden_layer_dim=64,
+                                   sparse=sparse)
+        generator = builder.pycodevectors.data_generator(batch_size, sparse=sparse)
+        batches = [next(generator) for _ in range(n_batches + 2)]
+
+        for X, y in batches[:2]:
+            builder.model.train_on_batch(X, y)
+        durations = []
+        for X, y in batches[2:]:
+            start = time.perf_counter()
+            builder.model.train_on_batch(X, y)
+            durations.append(time.perf_counter() - start)
+
+        result = {'batch_size': batch_size,
+                  'samples_per_second': throughput(durations, batch_size)}
+        result.update(percentiles(durations))
+        results['train_on_batch' + ('_sparse' if sparse else '')] = result
+    return results
+
+
+def bench_decoding(data, quick=False, n_chars=25):
+    '''Milliseconds to the first and to every following decoded character'''
+    results = {}
+    code_gen = CodeGenerator(data['engine'], CharVectorizer(sequence_length=SEQUENCE_LENGTH),
+                             sampler=Sampler(seed=0))
+    repeats = 3 if quick else 10
+
+    single = timed(lambda: code_gen.predict_n(data['source'][:SEQUENCE_LENGTH], n_chars),
+                   min_repeat=repeats)
+    results['predict_n'] = {'per_character_ms': 1000 * float(np.median(single)) / n_chars}
+
+    for prompt_length in (10, 100, 1000):
+        for batch_size in (1, 4, 16):
+            first = []
+            steps = []
+            for repeat in range(repeats):
+                offsets = np.arange(batch_size) * 997 + repeat * 13
+                prompts = [data['source'][offset:offset + prompt_length] for offset in offsets]
+                times = []
+
+                def on_step(row, char):
+                    if row == 0:
+                        times.append(time.perf_counter())
+
+                start = time.perf_counter()
+                code_gen.predict_batch(prompts, [n_chars] * batch_size, [1.0] * batch_size,
+                                       on_step=on_step)
+                first.append(times[0] - start)
+                steps.extend(np.diff(times))
+
+            result = {'first_character': percentiles(first),
+                      'next_character': percentiles(steps)}
+            results['prompt_%d_batch_%d' % (prompt_length, batch_size)] = result
+    return results
+
+
+def bench_serving(data, quick=False, n_chars=25):
+    '''Requests/s and latency of the BatchingWorker with concurrent clients'''
+    results = {}
+    n_requests = 10 if quick else 40
+    for concurrency in (1, 8):
+        code_gen = CodeGenerator(data['engine'],
+                                 CharVectorizer(sequence_length=SEQUENCE_LENGTH),
+                                 sampler=Sampler(seed=0))
+        worker = BatchingWorker(code_gen, max_batch_size=8, max_wait=0.002,
+                                max_queue_size=concurrency * 2)
+        worker.start()
+        worker.submit(data['source'][:SEQUENCE_LENGTH], n_chars)
+
+        latencies = [[] for _ in range(concurrency)]
+
+        def client(i):
+            for j in range(n_requests):
+                offset = (i * n_requests + j) * 101
+                start = time.perf_counter()
+                worker.submit(data['source'][offset:offset + 200], n_chars, timeout=60)
+                latencies[i].append(time.perf_counter() - start)
+
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        worker.stop()
+
+        result = {'requests_per_second': concurrency * n_requests / elapsed}
+        result.update(percentiles([latency for client_latencies in latencies
+                                   for latency in client_latencies]))
+        results['concurrency_%d' % concurrency] = result
+    return results
+
+
+def prepare(tmp, quick=False):
+    '''Write the synthetic corpus and model shared by the suites'''
+    corpus = os.path.join(tmp, 'corpus')
+    corpus_bytes = synthetic_corpus(corpus, n_files=40 if quick else 200)
+    archive = os.path.join(tmp, 'archive')
+    random_archive(archive, vocabulary_size=len(CharVectorizer().tokens),
+                   units=128 if quick else 256)
+
+    pycodevectors = PyCodeVectors(sequence_length=SEQUENCE_LENGTH)
+    pycodevectors.fit(corpus)
+    return {'tmp': tmp,
+            'corpus': corpus,
+            'corpus_bytes': corpus_bytes,
+            'source': synthetic_source(2 ** 20 if quick else 2 ** 22, seed=1),
+            'pycodevectors': pycodevectors,
+            'engine': NumpyLSTM(archive)}
+
+
+def run(suites=SUITES, quick=False):
+    '''Run the suites and return their results with a description of the machine'''
+    benchmarks = {'encoding': bench_encoding,
+                  'generators': bench_generators,
+                  'training': bench_training,
+                  'decoding': bench_decoding,
+                  'serving': bench_serving}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        data = prepare(tmp, quick=quick)
+        for suite in suites:
+            print('Running %s benchmarks...' % suite)
+            results[suite] = benchmarks[suite](data, quick=quick)
+
+    return {'metadata': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                         'python': platform.python_version(),
+                         'numpy': np.__version__,
+                         'platform': platform.platform(),
+                         'cpu_count': os.cpu_count(),
+                         'quick': quick},
+            'results': results}
+
+
+def flatten(results, prefix=''):
+    '''Map the path of every number in nested results, such as
+    decoding.predict_n.per_character_ms, to the number'''
+    flat = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def skipped(results, prefix=''):
+    '''Map the path of every benchmark that was skipped to the reason'''
+    reasons = {}
+    for key, value in results.items():
+        if key == 'skipped':
+            reasons[prefix.rstrip('.')] = value
+        elif isinstance(value, dict):
+            reasons.update(skipped(value, prefix + key + '.'))
+    return reasons
+
+
+def comparable(metric):
+    '''True if a metric ends in _per_second or _ms, so it has a direction'''
+    return metric.endswith(('_per_second', '_ms'))
+
+
+def uncompared(results, baseline):
+    '''Metrics of both results and the baseline that compare skips, because
+    their names do not say whether higher or lower is better'''
+    shared = set(flatten(results['results'])) & set(flatten(baseline['results']))
+    return sorted(metric for metric in shared if not comparable(metric))
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''Compare the metrics of results with a baseline. Returns a list of
+    (metric, baseline, value, change, regressed), where change is the
+    relative improvement, negative when the metric got worse'''
+    current = flatten(results['results'])
+    previous = flatten(baseline['results'])
+
+    rows = []
+    for metric in sorted(set(current) & set(previous)):
+        if not comparable(metric):
+            continue
+        higher_is_better = metric.endswith('_per_second')
+        if previous[metric] == 0:
+            continue
+
+        change = (current[metric] - previous[metric]) / previous[metric]
+        if not higher_is_better:
+            change = -change
+        rows.append((metric, previous[metric], current[metric], change, change < -tolerance))
+    return rows
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete benchmarks')
+    parser.add_argument('output', action='store',
+                        help='JSON file the results are written to')
+    parser.add_argument('-b', action='store', dest='baseline',
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('-t', type=float, default=0.2, action='store', dest='tolerance',
+                        help='Largest relative slowdown of a metric before it is a regression')
+    parser.add_argument('-s', nargs='+', default=list(SUITES), choices=SUITES,
+                        action='store', dest='suites', help='Suites to run')
+    parser.add_argument('-q', action='store_true', dest='quick',
+                        help='Smaller inputs and fewer repeats')
+
+    settings = parser.parse_args()
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(settings.output))):
+        arg_error(parser, 'error: Invalid output folder')
+
+    if settings.baseline is not None and not os.path.isfile(settings.baseline):
+        arg_error(parser, 'error: Baseline file not found')
+
+    results = run(settings.suites, quick=settings.quick)
+    with io.open(settings.output, 'w') as outfile:
+        json.dump(results, outfile, indent=1, sort_keys=True)
+
+    for metric, value in sorted(flatten(results['results']).items()):
+        print('%-70s %12.3f' % (metric, value))
+    for metric, reason in sorted(skipped(results['results']).items()):
+        print('%-70s skipped: %s' % (metric, reason))
+
+    if settings.baseline is None:
+        return
+
+    with io.open(settings.baseline, 'r') as infile:
+        baseline = json.load(infile)
+    rows = compare(results, baseline, tolerance=settings.tolerance)
+    print('\nCompared with %s:' % settings.baseline)
+    for metric, previous, current, change, regressed in rows:
+        print('%-70s %12.3f %12.3f %+7.1f%%%s' % (metric, previous, current, 100 * change,
+                                                  '  REGRESSION' if regressed else ''))
+
+    skipped_metrics = uncompared(results, baseline)
+    if skipped_metrics:
+        print('Not compared: %s' % ', '.join(skipped_metrics))
+
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print('%d of %d metrics regressed by more than %.0f%%' %
+              (len(regressions), len(rows), 100 * settings.tolerance))
+        sys.exit(1)
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
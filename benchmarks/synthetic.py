@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''synthetic.py
+
+Synthetic inputs for the benchmarks, so they run on a CPU-only machine
+without downloading a corpus or training a model. The corpus is made of
+Python-like files built from a few templates with random identifiers, and
+the model is a weight archive of randomly initialised LSTM layers in the
+format NumpyLSTM loads.
+
+Everything is generated from a seed, so two runs measure the same work.
+
+Todo:
+    *
+'''
+import io
+import json
+import os
+import string
+
+import numpy as np
+
+from pycodecomplete.ml.numpy_lstm import CONFIG, FORMAT_VERSION
+
+TEMPLATES = ['import {a}\nfrom {b} import {c}\n\n',
+             'def {a}({b}, {c}=None):\n    \'\'\'Return the {b} of {c}\'\'\'\n'
+             '    if {c} is None:\n        {c} = []\n    return [{b} + x for x in {c}]\n\n',
+             'class {A}({B}):\n    def __init__(self, {a}):\n        self.{a} = {a}\n\n'
+             '    def {b}(self):\n        return self.{a} * {n}\n\n',
+             'for {a} in range({n}):\n    {b}[{a}] = {c}.get({a}, {n})\n',
+             '{a} = {{\'{b}\': {n}, \'{c}\': "{b}"}}\n',
+             'try:\n    {a} = {b}({c})\nexcept ValueError as e:\n    print(e)\n\n',
+             'with open({a}, \'r\') as {b}:\n    {c} = {b}.read().split()\n\n']
+
+
+def synthetic_source(length, seed=0):
+    '''A string of Python-like code about length characters long'''
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase))
+
+    def identifier():
+        return ''.join(rng.choice(letters, size=rng.integers(3, 10)))
+
+    chunks = []
+    total = 0
+    while total < length:
+        template = TEMPLATES[rng.integers(len(TEMPLATES))]
+        chunk = template.format(a=identifier(), b=identifier(), c=identifier(),
+                                A=identifier().title(), B=identifier().title(),
+                                n=int(rng.integers(1000)))
+        chunks.append(chunk)
+        total += len(chunk)
+    return ''.join(chunks)[:length]
+
+
+def synthetic_corpus(directory, n_files=100, file_length=4000, seed=0):
+    '''Write n_files Python-like .py files of about file_length characters to
+    directory, in a few subfolders, and return the number of bytes written'''
+    rng = np.random.default_rng(seed)
+    n_bytes = 0
+    for i in range(n_files):
+        folder = os.path.join(directory, 'package%d' % (i % 8))
+        os.makedirs(folder, exist_ok=True)
+        length = int(file_length * rng.uniform(0.5, 1.5))
+        source = synthetic_source(length, seed=seed * 100003 + i)
+        with io.open(os.path.join(folder, 'module%03d.py' % i), 'w') as outfile:
+            outfile.write(source)
+        n_bytes += len(source)
+    return n_bytes
+
+
+def random_archive(path, vocabulary_size=100, n_layers=2, units=128,
+                   embedding_dim=None, seed=0):
+    '''Write a weight archive of a randomly initialised model with n_layers
+    LSTM layers of units units, shaped like the ones pyCodeRNNBuilder builds.
+    With embedding_dim, the model reads token indices through an Embedding'''
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+
+    def weight(*shape):
+        scale = 1.0 / np.sqrt(shape[0])
+        return rng.uniform(-scale, scale, size=shape).astype(np.float32)
+
+    layers = []
+
+    def add(class_name, config, weights):
+        filenames = []
+        for j, array in enumerate(weights):
+            filename = 'layer%02d_%d.npy' % (len(layers), j)
+            np.save(os.path.join(path, filename), array)
+            filenames.append(filename)
+        layers.append({'class_name': class_name, 'config': config, 'weights': filenames})
+
+    input_dim = vocabulary_size
+    if embedding_dim is not None:
+        add('Embedding', {}, [weight(vocabulary_size, embedding_dim)])
+        input_dim = embedding_dim
+
+    for _ in range(n_layers):
+        add('LSTM', {'units': units, 'activation': 'tanh',
+                     'recurrent_activation': 'hard_sigmoid'},
+            [weight(input_dim, 4 * units), weight(units, 4 * units),
+             np.zeros(4 * units, dtype=np.float32)])
+        input_dim = units
+
+    add('Dense', {'activation': 'linear'},
+        [weight(units, vocabulary_size), np.zeros(vocabulary_size, dtype=np.float32)])
+    add('Activation', {'activation': 'softmax'}, [])
+
+    with io.open(os.path.join(path, CONFIG), 'w') as outfile:
+        json.dump({'format': FORMAT_VERSION,
+                   'sparse': embedding_dim is not None,
+                   'layers': layers}, outfile, indent=1)
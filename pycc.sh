@@ -1,18 +1,27 @@
 #!/bin/bash
 
-pycc_usage="$(basename "$0") [-h] model_file predict_n_characters -- Start PyCodeComplete WebApp
+pycc_usage="$(basename "$0") [-h] [-p workers] [-j threads] model_file predict_n_characters -- Start PyCodeComplete WebApp
 
 where:
     -h  show this help text
-    model_file  Serialized RNN Model
+    -p  serve with this many pre-forked worker processes that share the model
+    -j  cores and BLAS threads of each worker process (default 1)
+    model_file  Serialized RNN Model, or weight archive written by export_model.py
     predict_n_characters Number of characters to predict"
 
 
-while getopts ':h' opt; do
+workers=""
+threads=1
+
+while getopts ':hp:j:' opt; do
     case $opt in
         h)  echo "$pycc_usage"
             exit
             ;;
+        p)  workers=$OPTARG
+            ;;
+        j)  threads=$OPTARG
+            ;;
         \?)
             echo "Invalid option: -$OPTARG" >&2
             echo "$pycc_usage"
@@ -20,6 +29,7 @@ while getopts ':h' opt; do
             ;;
     esac
 done
+shift $((OPTIND - 1))
 
 if [ -z "$1" ]
   then
@@ -35,4 +45,9 @@ if [ -z "$2" ]
     exit
 fi
 
-python -m webapp.app $1 $2
+if [ -n "$workers" ]
+  then
+    python -m webapp.serve $1 $2 -p $workers -j $threads
+else
+    python -m webapp.app $1 $2
+fi
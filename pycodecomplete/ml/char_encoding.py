@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''char_encoding.py
+
+Shared encoding engine used by PyCodeVectors and CharVectorizer. Text is
+mapped once to a uint8 array of vocabulary indices through a 256 entry
+lookup table. Feature and target windows are then cut from that array with
+NumPy stride tricks and one-hot encoded with fancy indexing, instead of
+filling the tensors one character at a time.
+
+Todo:
+    *
+'''
+import numpy as np
+
+UNKNOWN_INDEX = 255
+
+
+def lookup_table(vocabulary):
+    '''Create a 256 entry table that maps a character code to its vocabulary
+    index. Characters outside the vocabulary map to UNKNOWN_INDEX'''
+    if len(vocabulary) >= UNKNOWN_INDEX:
+        raise ValueError('vocabulary must contain fewer than %d characters'
+                         % UNKNOWN_INDEX)
+
+    table = np.full(256, UNKNOWN_INDEX, dtype=np.uint8)
+    for idx, char in enumerate(vocabulary):
+        if ord(char) > 255:
+            raise ValueError('%r can not be encoded in a single byte' % char)
+        table[ord(char)] = idx
+
+    return table
+
+
+def encode(text, table, errors='ignore'):
+    '''Convert text to a uint8 array of vocabulary indices
+
+    Args:
+        text (str): The text to be encoded
+        table (ndarray): Lookup table created by lookup_table
+        errors (str): 'strict' raises a ValueError on characters outside the
+            vocabulary, 'ignore' drops them (default 'ignore')
+
+    Returns:
+        indices: uint8 array with one vocabulary index per kept character
+    '''
+    codes = np.frombuffer(text.encode('latin-1', errors), dtype=np.uint8)
+    indices = table[codes]
+
+    unknown = indices == UNKNOWN_INDEX
+    if unknown.any():
+        if errors == 'strict':
+            raise ValueError('%r is not in the vocabulary'
+                             % chr(codes[unknown.argmax()]))
+        indices = indices[~unknown]
+
+    return indices
+
+
+def sliding_windows(indices, width, step_size=1):
+    '''Return a read-only (n_windows, width) view of every window of width
+    indices, starting step_size indices apart. No data is copied'''
+    n_windows = max((len(indices) - width) // step_size + 1, 0)
+    stride = indices.strides[0]
+
+    return np.lib.stride_tricks.as_strided(indices,
+                                           shape=(n_windows, width),
+                                           strides=(stride * step_size, stride),
+                                           writeable=False)
+
+
+def one_hot(indices, n_tokens):
+    '''One-hot encode an array of indices as booleans along a new last axis'''
+    return np.eye(n_tokens, dtype=bool)[indices]
+
+
+def windows_to_xy(windows, n_tokens):
+    '''Split (n_windows, sequence_length + 1) windows into one-hot encoded
+    features X of shape (n_windows, sequence_length, n_tokens) and targets y
+    of shape (n_windows, n_tokens)'''
+    return one_hot(windows[:, :-1], n_tokens), one_hot(windows[:, -1], n_tokens)
+
+
+def affine_permute(order, multiplier, offset, n):
+    '''Return (order * multiplier + offset) % n for an array order of integers
+    below n, as int64. The product is exact for any n: it fits in uint64 when
+    n is at most 2 ** 32, and is computed with Python integers above that'''
+    order = np.asarray(order)
+    if n <= 2 ** 32:
+        order = order.astype(np.uint64)
+        return ((order * np.uint64(multiplier) + np.uint64(offset)) %
+                np.uint64(n)).astype(np.int64)
+    return ((order.astype(object) * int(multiplier) + int(offset)) % int(n)).astype(np.int64)
@@ -4,62 +4,223 @@ Generate python code with a trained RNN. Class CodeGenerator is composed
 of an RNN model and a vectorizer. Takes a string and generates a sequence
 of Python code
 
+By default the model is run incrementally: a stateful copy of the trained
+network is warmed once on the prompt window and then advanced one character
+at a time, carrying the LSTM hidden and cell states between steps.
+
+The model can also be a NumpyLSTM loaded from an archive written by
+export_model.py, in which case Keras and TensorFlow are never imported.
+
 Todo:
     * 
 '''
 import random
 import string
 import sys
+import time
 
 import numpy as np
 
-from keras.models import Sequential
+try:
+    from .process_text import CharVectorizer
+    from .char_encoding import one_hot
+    from .numpy_lstm import NumpyLSTM
+    from .sampling import Sampler
+except ImportError:
+    from process_text import CharVectorizer
+    from char_encoding import one_hot
+    from numpy_lstm import NumpyLSTM
+    from sampling import Sampler
+
+
+def stateful_copy(model, batch_size=1):
+    '''Rebuild a trained Sequential model as a stateful network with the same
+    weights that accepts windows of any length, so the LSTM states carry over
+    from one predict call to the next'''
+    from keras.models import Sequential
+
+    stateful_model = Sequential()
+    for i, layer in enumerate(model.layers):
+        config = layer.get_config()
+        if 'stateful' in config:
+            config['stateful'] = True
+        if 'input_length' in config:
+            config['input_length'] = None
+        if i == 0:
+            config['batch_input_shape'] = ((batch_size, None) +
+                                           tuple(model.input_shape[2:]))
+        stateful_model.add(layer.__class__.from_config(config))
+
+    for layer, stateful_layer in zip(model.layers, stateful_model.layers):
+        stateful_layer.set_weights(layer.get_weights())
+
+    return stateful_model
+
+
+class StatefulDecoder():
+    '''StatefulDecoder object that advances a trained model a few timesteps at a time
+
+    Parameters:
+        model -- trained Keras Sequential model
+        batch_size -- number of sequences decoded side by side (default 1)
+
+    Attributes:
+        reset -- clear the carried-over LSTM hidden and cell states
+        warm -- reset the states, feed a whole window and return the next character probabilities
+        step -- feed the next timesteps and return the next character probabilities
+        get_states -- return the carried-over states as numpy arrays
+        set_states -- replace the carried-over states, e.g. reordered by beam search
+    '''
+
+    def __init__(self, model, batch_size=1):
+        '''Create a StatefulDecoder Object'''
+        self.batch_size = batch_size
+        self.model = stateful_copy(model, batch_size=batch_size)
+        self.stateful_layers = [layer for layer in self.model.layers
+                                if getattr(layer, 'stateful', False)]
+
+    def reset(self):
+        '''Clear the carried-over LSTM hidden and cell states'''
+        self.model.reset_states()
 
-from .process_text import CharVectorizer
+    def warm(self, x):
+        '''Reset the states and feed a whole window of shape (batch, timesteps, ...)'''
+        self.reset()
+        return self.step(x)
 
-import tensorflow
-import keras
+    def step(self, x):
+        '''Feed the next timesteps and return the probabilities for the character
+        that follows the last one'''
+        preds = self.model.predict_on_batch(x)
+        if preds.ndim == 3:
+            preds = preds[:, -1]
+        return preds
+
+    def get_states(self):
+        '''Return the states of every stateful layer as a list of numpy arrays
+        of shape (batch_size, units), hidden and cell state for each LSTM'''
+        from keras import backend as K
+
+        return K.batch_get_value([state for layer in self.stateful_layers
+                                  for state in layer.states])
+
+    def set_states(self, states):
+        '''Replace the carried-over states with arrays ordered as get_states'''
+        states = iter(states)
+        for layer in self.stateful_layers:
+            layer.reset_states([next(states) for _ in layer.states])
+
+
+class PromptState():
+    '''Decoder state after reading a prompt, to continue from when the prompt
+    is extended
+
+    Parameters:
+        text -- the prompt
+        states -- LSTM states after the prompt, arrays of shape (1, units) ordered as get_states
+        preds -- probabilities of the character after the prompt
+        steps -- characters fed one by one after the warmup window (default 0)
+    '''
+
+    def __init__(self, text, states, preds, steps=0):
+        self.text = text
+        self.states = states
+        self.preds = preds
+        self.steps = steps
+        self.nbytes = sum(state.nbytes for state in states) + preds.nbytes + len(text)
 
 
 class CodeGenerator():
     '''CodeGenerator object that generates Python code with a supplied model
 
     Parameters:
-        sequence_length -- The number of characters in a sequence
-        save_pickle_folder -- location to save the pickled model after each epoch
-        pycode_directory -- location of the data
+        model -- trained Keras model, or NumpyLSTM
+        char_vectorizer -- CharVectorizer used to encode the input text
+        incremental -- decode with a stateful copy of the model, feeding one
+                       character per step instead of the whole window (default True)
+        sampler -- Sampler used to draw the characters (default unseeded Sampler)
+        top_k -- only sample from the k most likely characters (default None)
+        top_p -- only sample from the most likely characters totalling top_p (default None)
+        metrics -- object whose observe(stage, seconds) records the time spent
+                   vectorizing, warming up, stepping and sampling (default None)
 
     Attributes:
         predict_n -- Predict the next n charaters
         predict_n_with_previous -- return string with the predicted code appended to the input
+        prompt_states -- decoder states after reading prompts, reusing those of their prefixes
+        predict_batch -- predict completions of several prompts together
+        predict_beam -- the most likely completions of a prompt by beam search
+        predict_beams -- beam search the completions of several prompts together
     '''
 
-    def __init__(self, model, char_vectorizer):
+    def __init__(self, model, char_vectorizer, incremental=True, sampler=None,
+                 top_k=None, top_p=None, metrics=None):
         '''Create a CodeGenerator Object'''
         self.model = model
         self.char_vectorizer = char_vectorizer
         self.char_vectorizer.shuffle_files()
+        self.sparse = len(model.input_shape) == 2
+        self.incremental = incremental
+        self.decoder = self.new_decoder(1) if incremental else None
+        self.batch_decoders = {}
+        self.sampler = sampler or Sampler()
+        self.top_k = top_k
+        self.top_p = top_p
+        self.metrics = metrics
+
+    def _timed(self, stage, function, *args, **kwargs):
+        '''Return function(*args, **kwargs), recording its duration as stage
+        when metrics are collected'''
+        if self.metrics is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.metrics.observe(stage, time.perf_counter() - start)
+        return result
+
+    def new_decoder(self, batch_size):
+        '''Return a decoder of the model for batch_size sequences'''
+        if isinstance(self.model, NumpyLSTM):
+            return self.model.decoder(batch_size)
+        return StatefulDecoder(self.model, batch_size=batch_size)
+
+    def vectorize_indices(self, indices):
+        '''Convert a (batch, timesteps) array of token indices to the model input'''
+        indices = np.asarray(indices, dtype=np.uint8)
+        if self.sparse:
+            return indices
+        return one_hot(indices, len(self.char_vectorizer.tokens))
+
+    def vectorize(self, text):
+        '''Encode the last sequence_length characters of text as a model input'''
+        return self.vectorize_indices(self.char_vectorizer.encode_window(text)[np.newaxis])
+
+    def vectorize_windows(self, prev_texts, batch_size):
+        '''Encode the last window of each of prev_texts as the rows of a model
+        input of batch_size rows, the rows after the texts left blank'''
+        x_pred = np.zeros((batch_size, self.char_vectorizer.sequence_length), dtype=np.uint8)
+        for row, prev_text in enumerate(prev_texts):
+            x_pred[row] = self.char_vectorizer.encode_window(prev_text)
+        return self.vectorize_indices(x_pred)
 
     def sample(self, preds, temperature=1.0):
-        '''Helper function to sample an index from a probability array'''
-        preds = np.asarray(preds).astype('float64')
-        preds = np.log(preds) / temperature
-        exp_preds = np.exp(preds)
-        preds = exp_preds / np.sum(exp_preds)
-        probas = np.random.multinomial(1, preds, 1)
-        return np.argmax(probas)
+        '''Sample an index from a probability array, or one per row of a batch'''
+        return self.sampler.sample(preds, temperature, top_k=self.top_k, top_p=self.top_p)
 
     def predict_n(self, prev_text, n, diversity=1.0):
         '''Predict the next n charaters'''
+        if self.incremental:
+            return self._predict_n_incremental(prev_text, n, diversity=diversity)
+
         generated = ''
         sentence = prev_text
 
         for _ in range(n):
-            x_pred = self.char_vectorizer.vectorize(sentence)
+            x_pred = self._timed('vectorize', self.vectorize, sentence)
 
-            preds = self.model.predict(x_pred, verbose=0)[0]
+            preds = self._timed('predict', self.model.predict, x_pred, verbose=0)[0]
 
-            next_index = self.sample(preds, diversity)
+            next_index = self._timed('sample', self.sample, preds, diversity)
             next_char = self.char_vectorizer.indices_char[next_index]
 
             generated += next_char
@@ -67,6 +228,211 @@ class CodeGenerator():
 
         return generated
 
+    def _predict_n_incremental(self, prev_text, n, diversity=1.0):
+        '''Warm the stateful decoder on the prompt window once, then advance it
+        one character per generated character'''
+        generated = ''
+
+        x_pred = self._timed('vectorize', self.vectorize, prev_text)
+        preds = self._timed('warm', self.decoder.warm, x_pred)[0]
+
+        for i in range(n):
+            next_index = self._timed('sample', self.sample, preds, diversity)
+            generated += self.char_vectorizer.indices_char[next_index]
+
+            if i < n - 1:
+                preds = self._timed('step', self.decoder.step,
+                                    self.vectorize_indices([[next_index]]))[0]
+
+        return generated
+
+    def batch_decoder(self, batch_size):
+        '''Return a StatefulDecoder for at least batch_size sequences. Sizes are
+        rounded up to a power of two so only a few decoders are ever built'''
+        bucket = 1
+        while bucket < batch_size:
+            bucket *= 2
+        if bucket not in self.batch_decoders:
+            self.batch_decoders[bucket] = self.new_decoder(bucket)
+        return self.batch_decoders[bucket]
+
+    def prompt_states(self, prev_texts, cached=None, max_steps=None):
+        '''Return the PromptState after reading each of prev_texts. When
+        cached[i] is the PromptState of a prefix of prev_texts[i], only the
+        rest of the text is fed, unless that takes the decoder more than
+        max_steps characters (default sequence_length) past its warmup window.
+        The prompts with as many characters left to feed are fed together,
+        and the other prompts are warmed up together on their last window'''
+        max_steps = max_steps or self.char_vectorizer.sequence_length
+        cached = cached or [None] * len(prev_texts)
+        prompt_states = [None] * len(prev_texts)
+
+        fresh = []
+        continued = {}
+        for row, (prev_text, state) in enumerate(zip(prev_texts, cached)):
+            if state is None or not prev_text.startswith(state.text):
+                fresh.append(row)
+                continue
+
+            indices = self.char_vectorizer.encode(prev_text[len(state.text):])
+            if len(indices) == 0:
+                prompt_states[row] = state
+            elif state.steps + len(indices) > max_steps:
+                fresh.append(row)
+            else:
+                continued.setdefault(len(indices), []).append((row, indices))
+
+        for length, group in continued.items():
+            decoder = self.batch_decoder(len(group))
+            self._set_prompt_states(decoder, [cached[row] for row, _ in group])
+            x = np.zeros((decoder.batch_size, length), dtype=np.uint8)
+            for i, (_, indices) in enumerate(group):
+                x[i] = indices
+            preds = self._timed('feed', decoder.step, self.vectorize_indices(x))
+            states = decoder.get_states()
+            for i, (row, _) in enumerate(group):
+                prompt_states[row] = PromptState(prev_texts[row],
+                                                 [state[i:i + 1].copy() for state in states],
+                                                 preds[i].copy(),
+                                                 steps=cached[row].steps + length)
+
+        if fresh:
+            decoder = self.batch_decoder(len(fresh))
+            x_pred = self._timed('vectorize', self.vectorize_windows,
+                                 [prev_texts[row] for row in fresh], decoder.batch_size)
+            preds = self._timed('warm', decoder.warm, x_pred)
+            states = decoder.get_states()
+            for i, row in enumerate(fresh):
+                prompt_states[row] = PromptState(prev_texts[row],
+                                                 [state[i:i + 1].copy() for state in states],
+                                                 preds[i].copy())
+
+        return prompt_states
+
+    def _set_prompt_states(self, decoder, prompt_states):
+        '''Load the PromptStates into the first rows of decoder and return the
+        matching rows of next character probabilities'''
+        states = []
+        for i, state in enumerate(prompt_states[0].states):
+            rows = np.zeros((decoder.batch_size,) + state.shape[1:], dtype=state.dtype)
+            rows[:len(prompt_states)] = np.concatenate(
+                [prompt_state.states[i] for prompt_state in prompt_states])
+            states.append(rows)
+        decoder.set_states(states)
+
+        preds = np.zeros((decoder.batch_size,) + prompt_states[0].preds.shape,
+                         dtype=prompt_states[0].preds.dtype)
+        preds[:len(prompt_states)] = [prompt_state.preds for prompt_state in prompt_states]
+        return preds
+
+    def predict_batch(self, prev_texts, ns, diversities, prompt_states=None, on_step=None):
+        '''Predict the next ns[i] characters of every prev_texts[i] with one batched
+        stateful decoder, advancing all the sequences together each step. With
+        prompt_states, from prompt_states, decoding starts from those states
+        instead of warming up on the texts. on_step(row, char) is called with
+        every character as soon as it is sampled; when it returns False that
+        row is not decoded any further'''
+        decoder = self.batch_decoder(len(prev_texts))
+        ns = list(ns)
+        generated = [''] * len(prev_texts)
+
+        if prompt_states is not None:
+            preds = self._set_prompt_states(decoder, prompt_states)
+        else:
+            x_pred = self._timed('vectorize', self.vectorize_windows, prev_texts,
+                                 decoder.batch_size)
+            preds = self._timed('warm', decoder.warm, x_pred)
+
+        n_rows = len(prev_texts)
+        diversities = np.asarray(diversities, dtype=np.float64)
+        next_indices = np.zeros((decoder.batch_size, 1), dtype=np.uint8)
+        i = 0
+        while i < max(ns):
+            next_indices[:n_rows, 0] = self._timed('sample', self.sample, preds[:n_rows],
+                                                   diversities)
+            for row in range(n_rows):
+                if i < ns[row]:
+                    next_char = self.char_vectorizer.indices_char[next_indices[row, 0]]
+                    generated[row] += next_char
+                    if on_step is not None and on_step(row, next_char) is False:
+                        ns[row] = i + 1
+
+            i += 1
+            if i < max(ns):
+                preds = self._timed('step', decoder.step, self.vectorize_indices(next_indices))
+
+        return generated
+
+    def predict_beam(self, prev_text, n, beam_width=4, prompt_state=None, cancelled=None):
+        '''Return the beam_width most likely completions of n characters after
+        prev_text as (completion, log probability) pairs, best first. All the
+        hypotheses are advanced together as one batch each step. With a
+        prompt_state, from prompt_states, decoding starts from it. When
+        cancelled() returns True the search stops and the shorter beams found
+        so far are returned'''
+        return self.predict_beams([prev_text], [n], [beam_width],
+                                  prompt_states=None if prompt_state is None else [prompt_state],
+                                  cancelled=None if cancelled is None else
+                                  lambda row: cancelled())[0]
+
+    def predict_beams(self, prev_texts, ns, beam_widths, prompt_states=None, cancelled=None):
+        '''Beam search the completions of several prompts with one batched
+        decoder. Prompt i gets a block of beam_widths[i] rows, so the decoder
+        advances the hypotheses of all the prompts together each step, and its
+        ns[i] characters long completions are returned as in predict_beam.
+        When cancelled(i) returns True the search of prompt i stops'''
+        offsets = np.concatenate([[0], np.cumsum(beam_widths)]).astype(np.intp)
+        decoder = self.batch_decoder(int(offsets[-1]))
+        n_tokens = len(self.char_vectorizer.tokens)
+        rows = [i for i, beam_width in enumerate(beam_widths) for _ in range(beam_width)]
+
+        if prompt_states is not None:
+            preds = self._set_prompt_states(decoder, [prompt_states[i] for i in rows])
+        else:
+            x_pred = self._timed('vectorize', self.vectorize_windows,
+                                 [prev_texts[i] for i in rows], decoder.batch_size)
+            preds = self._timed('warm', decoder.warm, x_pred)
+
+        beams = [[''] for _ in prev_texts]
+        scores = [np.zeros(1) for _ in prev_texts]
+        searching = [n > 0 for n in ns]
+        next_indices = np.zeros((decoder.batch_size, 1), dtype=np.uint8)
+        step = 0
+        while any(searching):
+            started = time.perf_counter()
+            parents = np.arange(decoder.batch_size)
+            for i, beam_width in enumerate(beam_widths):
+                if not searching[i]:
+                    continue
+                offset = offsets[i]
+                candidates = (scores[i][:, np.newaxis] +
+                              np.log(np.maximum(preds[offset:offset + len(beams[i])],
+                                                1e-12))).ravel()
+
+                k = min(beam_width, len(candidates))
+                best = np.argpartition(-candidates, k - 1)[:k]
+                best = best[np.argsort(-candidates[best])]
+                best_parents, best_tokens = np.divmod(best, n_tokens)
+
+                beams[i] = [beams[i][parent] + self.char_vectorizer.indices_char[token]
+                            for parent, token in zip(best_parents, best_tokens)]
+                scores[i] = candidates[best]
+
+                parents[offset:offset + k] = offset + best_parents
+                next_indices[offset:offset + k, 0] = best_tokens
+                searching[i] = (step < ns[i] - 1 and
+                                not (cancelled is not None and cancelled(i)))
+            if self.metrics is not None:
+                self.metrics.observe('sample', time.perf_counter() - started)
+
+            step += 1
+            if any(searching):
+                self._timed('reorder', decoder.set_states,
+                            [state[parents] for state in decoder.get_states()])
+                preds = self._timed('step', decoder.step, self.vectorize_indices(next_indices))
+
+        return [list(zip(beams[i], scores[i].tolist())) for i in range(len(prev_texts))]
+
     def predict_n_with_previous(self, prev_text, n, diversity=1.0):
         '''Return a string with the predicted code appended to the input'''
         return prev_text + self.predict_n(prev_text, n, diversity=diversity)
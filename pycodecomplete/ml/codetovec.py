@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
 '''codetovec.py
 
-PyCodeVectors converts Python code to encoded vectors using multiprocessing
+PyCodeVectors converts Python code to encoded vectors using multiprocessing.
+Encoding is done by the shared engine in char_encoding
+
+A source folder is encoded once into a corpus cached next to its FileIndex
+manifest. Later fits memory-map the cached corpus as long as the indexed
+files are unchanged, so starting training does not read the whole tree.
+Both are kept in the source folder, or, when it is read-only, in a folder
+of ~/.cache/pycodecomplete named after it, unless a cache_directory is given.
 
 Todo:
     * 
 '''
 import glob
+import hashlib
 import io
 import os
 import numpy as np
+import heapq
 import string
 import multiprocessing
 
+try:
+    from .char_encoding import encode, lookup_table, one_hot, sliding_windows, windows_to_xy
+    from .corpus import MappedCorpus, build_corpus, corpus_paths, is_corpus
+    from .file_index import MANIFEST, FileIndex
+except ImportError:
+    from char_encoding import encode, lookup_table, one_hot, sliding_windows, windows_to_xy
+    from corpus import MappedCorpus, build_corpus, corpus_paths, is_corpus
+    from file_index import MANIFEST, FileIndex
+
+# Base path, in the cache folder, of the corpus cached for a sequence length
+CORPUS_CACHE = '.file_index.corpus%d'
+# Parent of the cache folders of read-only source folders
+USER_CACHE = os.path.join('~', '.cache', 'pycodecomplete')
+
 
 class PyCodeVectors():
     '''PyCodeVectors object that converts Python code to one-hot-encoded vectors
@@ -26,14 +49,24 @@ class PyCodeVectors():
         step_size -- number of characters to step to create the next sequence (default 1)
         file_extension -- the file extension of teh fiels to use as data (default .py)
         pad_token -- token to use as padding (default \x0c)
+        cache_directory -- folder the file index and encoded corpus of a source folder are
+                           kept in (default the source folder, or a folder in
+                           ~/.cache/pycodecomplete when it is read-only)
 
     Attributes:
         vocabulary_length -- number of characters in vocabulary
         char_to_idx -- dictionary that maps character to one-hot-encoding index
         idx_to_char -- dictionary that maps one-hot-encoding index to character
+        lookup_table -- 256 entry array that maps a character code to its index
         file_list -- list of all files used as data
         n_files -- number of files used
         source_length -- total number of characters in all the files
+        source_indices -- uint8 array of the vocabulary indices of all the files,
+                          memory-mapped when fit on a corpus built by make_corpus.py
+        file_offsets -- int64 array of the start and end of each file in source_indices
+        validation_mask -- files held out for validation, chosen by path hash
+        windows -- uint8 array of the windows of a subset of the files
+        file_index -- FileIndex of a source directory with the same encoding settings
     '''
 
     def __init__(self,
@@ -43,7 +76,8 @@ class PyCodeVectors():
                  sequence_length=100,
                  step_size=1,
                  file_extension='.py',
-                 pad_token='\x0c'):
+                 pad_token='\x0c',
+                 cache_directory=None):
         '''Create a PyCodeVectors object'''
         self.source_directory = None
         self.encoding = encoding
@@ -53,21 +87,150 @@ class PyCodeVectors():
         self.step_size = step_size
         self.file_extension = file_extension
         self.pad_token = pad_token
+        self.cache_directory = cache_directory
 
         self.vocabulary_length = len(self.vocabulary)
         self.char_to_idx, self.idx_to_char = self._generate_mapping(
             self.vocabulary)
+        self.lookup_table = lookup_table(self.vocabulary)
 
         self.file_list = None
         self.n_files = None
         self.source_length = None
+        self.source_indices = None
+        self.file_offsets = None
+
+    def fit(self, source_directory, file_index=None):
+        '''Set the object's data directory, or the path of a corpus built by
+           make_corpus.py, and memory-map all of its files. The files of a
+           directory are listed by file_index, or by a refreshed FileIndex, and
+           encoded into a cached corpus unless it is already up to date'''
+        if is_corpus(source_directory):
+            self.load_corpus(source_directory)
+            return
+
+        if file_index is None:
+            file_index = self.file_index(source_directory).refresh()
+
+        self.load_corpus(self.cached_corpus(file_index))
+        self.source_directory = source_directory
+        self.file_list = file_index.file_list
+
+    def cached_corpus(self, file_index):
+        '''Return the base path of the corpus of the files of file_index cached
+           in the cache folder of its source folder, encoding it first if the
+           files changed since it was built. The new corpus replaces the old
+           one once complete'''
+        path = os.path.join(self.cache_folder(file_index.source_directory),
+                            CORPUS_CACHE % self.sequence_length)
+        fingerprint = file_index.fingerprint()
+        if is_corpus(path):
+            corpus = MappedCorpus(path)
+            if (corpus.fingerprint == fingerprint and corpus.vocabulary == self.vocabulary and
+                    corpus.pad_token == self.pad_token and
+                    corpus.sequence_length == self.sequence_length):
+                return path
+
+        print('Encoding', file_index.n_files, 'files')
+        temporary_path = path + '.tmp'
+        build_corpus(file_index.source_directory, file_index.file_list, temporary_path,
+                     vocabulary=self.vocabulary,
+                     sequence_length=self.sequence_length,
+                     pad_token=self.pad_token,
+                     encoding=self.encoding,
+                     decode_errors=self.decode_errors,
+                     fingerprint=fingerprint)
+        # The metadata goes last, so a partly replaced corpus is never loaded
+        for temporary, final in zip(corpus_paths(temporary_path), corpus_paths(path)):
+            os.replace(temporary, final)
+        return path
+
+    def cache_folder(self, source_directory):
+        '''Folder the file index and cached corpus of source_directory are kept
+           in: cache_directory if set, else the source folder if it is writable,
+           else a folder of ~/.cache/pycodecomplete named after its path'''
+        if self.cache_directory is not None:
+            folder = self.cache_directory
+        elif os.access(source_directory, os.W_OK):
+            return source_directory
+        else:
+            path = os.path.abspath(source_directory)
+            folder = os.path.join(os.path.expanduser(USER_CACHE), '%s-%s' % (
+                os.path.basename(path),
+                hashlib.sha1(path.encode('utf-8', errors='surrogateescape')).hexdigest()[:12]))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def file_index(self, source_directory):
+        '''FileIndex of source_directory with this object's encoding settings'''
+        return FileIndex(source_directory, vocabulary=self.vocabulary,
+                         encoding=self.encoding, decode_errors=self.decode_errors,
+                         file_extension=self.file_extension, step_size=self.step_size,
+                         manifest_path=os.path.join(self.cache_folder(source_directory),
+                                                    MANIFEST))
+
+    def load_corpus(self, path):
+        '''Memory-map a corpus built by make_corpus.py as the object's data'''
+        corpus = MappedCorpus(path)
+        if corpus.vocabulary != self.vocabulary or corpus.pad_token != self.pad_token:
+            raise ValueError(
+                'Corpus %s was built with a different vocabulary or pad token' % path)
+        if corpus.sequence_length != self.sequence_length:
+            # Shorter padding would let windows cross from one file into the next
+            raise ValueError('Corpus %s was padded for sequences of %d characters, not %d'
+                             % (path, corpus.sequence_length, self.sequence_length))
+
+        self.source_directory = corpus.source_directory
+        self.file_list = [os.path.join(corpus.source_directory, f)
+                          for f in corpus.file_list]
+        self.n_files = corpus.n_files
+        self.file_offsets = corpus.offsets
+        self.source_indices = corpus.indices
+        self.source_length = corpus.source_length
+
+    def build_corpus(self, source_directory, path, processes=None):
+        '''Encode the .py files in source_directory to a binary corpus at path'''
+        file_index = self.file_index(source_directory).refresh(processes=processes)
+        return build_corpus(source_directory, file_index.file_list, path,
+                            vocabulary=self.vocabulary,
+                            sequence_length=self.sequence_length,
+                            pad_token=self.pad_token,
+                            encoding=self.encoding,
+                            decode_errors=self.decode_errors,
+                            processes=processes,
+                            fingerprint=file_index.fingerprint())
+
+    def validation_mask(self, fraction):
+        '''Boolean array that is True for the files held out for validation.
+           A file is held out when the hash of its path relative to the source
+           directory falls in the first fraction of the hash range, so the split
+           does not change when files are added to the corpus'''
+        mask = np.zeros(self.n_files, dtype=bool)
+        for i, file in enumerate(self.file_list):
+            path = os.path.relpath(file, self.source_directory).replace(os.sep, '/')
+            digest = hashlib.md5(path.encode('utf-8')).digest()
+            mask[i] = int.from_bytes(digest[:8], 'big') < fraction * 2 ** 64
+        return mask
+
+    def windows(self, file_mask, max_windows=None):
+        '''Gather every window whose target is in a file of file_mask into one
+           uint8 array of shape (n_windows, sequence_length + 1). With
+           max_windows, keep that many windows evenly spaced over the files'''
+        offsets = self.file_offsets[file_mask]
+        lengths = offsets[:, 1] - offsets[:, 0]
+        ends = np.cumsum(lengths)
+        n_windows = int(ends[-1]) if len(ends) else 0
+
+        # Only the kept windows are numbered, then mapped to their file
+        if max_windows is not None and n_windows > max_windows:
+            samples = np.linspace(0, n_windows - 1, max_windows).astype(np.int64)
+        else:
+            samples = np.arange(n_windows, dtype=np.int64)
+        files = np.searchsorted(ends, samples, side='right')
+        targets = offsets[files, 0] + samples - (ends - lengths)[files]
 
-    def fit(self, source_directory):
-        '''Set the object's data directory'''
-        self.file_list = self._generate_filelist(source_directory)
-        self.n_files = len(self.file_list)
-        self.source = self.concatenate_source_code_parallel(self.file_list)
-        self.source_length = len(self.source)
+        return self.source_indices[targets[:, np.newaxis] +
+                                   np.arange(-self.sequence_length, 1)]
 
     def transform(self, source_directory, outfile=None, p=1.0):
         '''Convert .py files in source directory to feature and target numpy arrays
@@ -130,22 +293,16 @@ class PyCodeVectors():
         pool = multiprocessing.Pool(multiprocessing.cpu_count())
         return ''.join(pool.map(self.read_source_code_parallel, file_list))
 
+    def encode(self, code_string):
+        '''Convert a string to a uint8 array of vocabulary indices'''
+        return encode(code_string, self.lookup_table, errors=self.decode_errors)
+
     def vectorize(self, code_string):
         '''Non parallel, encode all files as feature and target numpy arrays'''
-        source_length = len(code_string)
-        n_samples = source_length - self.sequence_length
-
-        X = np.zeros((n_samples, self.sequence_length,
-                      self.vocabulary_length), dtype=bool)
-        y = np.zeros((n_samples, self.vocabulary_length), dtype=bool)
+        windows = sliding_windows(self.encode(code_string),
+                                  self.sequence_length + 1)
 
-        for sample_idx in range(n_samples):
-            for char_idx in range(self.sequence_length):
-                X[sample_idx, char_idx,
-                    self.char_to_idx[code_string[sample_idx + char_idx]]] = True
-            y[sample_idx, self.char_to_idx[code_string[sample_idx + self.sequence_length]]] = True
-
-        return X, y
+        return windows_to_xy(windows, self.vocabulary_length)
 
     def _vectorize_code_parallel_helper(self, file):
         '''Helper for vectorize_code_parallel'''
@@ -161,34 +318,42 @@ class PyCodeVectors():
         return np.concatenate(Xs, axis=0), np.concatenate(ys, axis=0)
 
     def generate_dataset(self, code_string):
-        source_length = len(code_string)
-        n_samples = source_length - self.n_files * self.sequence_length
-
-        X = np.zeros((n_samples, self.sequence_length,
-                      self.vocabulary_length), dtype=bool)
-        y = np.zeros((n_samples, self.vocabulary_length), dtype=bool)
-
-        sample_idx = 0
-        source_idx = 0
-        # for sample_idx in range(0, n_samples, step_size):
-        while sample_idx < n_samples:  # and source_idx < source_length - seq_length:
-            # print(source_idx)
-            if code_string[source_idx + self.sequence_length] != self.pad_token:
-                for char_idx in range(self.sequence_length):
-                    X[sample_idx, char_idx,
-                        self.char_to_idx[code_string[source_idx + char_idx]]] = True
-                y[sample_idx, self.char_to_idx[code_string[source_idx +
-                                                           self.sequence_length]]] = True
-
-                sample_idx += 1
-                source_idx += self.step_size
-            else:
-                source_idx += self.step_size
-
-        return X, y
-
-    def data_generator(self, batch_size, batch_count=None, ignore=['\x0c']):
-        '''Batch generator for Keras fit_generator'''
+        '''Encode a concatenated source string as feature and target numpy arrays,
+           skipping the windows whose target is a padding character'''
+        windows = sliding_windows(self.encode(code_string),
+                                  self.sequence_length + 1, self.step_size)
+
+        if self.pad_token in self.char_to_idx:
+            windows = windows[windows[:, -1] != self.char_to_idx[self.pad_token]]
+
+        return windows_to_xy(windows, self.vocabulary_length)
+
+    def _ignore_mask(self, ignore):
+        '''Boolean array that is True at the index of every ignored character'''
+        mask = np.zeros(self.vocabulary_length, dtype=bool)
+        mask[[self.char_to_idx[c] for c in ignore if c in self.char_to_idx]] = True
+        return mask
+
+    def _next_windows(self, windows, char_idx, batch_size, ignore_mask):
+        '''Collect the next batch_size windows whose target is not ignored,
+           starting at window char_idx and wrapping around the end of the source.
+           Returns the windows and the index to continue from'''
+        blocks = []
+        n_samples = 0
+        while n_samples < batch_size:
+            block = windows[char_idx:char_idx + batch_size - n_samples]
+            char_idx = (char_idx + len(block)) % len(windows)
+
+            block = block[~ignore_mask[block[:, -1]]]
+            blocks.append(block)
+            n_samples += len(block)
+
+        return np.concatenate(blocks), char_idx
+
+    def data_generator(self, batch_size, batch_count=None, ignore=['\x0c'], sparse=False):
+        '''Batch generator for Keras fit_generator. With sparse, yields uint8 index
+           arrays X of shape (batch_size, sequence_length) and y of shape
+           (batch_size, 1) instead of one-hot arrays'''
         if batch_count is None:
             batch_count = (self.source_length -
                            self.sequence_length) // batch_size
@@ -196,27 +361,90 @@ class PyCodeVectors():
         print('Generating Data with Batch Size:',
               batch_size, 'Batch Count:', batch_count)
 
+        windows = sliding_windows(self.source_indices, self.sequence_length + 1)
+        ignore_mask = self._ignore_mask(ignore)
+        if ignore_mask[windows[:, -1]].all():
+            # _next_windows would search for an eligible window forever
+            raise ValueError('Every target of the source is one of the ignored characters %r'
+                             % (ignore,))
+
         while True:
             char_idx = 0
             for batch_idx in range(batch_count):
-                X = np.zeros((batch_size, self.sequence_length,
-                              self.vocabulary_length), dtype=bool)
-                y = np.zeros((batch_size, self.vocabulary_length))
-
-                sample_idx = 0
-                while sample_idx < batch_size:
-
-                    if self.source[char_idx + self.sequence_length] not in ignore:
-                        for seq_pos in range(self.sequence_length):
-                            X[sample_idx, seq_pos,
-                                self.char_to_idx[self.source[char_idx + seq_pos]]] = True
-                        y[sample_idx, self.char_to_idx[self.source[char_idx +
-                                                                   self.sequence_length]]] = True
-                        sample_idx += 1
-
-                    if char_idx == self.source_length - self.sequence_length - 1:
-                        char_idx = 0
-                    else:
-                        char_idx += 1
-
-                yield X, y
+                batch, char_idx = self._next_windows(windows, char_idx,
+                                                     batch_size, ignore_mask)
+
+                if sparse:
+                    yield batch[:, :-1], batch[:, -1:]
+                else:
+                    yield windows_to_xy(batch, self.vocabulary_length)
+
+    def tbptt_schedule(self, batch_size):
+        '''Plan contiguous, non-overlapping chunks for stateful truncated BPTT.
+           Every non-empty file is assigned to one of batch_size lanes, longest
+           files first to the least loaded lane, and cut into sequence_length
+           chunks. Row r of
+           every batch continues lane r where the previous batch left off.
+
+           Returns three arrays of shape (steps_per_epoch, batch_size):
+               starts -- position in source_indices of each chunk's first input
+               lengths -- number of real targets in each chunk, 0 for lane padding
+               resets -- True where a chunk starts a new file and the lane's
+                         state must be reset
+        '''
+        file_lengths = self.file_offsets[:, 1] - self.file_offsets[:, 0]
+        n_chunks = -(-file_lengths // self.sequence_length)
+
+        lanes = [[] for _ in range(batch_size)]
+        loads = [(0, lane) for lane in range(batch_size)]
+        for file_idx in np.argsort(-n_chunks, kind='stable'):
+            if n_chunks[file_idx] == 0:
+                # Empty files, such as most __init__.py, have no targets
+                break
+            load, lane = heapq.heappop(loads)
+            lanes[lane].append(file_idx)
+            heapq.heappush(loads, (load + n_chunks[file_idx], lane))
+
+        steps = max(load for load, _ in loads)
+        starts = np.zeros((steps, batch_size), dtype=np.int64)
+        lengths = np.zeros((steps, batch_size), dtype=np.int32)
+        resets = np.zeros((steps, batch_size), dtype=bool)
+
+        for lane, file_indices in enumerate(lanes):
+            step = 0
+            for file_idx in file_indices:
+                # The pad token before the file is the first input, so the
+                # first character of the file is also a target
+                first = self.file_offsets[file_idx, 0] - 1
+                chunk_starts = first + np.arange(n_chunks[file_idx]) * self.sequence_length
+                chunk_ends = np.minimum(chunk_starts + self.sequence_length,
+                                        first + file_lengths[file_idx])
+
+                starts[step:step + len(chunk_starts), lane] = chunk_starts
+                lengths[step:step + len(chunk_starts), lane] = chunk_ends - chunk_starts
+                resets[step, lane] = True
+                step += len(chunk_starts)
+
+        return starts, lengths, resets
+
+    def tbptt_generator(self, schedule, sparse=False):
+        '''Batch generator for stateful truncated BPTT over a tbptt_schedule.
+           Yields X of shape (batch_size, sequence_length), y with the next
+           character of every position, and temporal sample weights that are 0
+           past the end of a file'''
+        starts, lengths, resets = schedule
+        positions = np.arange(self.sequence_length + 1)
+
+        while True:
+            for step in range(len(starts)):
+                window_positions = np.minimum(starts[step][:, np.newaxis] + positions,
+                                              self.source_length - 1)
+                windows = self.source_indices[window_positions]
+                weights = (positions[np.newaxis, :-1] <
+                           lengths[step][:, np.newaxis]).astype(np.float32)
+
+                if sparse:
+                    yield windows[:, :-1], windows[:, 1:, np.newaxis], weights
+                else:
+                    yield (one_hot(windows[:, :-1], self.vocabulary_length),
+                           one_hot(windows[:, 1:], self.vocabulary_length), weights)
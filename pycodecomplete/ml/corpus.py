@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''corpus.py
+
+Binary corpus format for the training data. A corpus is built once from a
+folder of .py files and is made of three files that share a base path:
+
+    <path>.bin          flat uint8 stream of vocabulary indices, every file
+                        preceded by sequence_length padding tokens
+    <path>.offsets.npy  int64 array of shape (n_files, 2) with the start and
+                        end of each file's content in the stream
+    <path>.json         vocabulary, sequence_length, pad_token, file list and
+                        the fingerprint of the FileIndex it was built from
+
+MappedCorpus opens the stream with np.memmap, so windows are sliced from the
+page cache without reading the corpus into RAM.
+
+Todo:
+    *
+'''
+import io
+import json
+import multiprocessing
+import os
+import string
+from functools import partial
+
+import numpy as np
+
+try:
+    from .char_encoding import encode, lookup_table
+except ImportError:
+    from char_encoding import encode, lookup_table
+
+
+def corpus_paths(path):
+    '''Return the stream, offsets and metadata file paths of a corpus'''
+    if path.endswith('.bin'):
+        path = path[:-len('.bin')]
+    return path + '.bin', path + '.offsets.npy', path + '.json'
+
+
+def is_corpus(path):
+    '''True if path is the base path or .bin file of a built corpus'''
+    return all(os.path.isfile(p) for p in corpus_paths(path))
+
+
+def encode_file(file, table, pad_indices, encoding='ascii', decode_errors='ignore'):
+    '''Read a file and return its vocabulary indices preceded by pad_indices'''
+    with io.open(file, 'r', encoding=encoding, errors=decode_errors) as infile:
+        indices = encode(infile.read(), table, errors=decode_errors)
+    return np.concatenate([pad_indices, indices])
+
+
+def encode_files_parallel(file_list, table, pad_indices, encoding='ascii',
+                          decode_errors='ignore', processes=None):
+    '''Encode files with multiple processors, yielding the index arrays in order'''
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        for indices in pool.imap(partial(encode_file, table=table,
+                                         pad_indices=pad_indices,
+                                         encoding=encoding,
+                                         decode_errors=decode_errors),
+                                 file_list, chunksize=64):
+            yield indices
+    finally:
+        pool.close()
+        pool.join()
+
+
+def build_corpus(source_directory, file_list, path,
+                 vocabulary=string.printable,
+                 sequence_length=100,
+                 pad_token='\x0c',
+                 encoding='ascii',
+                 decode_errors='ignore',
+                 processes=None,
+                 fingerprint=None):
+    '''Write the files in file_list to a binary corpus at path
+
+    Args:
+        source_directory (str): Folder the file paths are stored relative to
+        file_list (list): Paths of the files to include
+        path (str): Base path of the corpus files
+        vocabulary (str): Characters to encode (default string.printable)
+        sequence_length (int): Padding tokens written before each file (default 100)
+        pad_token (str): Padding character (default \\x0c)
+        encoding (str): Text file encoding (default ascii)
+        decode_errors (str): Decoding error handling (default ignore)
+        processes (int): Number of encoding processes (default cpu count)
+        fingerprint (str): FileIndex.fingerprint of the files, stored to tell
+            whether the corpus is still up to date (default None)
+
+    Returns:
+        offsets: int64 array of the start and end of each file's content
+    '''
+    bin_path, offsets_path, meta_path = corpus_paths(path)
+    table = lookup_table(vocabulary)
+    pad_indices = encode(pad_token * sequence_length, table, errors='strict')
+
+    offsets = np.zeros((len(file_list), 2), dtype=np.int64)
+    position = 0
+    with io.open(bin_path, 'wb') as outfile:
+        for i, indices in enumerate(encode_files_parallel(
+                file_list, table, pad_indices, encoding=encoding,
+                decode_errors=decode_errors, processes=processes)):
+            outfile.write(indices.tobytes())
+            offsets[i] = position + len(pad_indices), position + len(indices)
+            position += len(indices)
+
+    np.save(offsets_path, offsets)
+
+    with io.open(meta_path, 'w') as outfile:
+        json.dump({'vocabulary': vocabulary,
+                   'sequence_length': sequence_length,
+                   'pad_token': pad_token,
+                   'source_directory': os.path.abspath(source_directory),
+                   'file_list': [os.path.relpath(f, source_directory)
+                                 for f in file_list],
+                   'fingerprint': fingerprint},
+                  outfile)
+
+    return offsets
+
+
+class MappedCorpus():
+    '''MappedCorpus object that memory-maps a corpus written by build_corpus
+
+    Parameters:
+        path -- base path or .bin file of the corpus
+
+    Attributes:
+        indices -- read-only np.memmap of the uint8 index stream
+        offsets -- int64 array of the start and end of each file's content
+        vocabulary -- characters the indices refer to
+        sequence_length -- number of padding tokens before each file
+        pad_token -- padding character
+        source_directory -- folder the files were read from
+        file_list -- file paths relative to source_directory
+        n_files -- number of files in the corpus
+        source_length -- total number of indices in the stream
+        fingerprint -- FileIndex.fingerprint of the files the corpus was built from, or None
+    '''
+
+    def __init__(self, path):
+        '''Create a MappedCorpus object'''
+        bin_path, offsets_path, meta_path = corpus_paths(path)
+
+        with io.open(meta_path, 'r') as infile:
+            meta = json.load(infile)
+
+        self.vocabulary = meta['vocabulary']
+        self.sequence_length = meta['sequence_length']
+        self.pad_token = meta['pad_token']
+        self.source_directory = meta['source_directory']
+        self.file_list = meta['file_list']
+        self.n_files = len(self.file_list)
+        self.fingerprint = meta.get('fingerprint')
+
+        self.offsets = np.load(offsets_path)
+        self.indices = np.memmap(bin_path, dtype=np.uint8, mode='r')
+        self.source_length = len(self.indices)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''export_model.py
+
+This module exports a trained RNN model to a weight archive that the webapp
+can serve with the NumPy inference engine, without Keras or TensorFlow.
+After exporting, the NumPy engine is checked against the Keras model on
+random windows and on incremental steps after them.
+
+Example:
+
+    To export a model and check that both engines agree to within 1e-4 run:
+
+     $ python export_model.py /path/to/pickled/model /path/to/archive
+
+    The tolerance can be set with -t. Then serve the archive with:
+
+     $ ./pycc.sh /path/to/archive 25
+
+Attributes:
+    None
+
+Todo:
+    *
+'''
+import os
+import sys
+from argparse import ArgumentParser
+
+from keras.models import load_model
+
+from code_generation import StatefulDecoder
+from numpy_lstm import NumpyLSTM, export_model, parity
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete model exporter')
+    parser.add_argument('model_file', action='store',
+                        help='Trained RNN model file')
+    parser.add_argument('archive', action='store',
+                        help='Destination folder of the weight archive')
+    parser.add_argument('-t', type=float, default=1e-4, action='store', dest='tolerance',
+                        help='Largest probability difference accepted by the parity check')
+
+    settings = parser.parse_args()
+
+    if not os.path.isfile(settings.model_file):
+        arg_error(parser, 'error: Model file not found')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(settings.archive))):
+        arg_error(parser, 'error: Invalid archive folder')
+
+    print('Loading Model...')
+    model = load_model(settings.model_file)
+
+    print('Exporting Model...')
+    export_model(model, settings.archive)
+
+    engine = NumpyLSTM(settings.archive)
+    difference = parity(model, engine,
+                        reference_decoder=StatefulDecoder(model, batch_size=8),
+                        sequence_length=model.input_shape[1] or 100)
+    print('Largest difference from Keras: %.2e' % difference)
+
+    if difference > settings.tolerance:
+        print('%s: error: The NumPy engine does not match the model' %
+              os.path.basename(__file__))
+        sys.exit(1)
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
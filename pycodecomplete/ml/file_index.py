@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''file_index.py
+
+Persistent index of the .py files in a source folder. For every file the
+index keeps its size, modification time, content hash, encoded length and
+number of training windows in a manifest in the folder, so the vectorizers
+and trainers get the file list and corpus size without walking the tree
+twice or reading every file. A refresh lists the folders in parallel
+threads with os.scandir and only reads the files whose size or
+modification time changed since the manifest was written.
+
+Todo:
+    *
+'''
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import string
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+import numpy as np
+
+try:
+    from .char_encoding import encode, lookup_table
+except ImportError:
+    from char_encoding import encode, lookup_table
+
+MANIFEST = '.file_index.json'
+
+
+def _scan_folder(folder, file_extension):
+    '''List the files with file_extension and the subfolders of one folder'''
+    files = []
+    folders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.name.endswith(file_extension) and entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    return files, folders
+
+
+def scan_directory(directory, file_extension='.py', n_workers=8):
+    '''Return (path, size, mtime_ns) of every file with file_extension below
+    directory, listing the folders in n_workers threads. Hidden files and
+    folders are skipped'''
+    found = []
+    with ThreadPoolExecutor(n_workers) as executor:
+        pending = {executor.submit(_scan_folder, directory, file_extension)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                found.extend(files)
+                pending.update(executor.submit(_scan_folder, folder, file_extension)
+                               for folder in folders)
+    return found
+
+
+def index_file(path, table, encoding='ascii', decode_errors='ignore'):
+    '''Return the sha1 hex digest of a file and the number of characters it
+    encodes to. The file is decoded with universal newlines, as the corpus
+    reads it, so \r\n counts as one character'''
+    with io.open(path, 'rb') as infile:
+        content = infile.read()
+    text = io.TextIOWrapper(io.BytesIO(content), encoding=encoding, errors=decode_errors,
+                            newline=None).read()
+    return hashlib.sha1(content).hexdigest(), len(encode(text, table, errors=decode_errors))
+
+
+class FileIndex():
+    '''FileIndex object that keeps a persistent manifest of a source folder
+
+    Parameters:
+        source_directory -- folder of the Python code data
+        vocabulary -- characters the encoded lengths count (default string.printable)
+        encoding -- text file encoding (default ascii)
+        decode_errors -- decoding error handling (default ignore)
+        file_extension -- the file extension of the files to index (default .py)
+        step_size -- number of characters between windows (default 1)
+        manifest_path -- manifest location (default .file_index.json in source_directory)
+
+    Attributes:
+        refresh -- rescan the folder, read new or changed files and save the manifest
+        save -- write the manifest
+        fingerprint -- hash of the indexed files that changes when their encoding would
+        records -- dictionary of relative path to size, mtime_ns, sha1,
+                   encoded_length and n_windows
+        files -- sorted paths of the indexed files, relative to source_directory
+        file_list -- paths of the indexed files, in the order of files
+        n_files -- number of indexed files
+        encoded_lengths -- int64 array of the encoded length of each file
+        n_windows -- number of training windows in all the files
+        source_length -- total number of encoded characters in all the files
+    '''
+
+    def __init__(self, source_directory, vocabulary=string.printable,
+                 encoding='ascii', decode_errors='ignore', file_extension='.py',
+                 step_size=1, manifest_path=None):
+        '''Create a FileIndex object and load its manifest, if there is one'''
+        self.source_directory = source_directory
+        self.vocabulary = vocabulary
+        self.encoding = encoding
+        self.decode_errors = decode_errors
+        self.file_extension = file_extension
+        self.step_size = step_size
+        self.manifest_path = manifest_path or os.path.join(source_directory, MANIFEST)
+        # newline marks the manifests whose lengths count \r\n as one character
+        self.settings = {'vocabulary': vocabulary,
+                         'encoding': encoding,
+                         'decode_errors': decode_errors,
+                         'newline': 'universal'}
+
+        self.records = {}
+        self.files = None
+        self.file_list = None
+        self.n_files = None
+        self.encoded_lengths = None
+        self.n_windows = None
+        self.source_length = None
+
+        if os.path.isfile(self.manifest_path):
+            with io.open(self.manifest_path, 'r') as infile:
+                manifest = json.load(infile)
+            if manifest['settings'] == self.settings:
+                self.records = manifest['files']
+
+    def refresh(self, processes=None, n_workers=8):
+        '''Rescan the source folder, read the files that are new or whose size
+        or modification time changed, drop the removed ones and save the
+        manifest. Returns the object'''
+        records = {}
+        changed = []
+        for path, size, mtime_ns in scan_directory(self.source_directory,
+                                                   self.file_extension, n_workers):
+            relative = os.path.relpath(path, self.source_directory)
+            record = self.records.get(relative)
+            if record is not None and record['size'] == size and record['mtime_ns'] == mtime_ns:
+                records[relative] = record
+            else:
+                records[relative] = {'size': size, 'mtime_ns': mtime_ns}
+                changed.append(relative)
+
+        if changed:
+            print('Indexing', len(changed), 'new or changed files')
+            pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+            try:
+                results = pool.imap(partial(index_file,
+                                            table=lookup_table(self.vocabulary),
+                                            encoding=self.encoding,
+                                            decode_errors=self.decode_errors),
+                                    [os.path.join(self.source_directory, relative)
+                                     for relative in changed],
+                                    chunksize=64)
+                for relative, (sha1, encoded_length) in zip(changed, results):
+                    records[relative].update(sha1=sha1, encoded_length=encoded_length)
+            finally:
+                pool.close()
+                pool.join()
+
+        for record in records.values():
+            record['n_windows'] = -(-record['encoded_length'] // self.step_size)
+
+        unchanged = len(records) - len(changed)
+        removed = unchanged != len(self.records)
+        self.records = records
+        if changed or removed:
+            self.save()
+
+        self.files = sorted(self.records)
+        self.file_list = [os.path.join(self.source_directory, relative)
+                          for relative in self.files]
+        self.n_files = len(self.files)
+        self.encoded_lengths = np.array([self.records[relative]['encoded_length']
+                                         for relative in self.files], dtype=np.int64)
+        self.n_windows = sum(record['n_windows'] for record in self.records.values())
+        self.source_length = int(self.encoded_lengths.sum())
+        return self
+
+    def fingerprint(self):
+        '''Return the sha1 hex digest of the settings and of the path, content
+        hash and encoded length of every indexed file, as of the last refresh'''
+        digest = hashlib.sha1(json.dumps(self.settings, sort_keys=True).encode('utf-8'))
+        for relative in self.files:
+            record = self.records[relative]
+            digest.update(('%s\0%s\0%d\n' % (relative, record['sha1'], record['encoded_length']))
+                          .encode('utf-8', errors='surrogateescape'))
+        return digest.hexdigest()
+
+    def save(self):
+        '''Write the manifest, replacing the previous one atomically'''
+        temporary_path = self.manifest_path + '.tmp'
+        with io.open(temporary_path, 'w') as outfile:
+            json.dump({'settings': self.settings, 'files': self.records}, outfile)
+        os.replace(temporary_path, self.manifest_path)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''make_corpus.py
+
+This module encodes every .py file in a folder into a binary corpus that
+make_model.py can train on. The corpus is memory-mapped during training, so
+startup time and memory use do not grow with the number of cloned repos.
+
+Example:
+
+    To build a corpus for 100 character long sequences run the command:
+
+     $ python make_corpus.py /path/to/cloned/repos /path/to/corpus 100
+
+    This writes /path/to/corpus.bin, /path/to/corpus.offsets.npy and
+    /path/to/corpus.json. Then train on it with:
+
+     $ python make_model.py /path/to/save/pickled/models /path/to/corpus 100 512 1 4 512 20 1
+
+Attributes:
+    None
+
+Todo:
+    *
+'''
+import os
+import sys
+from argparse import ArgumentParser
+
+from codetovec import PyCodeVectors
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete corpus builder')
+    parser.add_argument('source', action='store',
+                        help='Source folder of .py files')
+    parser.add_argument('destination', action='store',
+                        help='Base path of the corpus files')
+    parser.add_argument('sequence_length', type=int, action='store',
+                        help='Sequence length the model will be trained with')
+    parser.add_argument('-p', type=int, action='store', dest='processes',
+                        help='Number of encoding processes (default cpu count)')
+
+    settings = parser.parse_args()
+
+    if not os.path.isdir(settings.source):
+        arg_error(parser, 'error: Invalid source folder')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(settings.destination))):
+        arg_error(parser, 'error: Invalid destination folder')
+
+    pycodevectors = PyCodeVectors(sequence_length=settings.sequence_length)
+    offsets = pycodevectors.build_corpus(settings.source, settings.destination,
+                                         processes=settings.processes)
+
+    print('Encoded %d files, %d characters' %
+          (len(offsets), offsets[-1, 1] if len(offsets) else 0))
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
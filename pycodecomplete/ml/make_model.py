@@ -15,7 +15,8 @@ Example:
 
     The arguments are:
         1. Path to save serialized RNN models. A trained model is saves after the completion of each epoch.
-        2. Path to the cloned GitHub repositories from which to train the model on
+        2. Path to the cloned GitHub repositories from which to train the model on,
+           or to a corpus built with make_corpus.py
         3. Sequence length (100 character long sequence)
         4. Number of layers (4 layers of LSTM nodes)
         5. Number of nodes per layer (512 nodes per layer)
@@ -32,6 +33,36 @@ Example:
 
     for a computer with 4 GPUs
 
+    Training batches can be prepared by several worker processes, each epoch in
+    a shuffled order that depends only on the seed:
+
+     $ -w 4 --multiprocessing --seed 0
+
+    About 5% of the files, chosen by a hash of their path so the split is stable
+    as the corpus grows, are held out for validation. Their windows are
+    gathered once and the validation loss is part of every saved model name:
+
+     $ --validation-split 0.05 --validation-windows 100000
+
+    To train on uint8 character indices through an Embedding layer instead of
+    one-hot vectors, add the --sparse flag, optionally with the embedding size:
+
+     $ --sparse -e 32
+
+    To train stateful LSTMs with truncated backpropagation through time on
+    contiguous, non-overlapping chunks of each file, add the --stateful flag.
+    Every timestep is supervised, and an epoch is one pass over the corpus:
+
+     $ --stateful
+
+    At the end of each epoch the samples per second and the share of the time
+    spent waiting for the data loader are printed, with whether the epoch was
+    bound by the data loader or by the train steps. To also log them per batch
+    and per epoch, with the batches prepared ahead and the memory in use, to a
+    .csv or .jsonl file:
+
+     $ --training-log /path/to/training.csv
+
 Attributes:
     None
 
@@ -46,6 +77,7 @@ from keras.models import load_model
 
 from rnn import pyCodeRNNBuilder
 from process_text import CharVectorizer
+from corpus import is_corpus
 
 
 def main():
@@ -53,7 +85,7 @@ def main():
     parser.add_argument('destination', action='store',
                         help='Destination folder for the trained RNN model')
     parser.add_argument('source', action='store',
-                        help='Source folder of .py files that will be used to train the model')
+                        help='Source folder of .py files, or corpus built by make_corpus.py, that will be used to train the model')
     parser.add_argument('sequence_length', type=int, action='store',
                         help='')
     parser.add_argument('batch_size', type=int, action='store',
@@ -78,8 +110,27 @@ def main():
                         help='Number of Workers')                                                       
     parser.add_argument('-m', action='store', dest='initial_model',
                         help='Continue training an existing model')
+    parser.add_argument('-e', type=int, action='store', dest='embedding_dim',
+                        help='Embedding size for --sparse (default vocabulary size)')
     parser.add_argument('--multiprocessing', action='store_true',
-                        help='Enable Multiprocessing')                                           
+                        help='Enable Multiprocessing')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Feed character indices through an Embedding layer')
+    parser.add_argument('--seed', type=int, default=0, action='store',
+                        help='Seed of the per-epoch shuffling of the training windows')
+    parser.add_argument('--validation-split', type=float, default=0.05, action='store',
+                        dest='validation_split',
+                        help='Fraction of files held out for validation, chosen by path hash, 0 to not validate')
+    parser.add_argument('--validation-windows', type=int, default=100000, action='store',
+                        dest='validation_windows',
+                        help='Most held-out windows validated on each epoch')
+    parser.add_argument('--stateful', action='store_true',
+                        help='Train stateful LSTMs with truncated BPTT')                                           
+    parser.add_argument('--training-log', action='store', dest='training_log',
+                        help='.csv or .jsonl file to log training throughput and data loader stalls to')
+    parser.add_argument('--cache-dir', action='store', dest='cache_directory',
+                        help='Folder for the file index and encoded corpus of a source folder '
+                             '(default the source folder, or ~/.cache/pycodecomplete if read-only)')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1')
 
     settings = parser.parse_args()
@@ -87,8 +138,11 @@ def main():
     if not os.path.isdir(settings.destination):
         arg_error(parser, 'error: Invalid destination folder')
     
-    if not os.path.isdir(settings.source):
-        arg_error(parser, 'error: Invalid source folder')
+    if not (os.path.isdir(settings.source) or is_corpus(settings.source)):
+        arg_error(parser, 'error: Invalid source folder or corpus')
+
+    if settings.training_log and not settings.training_log.endswith(('.csv', '.jsonl')):
+        arg_error(parser, 'error: Training log must be a .csv or .jsonl file')
 
     if settings.initial_model:
         if os.path.isfile(settings.initial_model):
@@ -107,15 +161,24 @@ def main():
                                      hidden_layer_dim=settings.nodes_per_layer,
                                      step_size=settings.step_size,
                                      n_gpu=settings.n_gpu,
-                                     model=pretrained_model)
+                                     model=pretrained_model,
+                                     sparse=settings.sparse,
+                                     embedding_dim=settings.embedding_dim,
+                                     stateful=settings.stateful,
+                                     batch_size=settings.batch_size,
+                                     cache_directory=settings.cache_directory)
 
     model_builder.fit(steps_per_epoch=settings.steps_per_epoch,
                       batch_size=settings.batch_size,
                       epochs=settings.epochs,
                       shuffle_source_files=True,
                       max_queue_size=settings.max_queue_size,
-                      workers=settings.n_workers)
-                      #multiprocessing=settings.multiprocessing)
+                      workers=settings.n_workers,
+                      multiprocessing=settings.multiprocessing,
+                      seed=settings.seed,
+                      validation_split=settings.validation_split,
+                      max_validation_windows=settings.validation_windows,
+                      training_log=settings.training_log)
                       #initial_epoch=settings.initial_epoch)
 
     
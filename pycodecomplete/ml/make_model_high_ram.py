@@ -1,43 +1,156 @@
+# -*- coding: utf-8 -*-
+'''make_model_high_ram.py
+
+This module trains a RNN model on every window of a folder of .py files.
+The windows are written once, in chunks of bounded size, to an on-disk
+array of uint8 token indices that is memory-mapped during training, so the
+"high RAM" path runs on machines with ordinary memory. Batches are one-hot
+encoded as they are fed to the model, which makes large batches affordable.
+
+Example:
+
+    To train 4 layers of 1001 LSTM nodes on 8 GPUs, in batches of 5000, for
+    100 epochs on 100 character windows taken every 10 characters, run:
+
+     $ python make_model_high_ram.py /path/to/save/pickled/models /path/to/cloned/repos /path/to/windows 100 5000 10 4 1001 100 -g 8
+
+    This writes /path/to/windows.bin and /path/to/windows.json. Rerunning with
+    the same windows path reuses them instead of encoding the repos again.
+    The encoder copies at most -r megabytes of windows at a time:
+
+     $ -r 256
+
+    Only the windows are read during training; the repos are not encoded
+    again to build the model. Every epoch the windows are served in a new
+    order that depends only on --seed, so a batch is not a run of
+    neighbouring windows of one file.
+
+Attributes:
+    None
+
+Todo:
+    *
+'''
 import os
 import sys
 from argparse import ArgumentParser
 import string
 
+from keras.callbacks import ModelCheckpoint
 from keras.models import load_model
-from keras.models import Sequential
-from keras.utils import multi_gpu_model
 
 from rnn import pyCodeRNNBuilder
 from process_text import CharVectorizer
+from window_sequence import CachedWindowSequence
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete out-of-core model generator')
+    parser.add_argument('destination', action='store',
+                        help='Destination folder for the trained RNN model')
+    parser.add_argument('source', action='store',
+                        help='Source folder of .py files')
+    parser.add_argument('windows', action='store',
+                        help='Base path of the on-disk window array')
+    parser.add_argument('sequence_length', type=int, action='store',
+                        help='Sequence length')
+    parser.add_argument('batch_size', type=int, action='store',
+                        help='Set batch size')
+    parser.add_argument('step_size', type=int, action='store',
+                        help='Number of characters between windows')
+    parser.add_argument('layers', type=int, action='store',
+                        help='Number of LSTM layers')
+    parser.add_argument('nodes_per_layer', type=int, action='store',
+                        help='Number of LSTM nodes per layer')
+    parser.add_argument('epochs', type=int, action='store',
+                        help='Number of Epochs to train the model')
+    parser.add_argument('-g', type=int, action='store', dest='n_gpu',
+                        help='Number of GPUs')
+    parser.add_argument('-m', action='store', dest='initial_model',
+                        help='Continue training an existing model')
+    parser.add_argument('-r', type=int, action='store', dest='max_memory', default=256,
+                        help='Megabytes of windows encoded at a time (default 256)')
+    parser.add_argument('-q', type=int, action='store', dest='max_queue_size', default=4,
+                        help='Max queue size')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Feed character indices through an Embedding layer')
+    parser.add_argument('--seed', type=int, default=0, action='store',
+                        help='Seed of the per-epoch shuffling of the windows')
+
+    settings = parser.parse_args()
+
+    if not os.path.isdir(settings.destination):
+        arg_error(parser, 'error: Invalid destination folder')
+
+    if not os.path.isdir(settings.source):
+        arg_error(parser, 'error: Invalid source folder')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(settings.windows))):
+        arg_error(parser, 'error: Invalid windows folder')
+
+    if settings.initial_model:
+        if os.path.isfile(settings.initial_model):
+            print('Loading Model...')
+            pretrained_model = load_model(settings.initial_model)
+        else:
+            arg_error(parser, 'error: Initial model file not found')
+    else:
+        pretrained_model = None
+
+    char_vectorizer = CharVectorizer(tokens=string.printable,
+                                     sequence_length=settings.sequence_length,
+                                     input='directorypath', encoding='utf-8',
+                                     step_size=settings.step_size)
 
-pycode_directory = '/home/ubuntu/repos'
+    if os.path.isfile(settings.windows + '.json'):
+        print('Loading Windows...')
+        windows = char_vectorizer.load_windows(settings.windows)
+    else:
+        print('Encoding Windows...')
+        windows = char_vectorizer.transform_to_disk(
+            settings.source, settings.windows,
+            max_memory=settings.max_memory * 2 ** 20)
 
+    print(windows.shape)
 
-char_vectorizer = CharVectorizer(tokens=string.printable,
-                                 sequence_length=100,
-                                 input='directorypath', encoding='utf-8',
-                                 step_size=10)
+    model_builder = pyCodeRNNBuilder(settings.sequence_length,
+                                     settings.destination,
+                                     settings.source,
+                                     n_layers=settings.layers,
+                                     hidden_layer_dim=settings.nodes_per_layer,
+                                     step_size=settings.step_size,
+                                     n_gpu=settings.n_gpu,
+                                     model=pretrained_model,
+                                     sparse=settings.sparse,
+                                     fit_data=False)
 
-char_vectorizer.fit(pycode_directory)
+    # There is no validation set, so the model names only carry the loss
+    checkpoint = ModelCheckpoint(
+        os.path.join(settings.destination,
+                     '%dx%d_%d-nlayers_%d-hiddenlayerdim_epoch{epoch:03d}-loss{loss:.4f}' %
+                     (settings.sequence_length, len(string.printable),
+                      settings.layers, settings.nodes_per_layer)),
+        save_weights_only=False)
 
-X, y = char_vectorizer.transform(pycode_directory)
+    sequence = CachedWindowSequence(windows, settings.batch_size,
+                                    len(string.printable), sparse=settings.sparse,
+                                    shuffle=True, seed=settings.seed)
 
-print(X.shape, y.shape)
+    model_builder.model.fit_generator(generator=sequence,
+                                      steps_per_epoch=len(sequence),
+                                      epochs=settings.epochs,
+                                      max_queue_size=settings.max_queue_size,
+                                      # The sequence orders the windows itself
+                                      shuffle=False,
+                                      verbose=1,
+                                      callbacks=[checkpoint])
 
-model_builder = pyCodeRNNBuilder(100,
-                                 '/home/ubuntu/models',
-                                 '/home/ubuntu/repos',
-                                 n_layers=4,
-                                 hidden_layer_dim=1001,
-                                 step_size=1,
-                                 n_gpu=8,
-                                 model=None)
 
-model = model_builder.model
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
 
-print('Using', 8, 'GPUs')
-parallel_model = multi_gpu_model(model, gpus=8)
-parallel_model.compile(loss='categorical_crossentropy', optimizer="adam")
 
-parallel_model.fit(X, y, batch_size=5000, epochs=100)
-                            
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+'''numpy_lstm.py
+
+NumPy inference engine for the character models built by pyCodeRNNBuilder.
+export_model writes the weights of a trained Keras model to a plain archive,
+a folder of .npy files and a config.json, and NumpyLSTM runs the same LSTM
+stack and Dense softmax from that archive without Keras or TensorFlow.
+
+The four gates of every LSTM are computed with one matmul, the input
+projection of a whole window is done before the recurrent loop, and the
+first layer's projection of every character (through the Embedding when
+there is one) is precomputed as a lookup table. A NumpyDecoder keeps its
+states and work buffers between calls, so it can stand in for the Keras
+StatefulDecoder in CodeGenerator. Archives quantized by quantize_model.py
+hold their kernels as QuantizedMatrix objects, which are multiplied the same
+way.
+
+Todo:
+    *
+'''
+import io
+import json
+import os
+
+import numpy as np
+
+try:
+    from .char_encoding import one_hot
+    from .quantization import QuantizedMatrix
+except ImportError:
+    from char_encoding import one_hot
+    from quantization import QuantizedMatrix
+
+FORMAT_VERSION = 1
+CONFIG = 'config.json'
+
+
+def _tanh(x):
+    np.tanh(x, out=x)
+
+
+def _sigmoid(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    np.reciprocal(x, out=x)
+
+
+def _hard_sigmoid(x):
+    x *= 0.2
+    x += 0.5
+    np.clip(x, 0, 1, out=x)
+
+
+def _relu(x):
+    np.maximum(x, 0, out=x)
+
+
+def _linear(x):
+    pass
+
+
+def _softmax(x):
+    x -= x.max(axis=-1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {'tanh': _tanh,
+               'sigmoid': _sigmoid,
+               'hard_sigmoid': _hard_sigmoid,
+               'relu': _relu,
+               'linear': _linear,
+               'softmax': _softmax}
+
+
+def _dot(x, weight, out):
+    '''Write x @ weight to out, for float32 arrays and QuantizedMatrix weights.
+    x is flattened to 2-D first, since np.dot only uses BLAS for matrices'''
+    if isinstance(weight, QuantizedMatrix):
+        return weight.dot(x, out)
+    np.dot(x.reshape(-1, x.shape[-1]), weight, out=out.reshape(-1, out.shape[-1]))
+    return out
+
+
+def _load_weight(path, entry, mmap_mode):
+    '''Load an archive weight: an .npy file name, or the values and scale
+    file names of a quantized matrix'''
+    if not isinstance(entry, dict):
+        return np.load(os.path.join(path, entry), mmap_mode=mmap_mode)
+
+    scale = entry.get('scale')
+    return QuantizedMatrix(np.load(os.path.join(path, entry['values']), mmap_mode=mmap_mode),
+                           None if scale is None else np.load(os.path.join(path, scale)))
+
+
+def _sequential_layers(model):
+    '''Layers of the Sequential model inside a multi_gpu_model, or of model'''
+    for layer in model.layers:
+        if hasattr(layer, 'layers'):
+            return layer.layers
+    return model.layers
+
+
+def export_model(model, path):
+    '''Write the weights of a trained pyCodeRNNBuilder model to an archive folder
+    of .npy files and a config.json that NumpyLSTM loads
+
+    Raises:
+        ValueError: the model has a layer the engine does not implement
+    '''
+    os.makedirs(path, exist_ok=True)
+
+    layers = []
+    for i, layer in enumerate(_sequential_layers(model)):
+        class_name = layer.__class__.__name__
+        config = layer.get_config()
+        if class_name == 'Embedding':
+            settings = {}
+        elif class_name == 'LSTM':
+            if not config.get('use_bias', True):
+                raise ValueError('LSTM layers without a bias are not supported')
+            settings = {'units': config['units'],
+                        'activation': config['activation'],
+                        'recurrent_activation': config['recurrent_activation']}
+        elif class_name == 'Dense':
+            if not config.get('use_bias', True):
+                raise ValueError('Dense layers without a bias are not supported')
+            settings = {'activation': config['activation']}
+        elif class_name == 'Activation':
+            settings = {'activation': config['activation']}
+        elif class_name == 'Dropout':
+            continue
+        else:
+            raise ValueError('%s layers are not supported' % class_name)
+
+        for name in settings.values():
+            if isinstance(name, str) and name not in ACTIVATIONS:
+                raise ValueError('%s activation is not supported' % name)
+
+        weights = []
+        for j, weight in enumerate(layer.get_weights()):
+            filename = 'layer%02d_%d.npy' % (i, j)
+            np.save(os.path.join(path, filename), weight.astype(np.float32))
+            weights.append(filename)
+
+        layers.append({'class_name': class_name, 'config': settings, 'weights': weights})
+
+    with io.open(os.path.join(path, CONFIG), 'w') as outfile:
+        json.dump({'format': FORMAT_VERSION,
+                   'sparse': len(model.input_shape) == 2,
+                   'layers': layers}, outfile, indent=1)
+
+
+def is_archive(path):
+    '''True if path is an archive folder written by export_model'''
+    return os.path.isfile(os.path.join(path, CONFIG))
+
+
+def parity(model, engine, reference_decoder=None, sequence_length=100,
+           n_steps=20, seed=0):
+    '''Largest absolute difference between the next character probabilities
+    of a Keras model and of its NumpyLSTM on a batch of random windows. With a
+    reference_decoder, a StatefulDecoder of the model, the incremental steps
+    of the two engines after the windows are compared too'''
+    rng = np.random.default_rng(seed)
+    n_tokens = engine.vocabulary_size
+    batch_size = reference_decoder.batch_size if reference_decoder is not None else 8
+    indices = rng.integers(0, n_tokens, size=(batch_size, sequence_length + n_steps),
+                           dtype=np.uint8)
+
+    def model_input(x):
+        return x if len(model.input_shape) == 2 else one_hot(x, n_tokens)
+
+    window = indices[:, :sequence_length]
+    difference = np.abs(model.predict(model_input(window)) - engine.predict(window)).max()
+
+    if reference_decoder is not None:
+        decoder = engine.decoder(batch_size)
+        expected, preds = reference_decoder.warm(model_input(window)), decoder.warm(window)
+        for t in range(sequence_length, sequence_length + n_steps):
+            difference = max(difference, np.abs(expected - preds).max())
+            x = indices[:, t:t + 1]
+            expected, preds = reference_decoder.step(model_input(x)), decoder.step(x)
+        difference = max(difference, np.abs(expected - preds).max())
+
+    return float(difference)
+
+
+class NumpyLSTM():
+    '''NumpyLSTM object that runs an exported model with NumPy
+
+    Parameters:
+        path -- archive folder written by export_model or quantize_archive
+        mmap -- memory-map the weights instead of reading them (default True)
+
+    Attributes:
+        input_shape -- (None, None), the model takes windows of token indices
+        quantization -- int8 or float16 when the kernels are quantized, else None
+        vocabulary_size -- number of characters the model predicts
+        lstm_layers -- kernel, recurrent kernel, bias and activations of every LSTM
+        input_table -- first LSTM input projection of every token, bias included
+        predict -- next character probabilities of a batch of windows
+        decoder -- a NumpyDecoder that advances the model a few timesteps at a time
+    '''
+
+    def __init__(self, path, mmap=True):
+        '''Create a NumpyLSTM object'''
+        with io.open(os.path.join(path, CONFIG), 'r') as infile:
+            config = json.load(infile)
+        if config['format'] != FORMAT_VERSION:
+            raise ValueError('Unsupported archive format %r' % config['format'])
+
+        self.path = path
+        self.input_shape = (None, None)
+        self.quantization = config.get('quantization')
+
+        embedding = None
+        self.lstm_layers = []
+        self.dense = None
+        self.output_activations = []
+        for layer in config['layers']:
+            weights = [_load_weight(path, entry, 'r' if mmap else None)
+                       for entry in layer['weights']]
+            settings = layer['config']
+            if layer['class_name'] == 'Embedding':
+                embedding = weights[0]
+            elif layer['class_name'] == 'LSTM':
+                self.lstm_layers.append((weights[0], weights[1], weights[2],
+                                         settings['units'],
+                                         ACTIVATIONS[settings['activation']],
+                                         ACTIVATIONS[settings['recurrent_activation']]))
+            elif layer['class_name'] == 'Dense':
+                self.dense = (weights[0], weights[1])
+                self.output_activations.append(ACTIVATIONS[settings['activation']])
+            else:
+                self.output_activations.append(ACTIVATIONS[settings['activation']])
+
+        kernel, _, bias = self.lstm_layers[0][:3]
+        if isinstance(kernel, QuantizedMatrix):
+            kernel = kernel.dequantize()
+        if embedding is not None:
+            self.input_table = np.dot(embedding, kernel) + bias
+        else:
+            self.input_table = kernel + bias
+        self.vocabulary_size = self.dense[0].shape[1]
+
+    def decoder(self, batch_size=1):
+        '''Return a NumpyDecoder for batch_size sequences'''
+        return NumpyDecoder(self, batch_size=batch_size)
+
+    def predict(self, x, verbose=0):
+        '''Return the next character probabilities after each window of token
+        indices in x, of shape (batch, timesteps)'''
+        return self.decoder(len(x)).warm(x)
+
+
+class NumpyDecoder():
+    '''NumpyDecoder object that advances a NumpyLSTM a few timesteps at a time
+
+    Parameters:
+        model -- NumpyLSTM to run
+        batch_size -- number of sequences decoded side by side (default 1)
+
+    Attributes:
+        reset -- clear the carried-over LSTM hidden and cell states
+        warm -- reset the states, feed a whole window and return the next character probabilities
+        step -- feed the next timesteps and return the next character probabilities
+        get_states -- return copies of the carried-over states
+        set_states -- replace the carried-over states, e.g. reordered by beam search
+    '''
+
+    def __init__(self, model, batch_size=1):
+        '''Create a NumpyDecoder object'''
+        self.model = model
+        self.batch_size = batch_size
+        self.states = [np.zeros((batch_size, units), dtype=np.float32)
+                       for layer in model.lstm_layers
+                       for units in (layer[3], layer[3])]
+        self.recurrent = [np.empty((batch_size, 4 * layer[3]), dtype=np.float32)
+                          for layer in model.lstm_layers]
+        self.output = np.empty((batch_size, model.vocabulary_size), dtype=np.float32)
+        self.buffers = {}
+
+    def _sequence_buffers(self, timesteps):
+        '''Projection and output buffers of every LSTM for windows of timesteps'''
+        if timesteps not in self.buffers:
+            self.buffers[timesteps] = [
+                (np.empty((self.batch_size, timesteps, 4 * layer[3]), dtype=np.float32),
+                 np.empty((self.batch_size, timesteps, layer[3]), dtype=np.float32))
+                for layer in self.model.lstm_layers]
+        return self.buffers[timesteps]
+
+    def reset(self):
+        '''Clear the carried-over LSTM hidden and cell states'''
+        for state in self.states:
+            state.fill(0)
+
+    def warm(self, x):
+        '''Reset the states and feed a whole window of shape (batch, timesteps)'''
+        self.reset()
+        return self.step(x)
+
+    def step(self, x):
+        '''Feed the next timesteps of token indices, of shape (batch, timesteps),
+        and return the probabilities for the character that follows the last one'''
+        x = np.asarray(x)
+        timesteps = x.shape[1]
+        buffers = self._sequence_buffers(timesteps)
+
+        inputs = None
+        for i, (kernel, recurrent_kernel, bias, units,
+                activation, recurrent_activation) in enumerate(self.model.lstm_layers):
+            projection, outputs = buffers[i]
+            if i == 0:
+                np.take(self.model.input_table, x, axis=0, out=projection)
+            else:
+                _dot(inputs, kernel, out=projection)
+                projection += bias
+
+            h, c = self.states[2 * i], self.states[2 * i + 1]
+            gates = self.recurrent[i]
+            for t in range(timesteps):
+                _dot(h, recurrent_kernel, out=gates)
+                gates += projection[:, t]
+                recurrent_activation(gates[:, :2 * units])
+                activation(gates[:, 2 * units:3 * units])
+                recurrent_activation(gates[:, 3 * units:])
+
+                c *= gates[:, units:2 * units]
+                gates[:, :units] *= gates[:, 2 * units:3 * units]
+                c += gates[:, :units]
+                np.copyto(h, c)
+                activation(h)
+                h *= gates[:, 3 * units:]
+                outputs[:, t] = h
+
+            inputs = outputs
+
+        kernel, bias = self.model.dense
+        _dot(np.ascontiguousarray(inputs[:, -1]), kernel, out=self.output)
+        self.output += bias
+        for activation in self.model.output_activations:
+            activation(self.output)
+
+        return self.output.copy()
+
+    def get_states(self):
+        '''Return copies of the hidden and cell state of every LSTM, as arrays
+        of shape (batch_size, units)'''
+        return [state.copy() for state in self.states]
+
+    def set_states(self, states):
+        '''Replace the carried-over states with arrays ordered as get_states'''
+        for state, new_state in zip(self.states, states):
+            np.copyto(state, new_state)
@@ -4,6 +4,7 @@
 
 import string
 import io
+import json
 import os
 import unicodedata
 import sys
@@ -14,6 +15,11 @@ import pandas as pd
 
 from sklearn.base import BaseEstimator, TransformerMixin
 
+try:
+    from .char_encoding import encode, lookup_table, one_hot, sliding_windows, windows_to_xy
+except ImportError:
+    from char_encoding import encode, lookup_table, one_hot, sliding_windows, windows_to_xy
+
 class CharVectorizer(BaseEstimator, TransformerMixin):
     
     def __init__(self, input='content', encoding='utf-8', decode_error='ignore',
@@ -37,11 +43,17 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
         self.step_size = step_size
         self.char_indices = dict((c, i) for i, c in enumerate(tokens))
         self.indices_char = dict((i, c) for i, c in enumerate(tokens))
+        self.lookup_table = lookup_table(tokens)
         self.file_extension = file_extension
         self.file_list = []
         self.n_files = None
 
-    def steps_per_epoch(self, n=10):
+    def steps_per_epoch(self, n=10, file_index=None):
+        '''Mean length of the files, from file_index when given, otherwise from
+        a sample of n files'''
+        if file_index is not None:
+            return int(file_index.encoded_lengths.mean()) if file_index.n_files else 0
+
         text_lengths = []
         file_paths = random.sample(self.file_list, n)
         for file_path in file_paths:
@@ -50,16 +62,21 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
             text_lengths.append(len(text))
         return int(np.mean(text_lengths))
             
-    def fit(self, raw_documents, y=None):
+    def fit(self, raw_documents, y=None, file_index=None):
+        '''With input 'directorypath', list the files to vectorize, taken from
+        file_index when given instead of walking the directory'''
         if self.input == 'directorypath':
             if not os.path.isdir(raw_documents):
                 raise ValueError("input is 'directorypath' but raw_documents is not a directory")
-            
-            for dirName, _, fileList in os.walk(raw_documents):
-                #print('Found directory: %s' % dirName)
-                for fname in fileList:
-                    if fname.endswith(self.file_extension):
-                        self.file_list.append(os.path.join(dirName, fname))
+
+            if file_index is not None:
+                self.file_list = list(file_index.file_list)
+            else:
+                for dirName, _, fileList in os.walk(raw_documents):
+                    #print('Found directory: %s' % dirName)
+                    for fname in fileList:
+                        if fname.endswith(self.file_extension):
+                            self.file_list.append(os.path.join(dirName, fname))
             self.n_files = len(self.file_list)
 
     def transform(self, raw_documents, copy=True):
@@ -76,32 +93,81 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
             y: The target array of shape (# sequences x 100)
             sentences
         '''
-        sequences = []
-        next_chars = []
         X_output = []
         y_output = []
-        
+
         for document in self.documents_to_strings(raw_documents):
-            for i in range(0, len(document) - self.sequence_length, self.step_size):
-                sequences.append(document[i: i + self.sequence_length])
-                next_chars.append(document[i + self.sequence_length])
-            
-            #Create zeroed feature array shape number of sentences x max_length x 100
-            X = np.zeros((len(sequences), self.sequence_length, len(self.tokens)), dtype=np.bool)
-            #Create zeroed target array shape number of sentences x 100
-            y = np.zeros((len(sequences), len(self.tokens)), dtype=np.bool)
-            
-            #Encode character with a True in the corresponsing index
-            for i, sequence in enumerate(sequences):
-                for letter_ind, char in enumerate(sequence):
-                    X[i, letter_ind, self.char_indices[char]] = True
-                y[i, self.char_indices[next_chars[i]]] = True
+            X, y = self.encode_windows(document)
 
             X_output.append(X)
             y_output.append(y)
 
         return np.vstack(X_output), np.vstack(y_output)
 
+    def transform_to_disk(self, raw_documents, path, max_memory=2 ** 28):
+        '''Stream the windows of raw_documents to an on-disk array instead of
+        building them in memory. Each window is stored as sequence_length + 1
+        uint8 token indices, and at most max_memory bytes of windows are copied
+        at a time, so memory use does not grow with the number of documents.
+
+        Args:
+            raw_documents (str): The documents, as for transform
+            path (str): Base path of the <path>.bin and <path>.json files written
+            max_memory (int): Bytes of windows copied per write (default 256MB)
+
+        Returns:
+            windows: The memory-mapped windows, as returned by load_windows
+        '''
+        width = self.sequence_length + 1
+        chunk_rows = max(max_memory // width, 1)
+        n_windows = 0
+
+        with open(path + '.bin', 'wb') as outfile:
+            for document in self.documents_to_strings(raw_documents):
+                windows = sliding_windows(self.encode(document), width, self.step_size)
+                for ix in range(0, len(windows), chunk_rows):
+                    np.ascontiguousarray(windows[ix:ix + chunk_rows]).tofile(outfile)
+                n_windows += len(windows)
+
+        with open(path + '.json', 'w') as outfile:
+            json.dump({'tokens': self.tokens,
+                       'sequence_length': self.sequence_length,
+                       'step_size': self.step_size,
+                       'n_windows': n_windows}, outfile)
+
+        return self.load_windows(path)
+
+    def load_windows(self, path):
+        '''Memory-map the windows written by transform_to_disk as a read-only
+        uint8 array of shape (# windows x sequence_length + 1)'''
+        with open(path + '.json') as infile:
+            metadata = json.load(infile)
+
+        if (metadata['tokens'] != self.tokens or
+                metadata['sequence_length'] != self.sequence_length):
+            raise ValueError('Windows %s were written with different tokens or '
+                             'sequence length' % path)
+
+        if metadata['n_windows'] == 0:
+            return np.zeros((0, self.sequence_length + 1), dtype=np.uint8)
+        return np.memmap(path + '.bin', dtype=np.uint8, mode='r',
+                         shape=(metadata['n_windows'], self.sequence_length + 1))
+
+    def encode(self, text):
+        '''Convert text to a uint8 array of token indices'''
+        return encode(text, self.lookup_table, errors=self.decode_error)
+
+    def encode_windows(self, text, sparse=False):
+        '''Encode every sequence_length window of text, step_size characters apart,
+        as a one-hot feature array X and the one-hot next character y. With sparse,
+        X and y hold uint8 token indices of shape (# sequences x sequence_length)
+        and (# sequences x 1)'''
+        windows = sliding_windows(self.encode(text), self.sequence_length + 1,
+                                  self.step_size)
+        if sparse:
+            return np.array(windows[:, :-1]), np.array(windows[:, -1:])
+        return windows_to_xy(windows, self.n_tokens)
+
     def documents_to_strings(self, raw_documents):
         if self.input == 'content':
             for text in [raw_documents]:
@@ -139,8 +205,6 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
 
             for file_path in self.file_list:
 
-                sequences = []
-                next_chars = []
                 #file_path = random.sample(self.file_list, 1)[0]
                 
                 with io.open(file_path, encoding=self.encoding, errors='ignore') as f:
@@ -148,21 +212,7 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
 
                 text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii', 'replace')
 
-                for i in range(0, len(text) - self.sequence_length, self.step_size):
-                    sequences.append(text[i: i + self.sequence_length])
-                    next_chars.append(text[i + self.sequence_length])
-                
-                #Create zeroed feature array shape number of sentences x max_length x 100
-                X = np.zeros((len(sequences), self.sequence_length, len(self.tokens)), dtype=np.bool)
-                #Create zeroed target array shape number of sentences x 100
-                y = np.zeros((len(sequences), len(self.tokens)), dtype=np.bool)
-                
-                #Encode character with a True in the corresponsing index
-                for i, sequence in enumerate(sequences):
-                    for letter_ind, char in enumerate(sequence):
-                        X[i, letter_ind, self.char_indices[char]] = True
-                    y[i, self.char_indices[next_chars[i]]] = True
-
+                X, y = self.encode_windows(text)
 
                 for ix in range(0, len(X), batch_size):
                     print(file_path, len(X))
@@ -179,10 +229,8 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
                     yield X[ix,:,:], y[ix,:]
                 '''
 
-    def batch_generator(self, batch_size=512):
+    def batch_generator(self, batch_size=512, sparse=False):
         for file_path in self.file_list:
-            sequences = []
-            next_chars = []
             #file_path = random.sample(self.file_list, 1)[0]
             
             with io.open(file_path, encoding=self.encoding, errors='ignore') as f:
@@ -191,24 +239,11 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
             text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii', 'replace')
             text = self.n_pad(text, self.sequence_length)
 
-            for i in range(0, len(text) - self.sequence_length, self.step_size):
-                sequences.append(text[i: i + self.sequence_length])
-                next_chars.append(text[i + self.sequence_length])
-            
-            #Create zeroed feature array shape number of sentences x max_length x 100
-            X = np.zeros((len(sequences), self.sequence_length, len(self.tokens)), dtype=np.bool)
-            #Create zeroed target array shape number of sentences x 100
-            y = np.zeros((len(sequences), len(self.tokens)), dtype=np.bool)
-            
-            #Encode character with a True in the corresponsing index
-            for i, sequence in enumerate(sequences):
-                for letter_ind, char in enumerate(sequence):
-                    X[i, letter_ind, self.char_indices[char]] = True
-                y[i, self.char_indices[next_chars[i]]] = True
+            X, y = self.encode_windows(text, sparse=sparse)
 
             for ix in range(0, len(X), batch_size):
                 #print(file_path, len(X), ix)
-                yield X[ix:ix+batch_size,:,:], y[ix:ix+batch_size,:]
+                yield X[ix:ix+batch_size], y[ix:ix+batch_size]
 
     def shuffle_files(self):
         random.shuffle(self.file_list)
@@ -228,15 +263,17 @@ class CharVectorizer(BaseEstimator, TransformerMixin):
             out += self.decode_char(v)
         return out
 
-    def vectorize(self, text):
-        text = self.pad_to_length(text, self.sequence_length)[:self.sequence_length]
-      
-        #Create zeroed feature array shape number of sentences x max_length x 100
-        X = np.zeros((1, self.sequence_length, len(self.tokens)), dtype=np.bool)
-        
-        #Encode character with a True in the corresponsing index
-        for i, char in enumerate(text):
-            X[0, i, self.char_indices[char]] = True
+    def encode_window(self, text, padding='\x0b'):
+        '''Encode the last sequence_length characters of text as token indices,
+        padded at the front when the text is shorter'''
+        indices = self.encode(text)[-self.sequence_length:]
+
+        window = np.full(self.sequence_length, self.char_indices[padding], dtype=np.uint8)
+        window[self.sequence_length - len(indices):] = indices
 
-        return X
+        return window
 
+    def vectorize(self, text):
+        '''One-hot encode the last sequence_length characters of text as an
+        array of shape (1 x sequence_length x 100)'''
+        return one_hot(self.encode_window(text)[np.newaxis], self.n_tokens)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+'''quantization.py
+
+Post-training weight quantization for the NumPy inference engine. The LSTM
+kernels and the Dense kernel of a weight archive are stored as int8 with a
+float32 scale per output channel, or as float16, and memory-mapped when the
+archive is loaded, so worker processes share one copy in the page cache.
+
+A QuantizedMatrix is multiplied a block of rows at a time: each block is
+converted to float32 in a small buffer that stays in cache, so only the
+compact weights are read from memory.
+
+Todo:
+    *
+'''
+import io
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+QUANTIZED_LAYERS = ('LSTM', 'Dense')
+DTYPES = ('int8', 'float16')
+
+
+class QuantizedMatrix():
+    '''QuantizedMatrix object that multiplies by int8 or float16 weights
+
+    Parameters:
+        values -- int8 or float16 array of shape (rows, columns)
+        scale -- float32 scale of every column of int8 values (default None)
+        block_bytes -- size of the float32 buffer a block is converted in (default 1MB)
+
+    Attributes:
+        shape -- shape of the matrix
+        dot -- multiply a float32 array by the matrix
+        dequantize -- the matrix as a float32 array
+    '''
+
+    def __init__(self, values, scale=None, block_bytes=2 ** 20):
+        '''Create a QuantizedMatrix object'''
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+        self.block_rows = max(block_bytes // (4 * self.shape[1]), 1)
+        self.local = threading.local()
+
+    def dequantize(self):
+        '''Return the matrix as a float32 array'''
+        matrix = self.values.astype(np.float32)
+        if self.scale is not None:
+            matrix *= self.scale
+        return matrix
+
+    def _buffers(self, n_rows):
+        '''Per thread block and product buffers for n_rows rows of input'''
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None or buffers[1].shape[0] != n_rows:
+            buffers = (np.empty((self.block_rows, self.shape[1]), dtype=np.float32),
+                       np.empty((n_rows, self.shape[1]), dtype=np.float32))
+            self.local.buffers = buffers
+        return buffers
+
+    def dot(self, x, out):
+        '''Write x @ matrix to out, where x has shape (..., rows)'''
+        x = x.reshape(-1, self.shape[0])
+        result = out.reshape(-1, self.shape[1])
+        block, product = self._buffers(len(x))
+
+        result.fill(0)
+        for start in range(0, self.shape[0], self.block_rows):
+            stop = min(start + self.block_rows, self.shape[0])
+            np.copyto(block[:stop - start], self.values[start:stop], casting='unsafe')
+            np.dot(x[:, start:stop], block[:stop - start], out=product)
+            result += product
+
+        if self.scale is not None:
+            result *= self.scale
+        return out
+
+
+def quantize(weight, dtype):
+    '''Quantize a float32 matrix. Returns int8 values and a float32 scale per
+    column, or float16 values and None'''
+    if dtype == 'float16':
+        return weight.astype(np.float16), None
+
+    scale = np.abs(weight).max(axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    values = np.clip(np.rint(weight / scale), -127, 127).astype(np.int8)
+    return values, scale.astype(np.float32)
+
+
+def quantize_archive(archive, destination, dtype='int8'):
+    '''Copy a float32 weight archive written by export_model to destination,
+    storing the LSTM kernels and the Dense kernel as dtype
+
+    Raises:
+        ValueError: dtype is not int8 or float16, or the archive is already quantized
+    '''
+    if dtype not in DTYPES:
+        raise ValueError('dtype must be one of %s' % ', '.join(DTYPES))
+
+    with io.open(os.path.join(archive, 'config.json'), 'r') as infile:
+        config = json.load(infile)
+    if config.get('quantization'):
+        raise ValueError('%s is already quantized' % archive)
+
+    os.makedirs(destination, exist_ok=True)
+    for layer in config['layers']:
+        weights = []
+        for filename in layer['weights']:
+            weight = np.load(os.path.join(archive, filename))
+            if layer['class_name'] in QUANTIZED_LAYERS and weight.ndim == 2:
+                values, scale = quantize(weight, dtype)
+                entry = {'values': filename.replace('.npy', '.%s.npy' % dtype)}
+                np.save(os.path.join(destination, entry['values']), values)
+                if scale is not None:
+                    entry['scale'] = filename.replace('.npy', '.scale.npy')
+                    np.save(os.path.join(destination, entry['scale']), scale)
+                weights.append(entry)
+            else:
+                shutil.copyfile(os.path.join(archive, filename),
+                                os.path.join(destination, filename))
+                weights.append(filename)
+        layer['weights'] = weights
+
+    config['quantization'] = dtype
+    with io.open(os.path.join(destination, 'config.json'), 'w') as outfile:
+        json.dump(config, outfile, indent=1)
+
+
+def bits_per_character(engine, windows, batch_size=256):
+    '''Mean number of bits the engine needs to encode the last character of
+    each window of shape (n_windows, sequence_length + 1)'''
+    total = 0.0
+    for start in range(0, len(windows), batch_size):
+        batch = np.asarray(windows[start:start + batch_size])
+        preds = engine.predict(batch[:, :-1])
+        total -= np.log2(np.maximum(preds[np.arange(len(batch)), batch[:, -1]],
+                                    1e-12)).sum()
+    return float(total / len(windows))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+'''quantize_model.py
+
+This module quantizes the LSTM and Dense kernels of a weight archive written
+by export_model.py to per-channel int8 or to float16, and reports what it
+costs: the change in bits per character on held-out windows of a corpus and
+the decoding latency of both archives.
+
+Example:
+
+    To quantize an archive to int8 and measure it on the files that
+    make_model.py holds out for validation run:
+
+     $ python quantize_model.py /path/to/archive /path/to/archive-int8 /path/to/corpus
+
+    The source can be a folder of .py files or a corpus built by
+    make_corpus.py. Use -d float16 for float16 weights, and -n to set the
+    number of held-out windows. The report is printed and saved as
+    quantization_report.json in the quantized archive, which is served
+    like any other archive:
+
+     $ ./pycc.sh /path/to/archive-int8 25
+
+Attributes:
+    None
+
+Todo:
+    *
+'''
+import io
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from codetovec import PyCodeVectors
+from corpus import is_corpus
+from numpy_lstm import NumpyLSTM, is_archive
+from quantization import DTYPES, bits_per_character, quantize_archive
+
+
+def step_latency(engine, sequence_length, batch_size=1, n_steps=200, seed=0):
+    '''Mean seconds per decoded character after warming on a random window'''
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, engine.vocabulary_size,
+                           size=(batch_size, sequence_length + n_steps), dtype=np.uint8)
+    decoder = engine.decoder(batch_size)
+    decoder.warm(indices[:, :sequence_length])
+
+    start = time.perf_counter()
+    for t in range(sequence_length, sequence_length + n_steps):
+        decoder.step(indices[:, t:t + 1])
+    return (time.perf_counter() - start) / n_steps
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete model quantizer')
+    parser.add_argument('archive', action='store',
+                        help='Weight archive written by export_model.py')
+    parser.add_argument('destination', action='store',
+                        help='Destination folder of the quantized archive')
+    parser.add_argument('source', action='store',
+                        help='Source folder of .py files, or corpus built by make_corpus.py, for the accuracy report')
+    parser.add_argument('-d', default='int8', choices=DTYPES, action='store', dest='dtype',
+                        help='Quantized weight type')
+    parser.add_argument('-l', type=int, default=100, action='store', dest='sequence_length',
+                        help='Sequence length the model was trained with')
+    parser.add_argument('-n', type=int, default=5000, action='store', dest='n_windows',
+                        help='Held-out windows the bits per character are measured on')
+    parser.add_argument('-v', type=float, default=0.05, action='store', dest='validation_split',
+                        help='Fraction of files held out for validation, as in make_model.py')
+    parser.add_argument('-s', type=int, default=200, action='store', dest='n_steps',
+                        help='Decoding steps timed for the latency benchmark')
+
+    settings = parser.parse_args()
+
+    if not is_archive(settings.archive):
+        arg_error(parser, 'error: Invalid weight archive')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(settings.destination))):
+        arg_error(parser, 'error: Invalid destination folder')
+
+    if not (os.path.isdir(settings.source) or is_corpus(settings.source)):
+        arg_error(parser, 'error: Invalid source folder or corpus')
+
+    print('Quantizing Weights...')
+    quantize_archive(settings.archive, settings.destination, dtype=settings.dtype)
+
+    engines = {'float32': NumpyLSTM(settings.archive),
+               settings.dtype: NumpyLSTM(settings.destination)}
+
+    print('Loading Held-out Windows...')
+    pycodevectors = PyCodeVectors(sequence_length=settings.sequence_length)
+    pycodevectors.fit(settings.source)
+    windows = pycodevectors.windows(pycodevectors.validation_mask(settings.validation_split),
+                                    max_windows=settings.n_windows)
+    if not len(windows):
+        arg_error(parser, 'error: No held-out windows, increase the validation split')
+
+    report = {'dtype': settings.dtype, 'n_windows': len(windows)}
+    for name, engine in engines.items():
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for path in [engine.path] for f in os.listdir(path) if f.endswith('.npy'))
+        report[name] = {
+            'weight_bytes': size,
+            'bits_per_character': bits_per_character(engine, windows),
+            'ms_per_character': 1000 * step_latency(engine, settings.sequence_length,
+                                                    n_steps=settings.n_steps),
+            'ms_per_character_batch_8': 1000 * step_latency(engine, settings.sequence_length,
+                                                            batch_size=8,
+                                                            n_steps=settings.n_steps)}
+    report['bits_per_character_delta'] = (report[settings.dtype]['bits_per_character'] -
+                                          report['float32']['bits_per_character'])
+
+    with io.open(os.path.join(settings.destination, 'quantization_report.json'), 'w') as outfile:
+        json.dump(report, outfile, indent=1)
+
+    for name in engines:
+        print('%-8s %10d bytes  %.4f bits/char  %.3f ms/char  %.3f ms/char (batch 8)' %
+              (name, report[name]['weight_bytes'], report[name]['bits_per_character'],
+               report[name]['ms_per_character'], report[name]['ms_per_character_batch_8']))
+    print('Bits per character delta: %+.4f' % report['bits_per_character_delta'])
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
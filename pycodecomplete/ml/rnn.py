@@ -15,15 +15,21 @@ import time
 
 import numpy as np
 
+from keras import backend as K
 from keras.models import Sequential
-from keras.layers import LSTM, Dropout, Activation, Dense
-from keras.callbacks import LambdaCallback, ModelCheckpoint
+from keras.layers import LSTM, Dropout, Activation, Dense, Embedding
+from keras.callbacks import Callback, LambdaCallback, ModelCheckpoint
 from keras.optimizers import RMSprop, Adam
 from keras.utils.data_utils import get_file
 from keras.utils import multi_gpu_model
 
 from process_text import CharVectorizer
 from codetovec import PyCodeVectors
+from char_encoding import one_hot
+from sampling import Sampler
+from training_monitor import (InstrumentedSequence, LoaderStats, TrainingMonitor,
+                              instrumented_generator)
+from window_sequence import CachedWindowSequence, WindowSequence
 
 
 class pyCodeRNNBuilder():
@@ -32,7 +38,7 @@ class pyCodeRNNBuilder():
         Parameters:
         sequence_length -- The number of characters in a sequence
         save_pickle_folder -- location to save the pickled model after each epoch
-        pycode_directory -- location of the data
+        pycode_directory -- location of the data, a folder or a corpus built by make_corpus.py
         vocabulary -- string containing all the characters to consider (default string.printable)
         hidden_layer_dim -- number of layers in the RNN (default 1)
         dropout -- add dropout layers between each layer of LSTMs (default True)
@@ -40,6 +46,18 @@ class pyCodeRNNBuilder():
         step_size -- the number of characters to step to create the next sequence (default 1)
         n_gpu -- number of GPUs to train on (default None)
         model -- existing model file location (default None)
+        sparse -- feed uint8 character indices through an Embedding layer and train
+                  with sparse_categorical_crossentropy instead of one-hot vectors (default False)
+        embedding_dim -- size of the Embedding output when sparse (default vocabulary size)
+        stateful -- train with truncated BPTT: stateful LSTMs read contiguous, non-overlapping
+                    chunks of every file, supervise every timestep and reset at file
+                    boundaries (default False)
+        batch_size -- batch size of the stateful model, required when stateful (default None)
+        fit_data -- read and encode pycode_directory for fit, False when the training
+                    batches are prepared elsewhere and only the model is needed (default True)
+        cache_directory -- folder the file index and encoded corpus of pycode_directory are
+                           kept in (default pycode_directory, or ~/.cache/pycodecomplete
+                           when it is read-only)
 
         Attributes:
         build_model -- create Keras RNN model with the specified hyperparameters
@@ -51,7 +69,9 @@ class pyCodeRNNBuilder():
     def __init__(self, sequence_length, save_pickle_folder, pycode_directory,
                  vocabulary=string.printable,
                  n_layers=1, hidden_layer_dim=128,
-                 dropout=True, dropout_rate=.2, step_size=1, n_gpu=None, model=None):
+                 dropout=True, dropout_rate=.2, step_size=1, n_gpu=None, model=None,
+                 sparse=False, embedding_dim=None, stateful=False, batch_size=None,
+                 fit_data=True, cache_directory=None):
 
         self.sequence_length = sequence_length
         self.vocabulary = vocabulary
@@ -61,28 +81,42 @@ class pyCodeRNNBuilder():
         self.dropout = dropout
         self.dropout_rate = dropout_rate
         self.step_size = step_size
+        self.stateful = stateful
+        self.batch_size = batch_size
+        if self.stateful and (self.batch_size is None or n_gpu is not None):
+            raise ValueError('stateful training needs a batch_size and a single GPU')
+
         self.save_pickle_folder = save_pickle_folder
         self.save_pickle_path = os.path.join(
             self.save_pickle_folder,
-            ('%dx%d_%d-nlayers_%d-hiddenlayerdim_%0.2f-dropout_epoch{epoch:03d}-loss{loss:.4f}-val-loss{val_loss:.4f}'))
+            '%dx%d_%d-nlayers_%d-hiddenlayerdim_%0.2f-dropout_epoch{epoch:03d}-loss{loss:.4f}')
         self.model = model
         self.n_gpu = n_gpu
+        self.sparse = sparse
+        self.embedding_dim = embedding_dim or self.vocabulary_size
+        self.sampler = Sampler()
+        self.loss = ('sparse_categorical_crossentropy' if self.sparse
+                     else 'categorical_crossentropy')
 
         self.char_vectorizer = CharVectorizer(tokens=self.vocabulary,
                                               sequence_length=self.sequence_length,
                                               input='directorypath', encoding='utf-8',
                                               step_size=self.step_size)
 
-        self.char_vectorizer.fit(pycode_directory)
+        self.pycodevectors = PyCodeVectors(vocabulary=self.vocabulary,
+                                           sequence_length=self.sequence_length,
+                                           step_size=self.step_size,
+                                           cache_directory=cache_directory)
 
-        self.pycodevectors = PyCodeVectors()
-        self.pycodevectors.fit(pycode_directory)
+        self.file_index = None
+        if fit_data:
+            if os.path.isdir(pycode_directory):
+                self.file_index = self.pycodevectors.file_index(pycode_directory).refresh()
+                self.char_vectorizer.fit(pycode_directory, file_index=self.file_index)
 
-        self.checkpoint = ModelCheckpoint(
-            self.save_pickle_path % (self.sequence_length, self.vocabulary_size,
-                                     self.n_layers, self.hidden_layer_dim,
-                                     self.dropout_rate),
-            save_weights_only=False)
+            self.pycodevectors.fit(pycode_directory, file_index=self.file_index)
+
+        self.checkpoint = self.checkpoint_callback(validation=not self.stateful)
 
         if self.model is None:
             self.build_model()
@@ -90,20 +124,39 @@ class pyCodeRNNBuilder():
             print('Continuing training existing model')
             print('Using', self.n_gpu, 'GPUs')
             parallel_model = multi_gpu_model(model, gpus=self.n_gpu)
-            parallel_model.compile(
-                loss='categorical_crossentropy', optimizer="adam")
+            parallel_model.compile(loss=self.loss, optimizer="adam")
             self.model = parallel_model
 
+    def checkpoint_callback(self, validation=True):
+        '''ModelCheckpoint that saves the model after every epoch, with the
+        validation loss in the file name when there is a validation set'''
+        return ModelCheckpoint(
+            (self.save_pickle_path + ('-val-loss{val_loss:.4f}' if validation else '')) %
+            (self.sequence_length, self.vocabulary_size, self.n_layers,
+             self.hidden_layer_dim, self.dropout_rate),
+            save_weights_only=False)
+
     def build_model(self):
         '''Build a Keras sequential model for training the char-rnn'''
         model = Sequential()
+        if self.stateful:
+            input_shape = {'batch_input_shape': (self.batch_size, self.sequence_length) +
+                           (() if self.sparse else (self.vocabulary_size,))}
+        elif self.sparse:
+            input_shape = {'input_length': self.sequence_length}
+        else:
+            input_shape = {'input_shape': (self.sequence_length, self.vocabulary_size)}
+
+        if self.sparse:
+            model.add(Embedding(self.vocabulary_size, self.embedding_dim, **input_shape))
         for i in range(self.n_layers):
             model.add(
                 LSTM(
                     self.hidden_layer_dim,
                     return_sequences=True if (
-                        i != (self.n_layers - 1)) else False,
-                    input_shape=(self.sequence_length, self.vocabulary_size)
+                        self.stateful or i != (self.n_layers - 1)) else False,
+                    stateful=self.stateful,
+                    **({} if self.sparse or i > 0 else input_shape)
                 )
             )
             if self.dropout:
@@ -113,14 +166,14 @@ class pyCodeRNNBuilder():
         model.add(Activation('softmax'))
 
         if self.n_gpu is None:
-            model.compile(loss='categorical_crossentropy', optimizer="adam")
+            model.compile(loss=self.loss, optimizer="adam",
+                          sample_weight_mode='temporal' if self.stateful else None)
             self.model = model
             return model
         else:
             print('Using ', self.n_gpu, ' GPUs')
             parallel_model = multi_gpu_model(model, gpus=self.n_gpu)
-            parallel_model.compile(
-                loss='categorical_crossentropy', optimizer="adam")
+            parallel_model.compile(loss=self.loss, optimizer="adam")
             self.model = parallel_model
             return parallel_model
 
@@ -128,12 +181,7 @@ class pyCodeRNNBuilder():
 
     def sample(self, preds, temperature=1.0):
         # Helper function to sample an index from a probability array
-        preds = np.asarray(preds).astype('float64')
-        preds = np.log(preds) / temperature
-        exp_preds = np.exp(preds)
-        preds = exp_preds / np.sum(exp_preds)
-        probas = np.random.multinomial(1, preds, 1)
-        return np.argmax(probas)
+        return self.sampler.sample(preds, temperature)
 
     def on_epoch_end(self, epoch, logs):
         # Function at end of each epoch. Prints generated text.
@@ -155,10 +203,9 @@ class pyCodeRNNBuilder():
             sys.stdout.write(generated)
 
             for i in range(400):
-                x_pred = np.zeros(
-                    (1, self.char_vectorizer.sequence_length, len(self.char_vectorizer.tokens)))
-                for t, char in enumerate(sentence):
-                    x_pred[0, t, self.char_vectorizer.char_indices[char]] = 1.
+                x_pred = self.char_vectorizer.encode_window(sentence)[np.newaxis]
+                if not self.sparse:
+                    x_pred = one_hot(x_pred, self.vocabulary_size)
 
                 preds = self.model.predict(x_pred, verbose=0)[0]
                 next_index = self.sample(preds, diversity)
@@ -173,16 +220,49 @@ class pyCodeRNNBuilder():
 
     def fit(self, steps_per_epoch=None, max_queue_size=1, batch_size=512,
             epochs=5, initial_epoch=0, validation_steps=None, multiprocessing=False,
-            shuffle_source_files=True, workers=1):
-        '''Perform batch training of the RNN with the specified hyperparamenters'''
+            shuffle_source_files=True, workers=1, seed=0, validation_split=0.05,
+            max_validation_windows=100000, training_log=None):
+        '''Perform batch training of the RNN with the specified hyperparamenters.
+        Training batches come from a WindowSequence, so with workers > 1 and
+        multiprocessing Keras prepares them in several processes. Batch i of
+        epoch e depends only on the seed. The files whose path hash falls in
+        validation_split are held out, and up to max_validation_windows of
+        their windows are gathered once and validated on every epoch. With a
+        validation_split of 0 every file is trained on and nothing is validated. A
+        TrainingMonitor times the train steps and the waits for batches, logs
+        them to training_log, a .csv or .jsonl file, and prints the bottleneck
+        of every epoch'''
+        if self.stateful:
+            return self.fit_stateful(max_queue_size=max_queue_size,
+                                     epochs=epochs, initial_epoch=initial_epoch,
+                                     training_log=training_log)
+
         # if steps_per_epoch is None:
         #    steps_per_epoch = self.char_vectorizer.steps_per_epoch
 
-        if steps_per_epoch is None:
-            steps_per_epoch = self.pycodevectors.source_length // batch_size
+        validation_mask = self.pycodevectors.validation_mask(validation_split)
+        validation_sequence = None
+        checkpoint = self.checkpoint
+        if validation_split > 0:
+            validation_windows = self.pycodevectors.windows(validation_mask,
+                                                            max_windows=max_validation_windows)
+            if not len(validation_windows):
+                raise ValueError('No files held out for validation, increase validation_split')
+
+            validation_sequence = CachedWindowSequence(validation_windows, batch_size,
+                                                       self.vocabulary_size, sparse=self.sparse)
+            if validation_steps is None:
+                validation_steps = len(validation_sequence)
+        else:
+            checkpoint = self.checkpoint_callback(validation=False)
 
-        if validation_steps is None:
-            validation_steps = 1
+        sequence = self.window_sequence(batch_size, seed=seed, epoch=initial_epoch,
+                                        file_mask=~validation_mask)
+        loader_stats = LoaderStats()
+        monitor = TrainingMonitor(training_log, stats=loader_stats)
+
+        if steps_per_epoch is None:
+            steps_per_epoch = len(sequence)
 
         if shuffle_source_files:
             self.char_vectorizer.shuffle_files()
@@ -193,18 +273,89 @@ class pyCodeRNNBuilder():
         print('Max Batches to Queue in RAM =', max_queue_size)
         print('Epochs =', epochs)
         print('Intial Epcoh =', initial_epoch)
+        print('Validation Files =', validation_mask.sum(), 'of', len(validation_mask))
+        print('Validation Windows =',
+              len(validation_sequence.windows) if validation_sequence is not None else 0)
+        print('Workers =', workers, '(processes)' if multiprocessing else '(threads)')
 
         self.model.fit_generator(
             # generator=self.char_vectorizer.batch_generator(batch_size=batch_size),
-            generator=self.pycodevectors.data_generator(batch_size=batch_size),
+            generator=InstrumentedSequence(sequence, loader_stats),
             steps_per_epoch=steps_per_epoch,
             max_queue_size=max_queue_size,
             epochs=epochs,
             initial_epoch=initial_epoch,
             workers=workers,
-            use_multiprocessing=False,
+            use_multiprocessing=multiprocessing,
+            shuffle=False,
             verbose=1,
-            validation_data=self.pycodevectors.data_generator(
-                batch_size=batch_size),
+            validation_data=validation_sequence,
             validation_steps=validation_steps,
-            callbacks=[self.checkpoint])
+            callbacks=[checkpoint, monitor])
+
+    def window_sequence(self, batch_size, seed=0, epoch=0, file_mask=None):
+        '''WindowSequence over the windows of the training corpus, or of the
+        files selected by file_mask'''
+        file_offsets = self.pycodevectors.file_offsets
+        if file_mask is not None:
+            file_offsets = file_offsets[file_mask]
+        return WindowSequence(self.pycodevectors.source_indices,
+                              file_offsets,
+                              self.sequence_length, batch_size,
+                              self.vocabulary_size, sparse=self.sparse,
+                              seed=seed, epoch=epoch)
+
+    def fit_stateful(self, max_queue_size=1, epochs=5, initial_epoch=0, training_log=None):
+        '''Train the stateful model with truncated BPTT over contiguous chunks.
+        Batches must arrive in order, so a single generator thread is used, and
+        an epoch is always one full pass over the lanes'''
+        schedule = self.pycodevectors.tbptt_schedule(self.batch_size)
+        steps_per_epoch = len(schedule[0])
+        loader_stats = LoaderStats()
+
+        print('Starting Stateful Training...')
+        print('Batch Size =', self.batch_size)
+        print('Number of Batches =', steps_per_epoch)
+        print('Epochs =', epochs)
+
+        self.model.fit_generator(
+            generator=instrumented_generator(
+                self.pycodevectors.tbptt_generator(schedule, sparse=self.sparse), loader_stats),
+            steps_per_epoch=steps_per_epoch,
+            max_queue_size=max_queue_size,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            workers=1,
+            use_multiprocessing=False,
+            verbose=1,
+            callbacks=[LaneResetCallback(schedule[2]), self.checkpoint,
+                       TrainingMonitor(training_log, stats=loader_stats)])
+
+
+class LaneResetCallback(Callback):
+    '''Keras callback that zeroes the LSTM states of the batch rows that start a
+    new file, as planned by PyCodeVectors.tbptt_schedule, and resets every state
+    at the start of an epoch
+
+    Parameters:
+        resets -- boolean array of shape (steps_per_epoch, batch_size)
+    '''
+
+    def __init__(self, resets):
+        super(LaneResetCallback, self).__init__()
+        self.resets = resets
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.model.reset_states()
+
+    def on_batch_begin(self, batch, logs=None):
+        rows = self.resets[batch % len(self.resets)]
+        if batch == 0 or not rows.any():
+            return
+
+        for layer in self.model.layers:
+            if getattr(layer, 'stateful', False):
+                states = K.batch_get_value(layer.states)
+                for state in states:
+                    state[rows] = 0
+                layer.reset_states(states)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''sampling.py
+
+Sampling kernel shared by CodeGenerator and pyCodeRNNBuilder. A Sampler draws
+one token index per row of a (batch, vocabulary) probability array with the
+Gumbel-max trick, reusing its work buffers between calls. Rows can be decoded
+greedily, with a temperature, and restricted to the top k tokens or to the
+smallest set of tokens whose probability reaches top p.
+
+Todo:
+    *
+'''
+import numpy as np
+
+
+class Sampler():
+    '''Sampler object that draws token indices from batches of probability rows
+
+    Parameters:
+        seed -- seed, or np.random.Generator, for the random draws (default None)
+
+    Attributes:
+        sample -- draw one token index for each row of a probability array
+    '''
+
+    def __init__(self, seed=None):
+        '''Create a Sampler object'''
+        self.rng = np.random.default_rng(seed)
+        self.buffers = {}
+
+    def _buffer(self, name, shape):
+        '''Return a float64 work buffer of shape, reused between calls'''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, dtype=np.float64)
+        return buffer
+
+    def sample(self, probs, temperature=1.0, top_k=None, top_p=None):
+        '''Draw a token index from each row of probs
+
+        Args:
+            probs (ndarray): Probabilities of shape (batch, vocabulary) or (vocabulary,)
+            temperature (float or ndarray): Temperature of every row, or one per
+                row. A temperature of 0 picks the most likely token (default 1.0)
+            top_k (int): Only sample from the k most likely tokens (default None)
+            top_p (float): Only sample from the most likely tokens whose total
+                probability reaches top_p (default None)
+
+        Returns:
+            indices: int array of shape (batch,), or an int for a single row
+        '''
+        probs = np.asarray(probs)
+        single = probs.ndim == 1
+        probs = np.atleast_2d(probs)
+
+        logits = self._buffer('logits', probs.shape)
+        with np.errstate(divide='ignore'):
+            np.log(probs, out=logits)
+
+        temperature = np.broadcast_to(
+            np.asarray(temperature, dtype=np.float64), (len(probs),))
+        greedy = temperature <= 0
+        logits /= np.where(greedy, 1.0, temperature)[:, np.newaxis]
+
+        if top_k is not None and top_k < probs.shape[1]:
+            kth = np.partition(logits, -top_k, axis=1)[:, -top_k, np.newaxis]
+            logits[logits < kth] = -np.inf
+
+        if top_p is not None and top_p < 1.0:
+            self._top_p_filter(logits, top_p)
+
+        noise = self._buffer('noise', probs.shape)
+        self.rng.random(out=noise)
+        np.log(noise, out=noise)
+        np.negative(noise, out=noise)
+        np.log(noise, out=noise)
+        np.subtract(logits, noise, out=noise)
+
+        indices = np.argmax(noise, axis=1)
+        if greedy.any():
+            indices[greedy] = np.argmax(logits[greedy], axis=1)
+
+        return int(indices[0]) if single else indices
+
+    def _top_p_filter(self, logits, top_p):
+        '''Set the logits outside each row's top p probability mass to -inf'''
+        tempered = self._buffer('tempered', logits.shape)
+        np.subtract(logits, logits.max(axis=1, keepdims=True), out=tempered)
+        np.exp(tempered, out=tempered)
+        tempered /= tempered.sum(axis=1, keepdims=True)
+
+        order = np.argsort(-tempered, axis=1)
+        sorted_probs = np.take_along_axis(tempered, order, axis=1)
+        cumulative = np.cumsum(sorted_probs, axis=1)
+
+        remove = np.zeros(logits.shape, dtype=bool)
+        np.put_along_axis(remove, order, cumulative - sorted_probs >= top_p, axis=1)
+        logits[remove] = -np.inf
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+'''training_monitor.py
+
+Find out whether training is limited by the model or by the data loader.
+The training Sequence, or generator, is wrapped so every batch it prepares
+is counted and timed, and the TrainingMonitor callback times each train
+step and the wait for the next batch between steps. It logs, per batch and
+per epoch, the samples per second, the wait and step times, the number of
+batches prepared ahead of training, and the memory of the process, to a
+.csv or .jsonl file. At the end of each epoch it prints whether the epoch
+was bound by the data loader or by the train steps.
+
+The counters of the wrapped loader live in shared memory, so batches
+prepared by forked worker processes are counted too.
+
+Todo:
+    *
+'''
+import csv
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from keras.callbacks import Callback
+from keras.utils import Sequence
+
+BATCH_FIELDS = ['epoch', 'batch', 'samples', 'wait_seconds', 'step_seconds',
+                'samples_per_second', 'prepare_seconds', 'queue_depth', 'rss_mb', 'loss']
+EPOCH_FIELDS = ['epoch', 'batches', 'samples', 'seconds', 'samples_per_second',
+                'wait_seconds', 'step_seconds', 'validation_seconds', 'wait_fraction',
+                'prepare_seconds', 'mean_queue_depth', 'min_queue_depth', 'peak_rss_mb',
+                'loss', 'val_loss', 'bottleneck']
+# One CSV header for both kinds of records, the cells a kind has no value for left empty
+CSV_FIELDS = ['record'] + BATCH_FIELDS + [field for field in EPOCH_FIELDS
+                                          if field not in BATCH_FIELDS]
+
+
+def rss_mb():
+    '''Resident memory of this process in MB, or its peak where the current
+    value cannot be read'''
+    try:
+        with io.open('/proc/self/statm', 'r') as infile:
+            pages = int(infile.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class LoaderStats():
+    '''Counters of the batches a data loader prepared, shared with forked workers
+
+    Attributes:
+        record -- count a prepared batch and the seconds it took
+        read -- the batches prepared so far and the seconds they took
+    '''
+
+    def __init__(self):
+        '''Create a LoaderStats object'''
+        self.prepared = multiprocessing.Value('q', 0)
+        self.seconds = multiprocessing.Value('d', 0.0)
+
+    def record(self, seconds):
+        '''Count a batch that took seconds to prepare'''
+        with self.prepared.get_lock():
+            self.prepared.value += 1
+            self.seconds.value += seconds
+
+    def read(self):
+        '''Return the batches prepared so far and the seconds they took'''
+        with self.prepared.get_lock():
+            return self.prepared.value, self.seconds.value
+
+
+class InstrumentedSequence(Sequence):
+    '''InstrumentedSequence object that serves the batches of a Sequence and
+    records the time each took to prepare
+
+    Parameters:
+        sequence -- the Keras Sequence to serve, e.g. a WindowSequence
+        stats -- LoaderStats the batches are counted in (default new LoaderStats)
+    '''
+
+    def __init__(self, sequence, stats=None):
+        '''Create an InstrumentedSequence object'''
+        self.sequence = sequence
+        self.stats = stats or LoaderStats()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        started = time.perf_counter()
+        batch = self.sequence[idx]
+        self.stats.record(time.perf_counter() - started)
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+def instrumented_generator(generator, stats):
+    '''Yield the batches of generator, recording in the LoaderStats stats the
+    time each took to prepare'''
+    while True:
+        started = time.perf_counter()
+        try:
+            batch = next(generator)
+        except StopIteration:
+            return
+        stats.record(time.perf_counter() - started)
+        yield batch
+
+
+class TrainingMonitor(Callback):
+    '''Keras callback that measures training throughput and data loader stalls
+
+    Parameters:
+        log_path -- .csv or .jsonl file the batch and epoch records are appended to,
+                    None to keep no log (default None)
+        stats -- LoaderStats of the wrapped training data (default None)
+        log_batches -- also log a record per batch, not only per epoch (default True)
+        stall_fraction -- share of an epoch spent waiting for batches above which
+                          it is reported as bound by the data loader (default 0.2)
+        verbose -- print the bottleneck summary at the end of each epoch (default True)
+
+    Attributes:
+        epochs -- the records of the finished epochs
+        summary -- short description of the bottleneck of an epoch record
+    '''
+
+    def __init__(self, log_path=None, stats=None, log_batches=True, stall_fraction=0.2,
+                 verbose=True):
+        super(TrainingMonitor, self).__init__()
+        self.log_path = log_path
+        self.stats = stats
+        self.log_batches = log_batches
+        self.stall_fraction = stall_fraction
+        self.verbose = verbose
+        self.jsonl = log_path is not None and log_path.endswith('.jsonl')
+        self.epochs = []
+
+        self.consumed = 0
+        self.logfile = None
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if self.log_path is None:
+            return
+        new = not os.path.exists(self.log_path) or os.path.getsize(self.log_path) == 0
+        self.logfile = io.open(self.log_path, 'a', newline='')
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.logfile, fieldnames=CSV_FIELDS)
+            if new:
+                self.writer.writeheader()
+
+    def on_train_end(self, logs=None):
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_started = time.perf_counter()
+        self.last_batch_end = self.epoch_started
+        self.batches = 0
+        self.samples = 0
+        self.wait_seconds = 0.0
+        self.step_seconds = 0.0
+        self.queue_depths = []
+        self.peak_rss = 0.0
+        self.loader_start = self.stats.read() if self.stats is not None else (0, 0.0)
+        self.loader_last = self.loader_start
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_started = time.perf_counter()
+        self.wait = self.batch_started - self.last_batch_end
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        now = time.perf_counter()
+        self.last_batch_end = now
+        step = now - self.batch_started
+        samples = int(logs.get('size', 0))
+        self.consumed += 1
+
+        self.batches += 1
+        self.samples += samples
+        self.wait_seconds += self.wait
+        self.step_seconds += step
+        memory = rss_mb()
+        self.peak_rss = max(self.peak_rss, memory)
+
+        queue_depth = prepare_seconds = None
+        if self.stats is not None:
+            prepared, seconds = self.stats.read()
+            queue_depth = max(prepared - self.consumed, 0)
+            self.queue_depths.append(queue_depth)
+            if prepared > self.loader_last[0]:
+                prepare_seconds = ((seconds - self.loader_last[1]) /
+                                   (prepared - self.loader_last[0]))
+            self.loader_last = (prepared, seconds)
+
+        if self.log_batches:
+            self.write('batch', {'epoch': self.epoch,
+                                 'batch': batch,
+                                 'samples': samples,
+                                 'wait_seconds': self.wait,
+                                 'step_seconds': step,
+                                 'samples_per_second': samples / max(self.wait + step, 1e-9),
+                                 'prepare_seconds': prepare_seconds,
+                                 'queue_depth': queue_depth,
+                                 'rss_mb': memory,
+                                 'loss': logs.get('loss')})
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        now = time.perf_counter()
+        train_seconds = self.wait_seconds + self.step_seconds
+
+        prepare_seconds = None
+        if self.stats is not None:
+            prepared, seconds = self.stats.read()
+            # Also counts the batches prefetched for the next epoch
+            if prepared > self.loader_start[0]:
+                prepare_seconds = ((seconds - self.loader_start[1]) /
+                                   (prepared - self.loader_start[0]))
+
+        record = {'epoch': epoch,
+                  'batches': self.batches,
+                  'samples': self.samples,
+                  'seconds': now - self.epoch_started,
+                  'samples_per_second': self.samples / max(train_seconds, 1e-9),
+                  'wait_seconds': self.wait_seconds,
+                  'step_seconds': self.step_seconds,
+                  'validation_seconds': now - self.last_batch_end,
+                  'wait_fraction': self.wait_seconds / max(train_seconds, 1e-9),
+                  'prepare_seconds': prepare_seconds,
+                  'mean_queue_depth': (sum(self.queue_depths) / len(self.queue_depths)
+                                       if self.queue_depths else None),
+                  'min_queue_depth': min(self.queue_depths) if self.queue_depths else None,
+                  'peak_rss_mb': self.peak_rss,
+                  'loss': logs.get('loss'),
+                  'val_loss': logs.get('val_loss')}
+        record['bottleneck'] = ('data loader' if record['wait_fraction'] > self.stall_fraction
+                                else 'train step')
+        self.epochs.append(record)
+        self.write('epoch', record)
+        if self.logfile is not None:
+            self.logfile.flush()
+
+        if self.verbose:
+            print(self.summary(record))
+
+    def summary(self, record):
+        '''Return a short description of the bottleneck of an epoch record'''
+        lines = ['----- Epoch %d: %.0f samples/s, %.1f%% of the time waiting for batches, '
+                 'bound by the %s' % (record['epoch'], record['samples_per_second'],
+                                      100 * record['wait_fraction'], record['bottleneck']),
+                 '----- Train step %.1f ms, wait %.1f ms per batch' %
+                 (1000 * record['step_seconds'] / max(record['batches'], 1),
+                  1000 * record['wait_seconds'] / max(record['batches'], 1))]
+        if record['prepare_seconds'] is not None:
+            lines[-1] += (', a batch takes %.1f ms to prepare, %.1f batches ready on average'
+                          % (1000 * record['prepare_seconds'], record['mean_queue_depth']))
+        lines.append('----- Validation %.1f s, peak memory %.0f MB' %
+                     (record['validation_seconds'], record['peak_rss_mb']))
+        if record['bottleneck'] == 'data loader':
+            lines.append('----- Add workers (-w), --multiprocessing or a larger max queue size, '
+                         'or train on a corpus with --sparse to encode batches faster')
+        return '\n'.join(lines)
+
+    def write(self, kind, record):
+        '''Append a batch or epoch record to the log'''
+        if self.logfile is None:
+            return
+        if self.jsonl:
+            self.logfile.write(json.dumps(dict(record, record=kind)) + '\n')
+        else:
+            self.writer.writerow(dict(record, record=kind))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''window_sequence.py
+
+Indexable training data for Keras. WindowSequence serves batches of windows
+cut from an encoded corpus, so Keras can prefetch them with several worker
+processes. The order of the windows is shuffled every epoch by a seeded
+affine permutation, which needs no memory and makes batch i of epoch e the
+same no matter how many workers produce it. CachedWindowSequence serves the
+same kind of batches from windows gathered once, such as the held-out
+validation set, in a fixed order or shuffled the same way.
+
+Todo:
+    *
+'''
+import math
+
+import numpy as np
+
+from keras.utils import Sequence
+
+try:
+    from .char_encoding import affine_permute, windows_to_xy
+except ImportError:
+    from char_encoding import affine_permute, windows_to_xy
+
+
+def epoch_permutation(seed, epoch, n):
+    '''The multiplier and offset of the affine permutation of n items in an
+    epoch. The multiplier is coprime with n, so the map is a bijection'''
+    rng = np.random.default_rng([seed, epoch])
+    multiplier = int(rng.integers(1, max(n, 2)))
+    while math.gcd(multiplier, n) != 1:
+        multiplier = multiplier % (n - 1) + 1
+    offset = int(rng.integers(0, max(n, 1)))
+    return multiplier, offset
+
+
+class WindowSequence(Sequence):
+    '''WindowSequence object that serves shuffled batches of corpus windows
+
+    Parameters:
+        source_indices -- uint8 array, or memmap, of the encoded corpus
+        file_offsets -- int64 array of the start and end of each file's content
+        sequence_length -- length of each sequence
+        batch_size -- number of windows in a batch
+        vocabulary_length -- number of characters in the vocabulary
+        sparse -- serve uint8 index arrays instead of one-hot arrays (default False)
+        seed -- seed of the per-epoch permutations (default 0)
+        shuffle -- shuffle the windows every epoch (default True)
+        epoch -- epoch the sequence starts at (default 0)
+
+    Attributes:
+        n_windows -- number of windows whose target is a character of a file
+        positions -- corpus positions of the targets of a batch
+    '''
+
+    def __init__(self, source_indices, file_offsets, sequence_length, batch_size,
+                 vocabulary_length, sparse=False, seed=0, shuffle=True, epoch=0):
+        '''Create a WindowSequence object'''
+        self.source_indices = source_indices
+        self.sequence_length = sequence_length
+        self.batch_size = batch_size
+        self.vocabulary_length = vocabulary_length
+        self.sparse = sparse
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = epoch
+
+        self.file_starts = np.asarray(file_offsets[:, 0], dtype=np.int64)
+        file_lengths = np.asarray(file_offsets[:, 1] - file_offsets[:, 0], dtype=np.int64)
+        self.file_ends = np.cumsum(file_lengths)
+        self.file_firsts = self.file_ends - file_lengths
+        self.n_windows = int(self.file_ends[-1]) if len(self.file_ends) else 0
+
+        self.window_offsets = np.arange(-self.sequence_length, 1)
+        self._permutation = None
+
+    def __len__(self):
+        return self.n_windows // self.batch_size
+
+    def __getitem__(self, idx):
+        windows = self.source_indices[self.positions(idx)[:, np.newaxis] +
+                                      self.window_offsets]
+        if self.sparse:
+            return windows[:, :-1], windows[:, -1:]
+        return windows_to_xy(windows, self.vocabulary_length)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def permutation(self, epoch):
+        '''The multiplier and offset of the affine permutation of an epoch'''
+        if self._permutation is None or self._permutation[0] != epoch:
+            self._permutation = (epoch,) + epoch_permutation(self.seed, epoch, self.n_windows)
+        return self._permutation[1:]
+
+    def positions(self, idx):
+        '''Corpus positions of the targets of batch idx of the current epoch'''
+        order = np.arange(idx * self.batch_size, (idx + 1) * self.batch_size,
+                          dtype=np.int64)
+        if self.shuffle:
+            multiplier, offset = self.permutation(self.epoch)
+            order = affine_permute(order, multiplier, offset, self.n_windows)
+
+        files = np.searchsorted(self.file_ends, order, side='right')
+        return self.file_starts[files] + order - self.file_firsts[files]
+
+
+class CachedWindowSequence(Sequence):
+    '''CachedWindowSequence object that serves batches of pre-gathered windows
+
+    Parameters:
+        windows -- uint8 array of shape (n_windows, sequence_length + 1)
+        batch_size -- number of windows in a batch
+        vocabulary_length -- number of characters in the vocabulary
+        sparse -- serve uint8 index arrays instead of one-hot arrays (default False)
+        shuffle -- serve the windows in a new seeded order every epoch, so a
+                   batch is not a run of neighbouring windows (default False)
+        seed -- seed of the per-epoch permutations (default 0)
+        epoch -- epoch the sequence starts at (default 0)
+    '''
+
+    def __init__(self, windows, batch_size, vocabulary_length, sparse=False,
+                 shuffle=False, seed=0, epoch=0):
+        '''Create a CachedWindowSequence object'''
+        self.windows = windows
+        self.batch_size = batch_size
+        self.vocabulary_length = vocabulary_length
+        self.sparse = sparse
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-len(self.windows) // self.batch_size)
+
+    def __getitem__(self, idx):
+        if self.shuffle:
+            order = np.arange(idx * self.batch_size,
+                              min((idx + 1) * self.batch_size, len(self.windows)))
+            multiplier, offset = epoch_permutation(self.seed, self.epoch, len(self.windows))
+            # Sorted, the rows of a batch are read from the memmap front to back
+            windows = self.windows[np.sort(affine_permute(order, multiplier, offset,
+                                                          len(self.windows)))]
+        else:
+            windows = self.windows[idx * self.batch_size:(idx + 1) * self.batch_size]
+        if self.sparse:
+            return windows[:, :-1], windows[:, -1:]
+        return windows_to_xy(windows, self.vocabulary_length)
+
+    def on_epoch_end(self):
+        self.epoch += 1
@@ -12,6 +12,17 @@ Example:
 
      $ python process_code.py /repos/source/folder /destination/file.py --twotothree --autopep8
 
+    The transformations run file by file on a pool of processes (-w, default
+    cpu count) and the results are streamed into the destination file as they
+    finish. The hash of every transformed file is kept in a manifest in the
+    source folder, so files that have not changed since the last run with the
+    same transformations are not transformed again. A file that one of the
+    transformations fails on is left as it was and retried on the next run.
+
+    --autopep8 and --yapf need the autopep8 and yapf packages. --twotothree
+    uses lib2to3, which is deprecated and was removed in Python 3.13, so it
+    needs Python 3.12 or older.
+
 Attributes:
     None
 
@@ -19,11 +30,17 @@ Todo:
     * 
 '''
 from argparse import ArgumentParser
-from subprocess import check_call
 import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import io
+import sys
 import tokenize
+from functools import partial
+
+MANIFEST = '.process_code_manifest.json'
 
 
 def main():
@@ -40,6 +57,8 @@ def main():
     parser.add_argument('--removecomments', action='store_true')
     parser.add_argument('--autopep8', action='store_true')
     parser.add_argument('--yapf', action='store_true')
+    parser.add_argument('-w', type=int, action='store', dest='n_workers',
+                        help='Number of processes (default cpu count)')
 
     settings = parser.parse_args()
 
@@ -50,31 +69,157 @@ def main():
     filelist = [f for f in glob.iglob(
         glob_search_path, recursive=True) if os.path.isfile(f)]
 
-    if settings.twotothree:
-        check_call(['2to3', '-n', '-w', settings.source])
-
-    if settings.removecomments:
-        for filename in filelist:
-            with io.open(filename, 'r+', encoding='latin-1', errors='ignore') as f:
-                print(filename)
-                text = f.read()
-                clean_text = remove_comments_and_docstrings(text)
-                f.seek(0)
-                f.write(clean_text)
+    transforms = [name for name in ('twotothree', 'removecomments', 'autopep8', 'yapf')
+                  if getattr(settings, name)]
+    try:
+        load_transforms(transforms)
+    except ImportError as e:
+        arg_error(parser, 'error: %s' % e)
 
-    if settings.autopep8:
-        check_call(['autopep8', '--in-place', '--recursive', settings.source])
+    manifest_path = os.path.join(settings.source, MANIFEST)
+    manifest = read_manifest(manifest_path, transforms)
 
-    if settings.yapf:
-        check_call(['autopep8', '--in-place', '--recursive', settings.source])
+    # The manifest is keyed by the path in the source folder, so it does not
+    # depend on the directory the command is run from
+    relative_paths = [os.path.relpath(filename, settings.source) for filename in filelist]
 
-    with io.open(settings.destination, 'w') as outfile:
-        for f in filelist[:10]:
-            with io.open(f, 'r', encoding='latin-1') as infile:
-                pad(settings.padding, '\x0b')
+    pool = multiprocessing.Pool(settings.n_workers or multiprocessing.cpu_count())
+    n_transformed = 0
+    n_failed = 0
+    try:
+        with io.open(settings.destination, 'w', encoding='latin-1') as outfile:
+            tasks = [(filename, manifest['files'].get(relative))
+                     for filename, relative in zip(filelist, relative_paths)]
+            results = pool.imap(partial(process_file, transforms=transforms),
+                                tasks, chunksize=16)
+            for relative, (filename, text, digest, transformed) in zip(relative_paths,
+                                                                       results):
                 outfile.write(pad(settings.padding, '\x0b') +
-                              infile.read() +
-                              pad(settings.padding, '\x0c'))
+                              text +
+                              pad(settings.end_padding, '\x0c'))
+                if digest is None:
+                    manifest['files'].pop(relative, None)
+                    n_failed += 1
+                else:
+                    manifest['files'][relative] = digest
+                    n_transformed += transformed
+    finally:
+        pool.close()
+        pool.join()
+        write_manifest(manifest_path, manifest)
+
+    print('Transformed %d of %d files, %d failed and will be retried' %
+          (n_transformed, len(filelist), n_failed))
+
+
+def read_manifest(manifest_path, transforms):
+    '''Load the hashes of the files processed by an earlier run with the same
+    transformations'''
+    if os.path.isfile(manifest_path):
+        with io.open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['transforms'] == transforms:
+            return manifest
+    return {'transforms': transforms, 'files': {}}
+
+
+def write_manifest(manifest_path, manifest):
+    '''Save the hashes of the processed files'''
+    with io.open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def content_hash(text):
+    '''Hash of a file's contents'''
+    return hashlib.sha1(text.encode('latin-1', 'ignore')).hexdigest()
+
+
+def process_file(task, transforms):
+    '''Apply the transformations to a file in place, unless the file still has
+    the hash it was given when last processed. task is a (file name, previous
+    hash) pair. Returns the file name, its processed text, the hash of the
+    processed text and whether it was transformed. When a transformation
+    fails the file is left unchanged and the hash is None, so it is retried'''
+    filename, previous_digest = task
+    with io.open(filename, 'r', encoding='latin-1', errors='ignore') as f:
+        text = f.read()
+
+    digest = content_hash(text)
+    if not transforms or previous_digest == digest:
+        return filename, text, digest, False
+
+    clean_text, failed = transform_source(text, transforms, filename)
+    if failed:
+        return filename, clean_text, None, False
+    if clean_text != text:
+        with io.open(filename, 'w', encoding='latin-1', errors='ignore') as f:
+            f.write(clean_text)
+
+    return filename, clean_text, content_hash(clean_text), True
+
+
+def load_transforms(transforms):
+    '''Import the packages the named transformations need
+
+    Raises:
+        ImportError: a package is not installed, or lib2to3 was removed from
+            this version of Python
+    '''
+    for name in transforms:
+        try:
+            if name == 'twotothree':
+                import lib2to3.refactor
+            elif name == 'autopep8':
+                import autopep8
+            elif name == 'yapf':
+                import yapf.yapflib.yapf_api
+        except ImportError as e:
+            raise ImportError('--%s needs a module that is not installed: %s' % (name, e))
+
+
+def transform_source(text, transforms, filename='<string>'):
+    '''Apply the named transformations to the source text in order. A
+    transformation that fails on a file leaves the text as it was before it.
+    Returns the text and the names of the transformations that failed'''
+    failed = []
+    for name in transforms:
+        try:
+            if name == 'twotothree':
+                text = two_to_three(text, filename)
+            elif name == 'removecomments':
+                text = remove_comments_and_docstrings(text)
+            elif name == 'autopep8':
+                import autopep8
+                text = autopep8.fix_code(text)
+            elif name == 'yapf':
+                from yapf.yapflib.yapf_api import FormatCode
+                text = FormatCode(text)[0]
+        except Exception as e:
+            print('%s: %s failed: %s' % (filename, name, e))
+            failed.append(name)
+    return text, failed
+
+
+_refactoring_tool = None
+
+
+def two_to_three(text, filename='<string>'):
+    '''Convert Python 2 source to Python 3 with the 2to3 fixers. lib2to3 is
+    deprecated and was removed in Python 3.13, where this raises ImportError'''
+    global _refactoring_tool
+    if _refactoring_tool is None:
+        from lib2to3.refactor import RefactoringTool, get_fixers_from_package
+        _refactoring_tool = RefactoringTool(get_fixers_from_package('lib2to3.fixes'))
+
+    if not text.endswith('\n'):
+        text += '\n'
+    return str(_refactoring_tool.refactor_string(text, filename))
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
 
 
 def pad(n, padding):
@@ -90,7 +235,7 @@ def n_pad(text, n, padding='\x0b'):
 def remove_comments_and_docstrings(source):
     '''Strip comments and docstings from source'''
     io_obj = io.StringIO(source)
-    out = ""
+    out = []
     prev_toktype = tokenize.INDENT
     last_lineno = -1
     last_col = 0
@@ -107,7 +252,7 @@ def remove_comments_and_docstrings(source):
         if start_line > last_lineno:
             last_col = 0
         if start_col > last_col:
-            out += (" " * (start_col - last_col))
+            out.append(" " * (start_col - last_col))
         # Remove comments:
         if token_type == tokenize.COMMENT:
             pass
@@ -124,7 +269,7 @@ def remove_comments_and_docstrings(source):
                     # Catch whole-module docstrings:
                     if start_col > 0:
                         # Unlabelled indentation means we're inside an operator
-                        out += token_string
+                        out.append(token_string)
                     # Note regarding the INDENT token: The tokenize module does
                     # not label indentation inside of an operator (parens,
                     # brackets, and curly braces) as actual indentation.
@@ -135,11 +280,11 @@ def remove_comments_and_docstrings(source):
                     #         "The spaces before this string do not get a token"
                     #     ]
         else:
-            out += token_string
+            out.append(token_string)
         prev_toktype = token_type
         last_col = end_col
         last_lineno = end_line
-    return out
+    return ''.join(out)
 
 
 def remove_last_n_lines(file, number=2):
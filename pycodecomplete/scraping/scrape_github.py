@@ -15,6 +15,14 @@ Example:
 
      $ python scrape_github.py -t 123456789abcdefghi /cloned/repos/destination/folder 1000
 
+    Repositories are cloned by a pool of workers (-w, default 8), shallow and
+    with only their .py files checked out. Every finished clone is recorded in
+    clone_manifest.jsonl in the destination folder, so running the command
+    again resumes an interrupted run. To resume from the repo_list.csv of an
+    earlier run without querying the API again:
+
+     $ python scrape_github.py -l repo_list.csv /cloned/repos/destination/folder 1000
+
 Attributes:
     None
 
@@ -24,9 +32,13 @@ Todo:
 import os
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import io
 import json
 import requests
 import math
+import shutil
+import time
 import pandas as pd
 
 from git import Repo
@@ -42,9 +54,21 @@ def main():
                         help='GitHub API OAuth token')
     parser.add_argument('-f', action='store', dest='token_file',
                         help='File containing GitHub API OAuth token')
+    parser.add_argument('-l', action='store', dest='repo_list',
+                        help='Clone the repos in an existing repo_list.csv instead of querying GitHub')
+    parser.add_argument('-w', type=int, default=8, action='store', dest='n_workers',
+                        help='Number of repos cloned at the same time')
+    parser.add_argument('-r', type=int, default=3, action='store', dest='retries',
+                        help='Number of times a failed clone is retried')
 
     settings = parser.parse_args()
 
+    if settings.repo_list:
+        repos_df = pd.read_csv(settings.repo_list, index_col=0).head(settings.count)
+        clone_repos_from_df(settings.destination, repos_df,
+                            n_workers=settings.n_workers, retries=settings.retries)
+        return
+
     if settings.token_file:
         try:
             with open(settings.token_file, 'r') as f:
@@ -68,7 +92,8 @@ def main():
     repos_df = df_from_query(token, settings.count, batch_size=100)
     repos_df.to_csv('repo_list.csv')
 
-    clone_repos_from_df(settings.destination, repos_df)
+    clone_repos_from_df(settings.destination, repos_df,
+                        n_workers=settings.n_workers, retries=settings.retries)
 
 
 def json_query(batch_size, after_cursor=''):
@@ -172,27 +197,105 @@ def df_from_query(token, n, batch_size=10):
     return result
 
 
-def clone_repos_from_df(to_path, repos_df):
-    '''Clone all the repositories from the dataframe to a specified path
+def clone_repo(url, path, retries=3, backoff=2.0):
+    '''Shallow clone a repository with only its .py files checked out. Failed
+    attempts are retried after an exponentially growing pause
+
+    Args:
+        url (String): The repository url, or the path of a local repository
+        path (String): The path to clone the repository to
+        retries (int): Number of times a failed clone is retried
+        backoff (float): Seconds to wait before the first retry
+
+    Returns:
+        int: Number of attempts the clone took
+    '''
+    for attempt in range(retries + 1):
+        try:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            repo = Repo.clone_from(url, path, depth=1, filter='blob:none', sparse=True)
+            repo.git.sparse_checkout('set', '--no-cone', '*.py')
+            remove_non_py_files(path)
+            return attempt + 1
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def remove_non_py_files(path):
+    '''Delete every file that is not a .py file under path, except the
+    repository's own .git folder'''
+    for root, dirs, files in os.walk(path):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        for name in files:
+            if not name.endswith(('.py')):
+                os.remove(os.path.join(root, name))
+
+
+def read_manifest(manifest_path):
+    '''Return the latest manifest record of every repository as a dictionary
+    keyed by nameWithOwner'''
+    records = {}
+    if os.path.isfile(manifest_path):
+        with io.open(manifest_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record['nameWithOwner']] = record
+    return records
+
+
+def clone_repos_from_df(to_path, repos_df, n_workers=8, retries=3, backoff=2.0,
+                        manifest='clone_manifest.jsonl'):
+    '''Clone all the repositories from the dataframe to a specified path with a
+    pool of workers. Finished clones are appended to a manifest in to_path, and
+    repositories already recorded as cloned are skipped, so an interrupted run
+    resumes where it stopped
 
     Args:
         to_path (String): The path to clone the repositories to
         repos_df (dataframe): The dataframe containing repository metadata
+        n_workers (int): Number of repositories cloned at the same time
+        retries (int): Number of times a failed clone is retried
+        backoff (float): Seconds to wait before the first retry
+        manifest (String): File name of the manifest in to_path
 
     Returns:
         None
     '''
-    n = repos_df.shape[0]
-    for i, row in repos_df.iterrows():
-        path = os.path.join(to_path, row['nameWithOwner'])
-        print('Cloning repo %d/%d to %s' % (i+1, n, path))
-        Repo.clone_from(row['url'], path)
-
-        # Delete non-.py files
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                if not name.endswith(('.py')):
-                    os.remove(os.path.join(root, name))
+    os.makedirs(to_path, exist_ok=True)
+    manifest_path = os.path.join(to_path, manifest)
+    cloned = set(name for name, record in read_manifest(manifest_path).items()
+                 if record['status'] == 'cloned')
+    rows = [row for _, row in repos_df.iterrows()
+            if row['nameWithOwner'] not in cloned]
+
+    n = len(rows)
+    print('Cloning %d repos, %d already cloned' % (n, len(cloned)))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, \
+            io.open(manifest_path, 'a') as manifest_file:
+        futures = {executor.submit(clone_repo, row['url'],
+                                   os.path.join(to_path, row['nameWithOwner']),
+                                   retries, backoff): row
+                   for row in rows}
+
+        for i, future in enumerate(as_completed(futures)):
+            row = futures[future]
+            record = {'nameWithOwner': row['nameWithOwner'], 'url': row['url']}
+            try:
+                record['attempts'] = future.result()
+                record['status'] = 'cloned'
+            except Exception as e:
+                record['status'] = 'failed'
+                record['error'] = str(e)
+
+            manifest_file.write(json.dumps(record) + '\n')
+            manifest_file.flush()
+            print('Repo %d/%d %s %s' % (i + 1, n, record['status'], row['nameWithOwner']))
 
 
 if __name__ == '__main__':
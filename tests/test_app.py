@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''Tests of the webapp on a random weight archive'''
+import sys
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from benchmarks.synthetic import random_archive
+from pycodecomplete.ml.process_text import CharVectorizer
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    archive = str(tmp_path_factory.mktemp('archive'))
+    random_archive(archive, vocabulary_size=len(CharVectorizer().tokens), units=32)
+    argv = sys.argv
+    sys.argv = ['app.py', archive, '5']
+    try:
+        from webapp import app
+    finally:
+        sys.argv = argv
+    app.load_objects()
+    return app
+
+
+def test_stream_closed_before_the_first_chunk_cancels_the_completion(app, monkeypatch):
+    monkeypatch.setattr(app.settings, 'predict_n', 10 ** 6)
+    # Call the WSGI app directly, as the test client reads the first chunk
+    environ = EnvironBuilder(path='/predict_stream', method='POST',
+                             json={'text': 'import os', 'session': 'a'}).get_environ()
+    statuses = []
+    app_iter = app.app(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ['200 OK']
+    assert app.server.served.in_flight == 1
+    request = app.server.served.worker.latest['a']
+
+    app_iter.close()
+    assert request.cancelled
+    assert request.done.wait(5)
+    assert app.server.served.in_flight == 0
+
+
+def test_stream_read_to_the_end_releases_the_model(app):
+    response = app.app.test_client().post('/predict_stream',
+                                          json={'text': 'import os', 'session': 'b'})
+    assert 'event: done' in response.get_data(as_text=True)
+    assert app.server.served.in_flight == 0
+
+
+def test_failed_model_load_is_reported_by_ready(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app.server, 'reload_error', None)
+    monkeypatch.setattr(app.settings, 'model_file', str(tmp_path / 'missing.h5'))
+    with pytest.raises(Exception):
+        app.load_objects()
+
+    response = app.app.test_client().get('/ready')
+    assert 'missing.h5' in response.get_json()['reload_error']
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+'''Tests of the completion cache'''
+from webapp.cache import CompletionCache
+
+
+def generator(calls):
+    def generate(text, n, diversity):
+        calls.append((text, n))
+        return ''.join(chr(ord('a') + (len(text) + i) % 26) for i in range(n))
+    return generate
+
+
+def test_maxsize_counts_completions_not_prefixes():
+    calls = []
+    cache = CompletionCache(maxsize=6, window_length=10)
+    for text in ['one', 'two', 'three']:
+        cache.complete(text, 25, 0.1, generator(calls))
+    assert cache.stats()['entries'] == 3
+    assert len(calls) == 3
+
+    # Every completion is still cached, and so are the windows typed into them
+    for text in ['one', 'two', 'three']:
+        completion = cache.complete(text, 25, 0.1, generator(calls))
+        assert cache.complete(text + completion[:4], 25, 0.1, generator(calls))[:21] == \
+            completion[4:]
+    assert len(calls) == 6
+    assert cache.stats()['prefix_hits'] == 3
+
+
+def test_evicted_completion_takes_its_prefixes():
+    calls = []
+    cache = CompletionCache(maxsize=1, window_length=10)
+    first = cache.complete('one', 5, 0.1, generator(calls))
+    cache.complete('two', 5, 0.1, generator(calls))
+    assert cache.stats()['entries'] == 1
+    assert all(owner[0] == 'two' for owner, _ in cache.prefixes.values())
+
+    cache.complete('one' + first[:2], 5, 0.1, generator(calls))
+    assert calls[-1] == ('one' + first[:2], 5)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''Tests of decoding with CodeGenerator on a random NumpyLSTM'''
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import random_archive
+from pycodecomplete.ml.code_generation import CodeGenerator
+from pycodecomplete.ml.numpy_lstm import NumpyLSTM
+from pycodecomplete.ml.process_text import CharVectorizer
+
+PROMPTS = ['import os\nfrom sys import', 'def f(x):\n    return', 'class A(']
+
+
+@pytest.fixture(scope='module')
+def code_gen(tmp_path_factory):
+    archive = str(tmp_path_factory.mktemp('archive'))
+    random_archive(archive, vocabulary_size=len(CharVectorizer().tokens), units=32)
+    return CodeGenerator(NumpyLSTM(archive), CharVectorizer(sequence_length=20))
+
+
+def assert_same_beams(beams, expected):
+    assert [completion for completion, _ in beams] == [completion for completion, _ in expected]
+    assert np.allclose([score for _, score in beams], [score for _, score in expected],
+                       rtol=1e-4)
+
+
+def test_stacked_beam_searches_match_one_at_a_time(code_gen):
+    ns = [5, 3, 0]
+    beam_widths = [2, 4, 3]
+    stacked = code_gen.predict_beams(PROMPTS, ns, beam_widths)
+    for prompt, n, beam_width, beams in zip(PROMPTS, ns, beam_widths, stacked):
+        assert_same_beams(beams, code_gen.predict_beam(prompt, n, beam_width))
+
+    prompt_states = code_gen.prompt_states(PROMPTS)
+    from_states = code_gen.predict_beams(PROMPTS, ns, beam_widths, prompt_states=prompt_states)
+    for beams, expected in zip(from_states, stacked):
+        assert_same_beams(beams, expected)
+
+
+def test_cancelled_beam_search_stops_alone(code_gen):
+    beams = code_gen.predict_beams(PROMPTS[:2], [6, 6], [3, 3],
+                                   cancelled=lambda row: row == 1)
+    assert all(len(completion) == 6 for completion, _ in beams[0])
+    assert all(len(completion) == 1 for completion, _ in beams[1])
+    assert_same_beams(beams[0], code_gen.predict_beam(PROMPTS[0], 6, 3))
+
+
+def test_cached_prompts_are_fed_together(code_gen):
+    cached = code_gen.prompt_states(PROMPTS + ['x = '])
+    texts = [PROMPTS[0] + ' sys', PROMPTS[1] + ' x', PROMPTS[2] + 'B', 'y = 1']
+    together = code_gen.prompt_states(texts, cached)
+    assert [prompt_state.steps for prompt_state in together] == [4, 2, 1, 0]
+
+    for text, state, prompt_state in zip(texts[:3], cached, together):
+        decoder = code_gen.model.decoder(1)
+        decoder.set_states(state.states)
+        indices = code_gen.char_vectorizer.encode(text[len(state.text):])
+        assert np.allclose(prompt_state.preds, decoder.step(indices[np.newaxis])[0], atol=1e-6)
+        for row, expected in zip(prompt_state.states, decoder.get_states()):
+            assert row.shape == expected.shape
+            assert np.allclose(row, expected, atol=1e-6)
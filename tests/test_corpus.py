@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''Tests of loading a corpus built by make_corpus.py'''
+import os
+
+import numpy as np
+import pytest
+
+from pycodecomplete.ml.codetovec import CORPUS_CACHE, PyCodeVectors
+from pycodecomplete.ml.file_index import MANIFEST
+
+
+def test_corpus_needs_the_same_sequence_length(tmp_path):
+    source = tmp_path / 'repos'
+    source.mkdir()
+    (source / 'a.py').write_text('import os\nprint(os.sep)\n')
+    (source / 'b.py').write_text('x = 1\n')
+    PyCodeVectors(sequence_length=10).build_corpus(str(source), str(tmp_path / 'corpus'),
+                                                   processes=1)
+
+    vectors = PyCodeVectors(sequence_length=10)
+    vectors.fit(str(tmp_path / 'corpus'))
+    assert vectors.n_files == 2
+
+    with pytest.raises(ValueError, match='padded for sequences of 10'):
+        PyCodeVectors(sequence_length=20).fit(str(tmp_path / 'corpus'))
+
+
+def test_windows_sample_every_file_without_crossing_files():
+    rng = np.random.default_rng(0)
+    vectors = PyCodeVectors(sequence_length=5)
+    lengths = rng.integers(0, 50, size=40)
+    starts = np.cumsum(np.concatenate([[0], lengths[:-1] + 5])) + 5
+    vectors.file_offsets = np.stack([starts, starts + lengths], axis=1).astype(np.int64)
+    vectors.source_indices = rng.integers(0, 100, size=int(starts[-1] + lengths[-1])).astype(np.uint8)
+    mask = rng.random(40) < 0.3
+
+    targets = np.concatenate([np.arange(start, end)
+                              for start, end in vectors.file_offsets[mask]])
+    every = vectors.source_indices[targets[:, np.newaxis] + np.arange(-5, 1)]
+    assert np.array_equal(vectors.windows(mask), every)
+
+    kept = np.linspace(0, len(targets) - 1, 7).astype(np.int64)
+    assert np.array_equal(vectors.windows(mask, max_windows=7), every[kept])
+    assert vectors.windows(np.zeros(40, dtype=bool)).shape == (0, 6)
+
+
+def test_fit_reuses_the_cached_corpus_until_a_file_changes(tmp_path):
+    (tmp_path / 'a.py').write_text('import os\n')
+    (tmp_path / 'b.py').write_text('x = 1\n')
+    cached = tmp_path / (CORPUS_CACHE % 10 + '.bin')
+
+    first = PyCodeVectors(sequence_length=10)
+    first.fit(str(tmp_path))
+    built = cached.stat().st_mtime_ns
+    assert first.n_files == 2 and first.source_length == 10 + 10 + 10 + 6
+
+    second = PyCodeVectors(sequence_length=10)
+    second.fit(str(tmp_path))
+    assert cached.stat().st_mtime_ns == built
+    assert np.array_equal(second.source_indices, first.source_indices)
+    assert second.file_list == [str(tmp_path / 'a.py'), str(tmp_path / 'b.py')]
+
+    (tmp_path / 'b.py').write_text('y = 22\n')
+    third = PyCodeVectors(sequence_length=10)
+    third.fit(str(tmp_path))
+    start, end = third.file_offsets[1]
+    assert np.array_equal(third.source_indices[start:end], third.encode('y = 22\n'))
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_tbptt_schedule_skips_empty_files(batch_size):
+    vectors = PyCodeVectors(sequence_length=4)
+    lengths = np.array([8, 0, 3, 0])
+    starts = np.cumsum(np.concatenate([[0], lengths[:-1] + 4])) + 4
+    vectors.file_offsets = np.stack([starts, starts + lengths], axis=1).astype(np.int64)
+
+    starts, chunk_lengths, resets = vectors.tbptt_schedule(batch_size)
+    assert chunk_lengths.sum() == lengths.sum()
+    assert resets.sum() == 2
+
+
+def test_crlf_files_are_indexed_as_the_corpus_reads_them(tmp_path):
+    (tmp_path / 'a.py').write_bytes(b'x = 1\r\ny = 2\r\n')
+    vectors = PyCodeVectors(sequence_length=4)
+    file_index = vectors.file_index(str(tmp_path)).refresh(processes=1)
+    vectors.fit(str(tmp_path), file_index=file_index)
+    start, end = vectors.file_offsets[0]
+    assert file_index.source_length == end - start == len('x = 1\ny = 2\n')
+
+
+def test_read_only_source_is_cached_elsewhere(tmp_path, monkeypatch):
+    source = tmp_path / 'repos'
+    source.mkdir()
+    (source / 'a.py').write_text('import os\n')
+    monkeypatch.setattr('os.access', lambda path, mode: False)
+
+    vectors = PyCodeVectors(sequence_length=10, cache_directory=str(tmp_path / 'cache'))
+    vectors.fit(str(source))
+    assert os.listdir(str(source)) == ['a.py']
+    assert (tmp_path / 'cache' / MANIFEST).exists()
+
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    PyCodeVectors(sequence_length=10).fit(str(source))
+    assert os.listdir(str(source)) == ['a.py']
+    assert len(os.listdir(str(tmp_path / 'home' / '.cache' / 'pycodecomplete'))) == 1
+
+
+def test_data_generator_without_eligible_targets_raises():
+    vectors = PyCodeVectors(sequence_length=4)
+    vectors.source_indices = vectors.encode(' ' * 12)
+    vectors.source_length = len(vectors.source_indices)
+    with pytest.raises(ValueError):
+        next(vectors.data_generator(2, ignore=[' ']))
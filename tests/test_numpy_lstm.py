@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''Parity of the NumPy inference engine with the LSTM computed as Keras 2.2 does'''
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import random_archive
+from pycodecomplete.ml.numpy_lstm import CONFIG, NumpyLSTM
+
+VOCABULARY_SIZE = 40
+
+
+def sharpened_archive(path, embedding_dim):
+    '''Write a random archive with weights and biases large enough to saturate
+    the gates and spread the probabilities, so a wrong gate shows'''
+    random_archive(path, vocabulary_size=VOCABULARY_SIZE, units=16,
+                   embedding_dim=embedding_dim, seed=3)
+    rng = np.random.default_rng(1)
+    for name in os.listdir(path):
+        if name.endswith('.npy'):
+            weight = np.load(os.path.join(path, name))
+            weight = 4 * weight + rng.normal(0, 0.5, size=weight.shape)
+            np.save(os.path.join(path, name), weight.astype(np.float32))
+
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+
+def reference_model(path):
+    '''Return a function of a (batch, timesteps) window of token indices that
+    returns the next character probabilities after every timestep, computed
+    in float64 from the archive files with the gates in Keras order i, f, c, o'''
+    with io.open(os.path.join(path, CONFIG), 'r') as infile:
+        layers = json.load(infile)['layers']
+    weights = [[np.load(os.path.join(path, name)).astype(np.float64)
+                for name in layer['weights']] for layer in layers]
+
+    def run(x):
+        if layers[0]['class_name'] == 'Embedding':
+            inputs = weights[0][0][x]
+        else:
+            inputs = np.eye(VOCABULARY_SIZE)[x]
+        for layer, layer_weights in zip(layers, weights):
+            if layer['class_name'] != 'LSTM':
+                continue
+            kernel, recurrent_kernel, bias = layer_weights
+            units = layer['config']['units']
+            h = np.zeros((len(x), units))
+            c = np.zeros((len(x), units))
+            outputs = []
+            for t in range(x.shape[1]):
+                z = inputs[:, t] @ kernel + h @ recurrent_kernel + bias
+                i = hard_sigmoid(z[:, :units])
+                f = hard_sigmoid(z[:, units:2 * units])
+                o = hard_sigmoid(z[:, 3 * units:])
+                c = f * c + i * np.tanh(z[:, 2 * units:3 * units])
+                h = o * np.tanh(c)
+                outputs.append(h)
+            inputs = np.stack(outputs, axis=1)
+
+        kernel, bias = weights[-2]
+        logits = inputs @ kernel + bias
+        logits -= logits.max(axis=-1, keepdims=True)
+        return np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True)
+
+    return run
+
+
+@pytest.mark.parametrize('embedding_dim', [None, 8])
+def test_numpy_lstm_matches_the_reference(tmp_path, embedding_dim):
+    sharpened_archive(str(tmp_path), embedding_dim)
+    engine = NumpyLSTM(str(tmp_path))
+    reference = reference_model(str(tmp_path))
+
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, VOCABULARY_SIZE, size=(3, 30), dtype=np.uint8)
+    expected = reference(x)
+    assert np.allclose(engine.predict(x), expected[:, -1], rtol=1e-4, atol=1e-6)
+
+    decoder = engine.decoder(3)
+    assert np.allclose(decoder.warm(x[:, :20]), expected[:, 19], rtol=1e-4, atol=1e-6)
+    for t in range(20, 25):
+        assert np.allclose(decoder.step(x[:, t:t + 1]), expected[:, t], rtol=1e-4, atol=1e-6)
+    assert np.allclose(decoder.step(x[:, 25:]), expected[:, -1], rtol=1e-4, atol=1e-6)
+
+    states = decoder.get_states()
+    preds = decoder.step(x[:, :4])
+    decoder.set_states(states)
+    assert np.array_equal(decoder.step(x[:, :4]), preds)
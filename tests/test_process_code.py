@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''Tests of the incremental cleanup of the scraped code'''
+import json
+import sys
+
+import pytest
+
+from pycodecomplete.scraping import process_code
+
+
+def run(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', ['process_code.py'] + list(args))
+    process_code.main()
+    return capsys.readouterr().out.splitlines()[-1]
+
+
+def test_manifest_is_relative_to_the_source_folder(tmp_path, monkeypatch, capsys):
+    source = tmp_path / 'repos'
+    (source / 'pkg').mkdir(parents=True)
+    (source / 'pkg' / 'a.py').write_text('x = 1  # one\n')
+    (source / 'b.py').write_text('y = 2\n')
+
+    monkeypatch.chdir(tmp_path)
+    assert run(monkeypatch, capsys, 'repos', 'out.py', '--removecomments', '-w', '1') == \
+        'Transformed 2 of 2 files, 0 failed and will be retried'
+    with open(str(source / process_code.MANIFEST)) as f:
+        assert sorted(json.load(f)['files']) == ['b.py', 'pkg/a.py']
+
+    monkeypatch.chdir(source)
+    assert run(monkeypatch, capsys, '.', str(tmp_path / 'out.py'), '--removecomments',
+               '-w', '1') == 'Transformed 0 of 2 files, 0 failed and will be retried'
+
+
+def test_failed_transform_is_retried(tmp_path, monkeypatch):
+    (tmp_path / 'a.py').write_text('print "old"\n')
+
+    def fail(text, filename):
+        raise RuntimeError('cannot convert')
+
+    monkeypatch.setattr(process_code, 'two_to_three', fail)
+    task = (str(tmp_path / 'a.py'), None)
+    filename, text, digest, transformed = process_code.process_file(
+        task, ['removecomments', 'twotothree'])
+    assert digest is None and not transformed
+    assert (tmp_path / 'a.py').read_text() == 'print "old"\n'
+
+
+def test_missing_tool_is_an_error(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'autopep8', None)
+    with pytest.raises(ImportError, match='--autopep8'):
+        process_code.load_transforms(['removecomments', 'autopep8'])
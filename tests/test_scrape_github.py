@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+'''Offline tests of the resumable cloning in scrape_github.py, against local
+bare repositories instead of GitHub'''
+import io
+import json
+import os
+import subprocess
+
+import pandas as pd
+
+from pycodecomplete.scraping.scrape_github import clone_repos_from_df, read_manifest
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(*args, cwd=None):
+    subprocess.run(('git',) + args, cwd=cwd, env=GIT_ENV, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bare_repo(tmp_path, name):
+    '''Create a bare repository with a .py file and a README, return its url'''
+    work = tmp_path / 'work' / name
+    work.mkdir(parents=True)
+    git('init', '-q', cwd=work)
+    (work / 'module.py').write_text('import os\n')
+    (work / 'README.md').write_text('# %s\n' % name)
+    git('add', '.', cwd=work)
+    git('commit', '-q', '-m', 'initial', cwd=work)
+    bare = tmp_path / 'bare' / (name + '.git')
+    git('clone', '-q', '--bare', str(work), str(bare))
+    return bare.as_uri()
+
+
+def test_clone_into_fresh_folder_and_resume(tmp_path):
+    repos_df = pd.DataFrame({'nameWithOwner': ['owner/first', 'owner/second', 'owner/missing'],
+                             'url': [bare_repo(tmp_path, 'first'),
+                                     bare_repo(tmp_path, 'second'),
+                                     (tmp_path / 'bare' / 'missing.git').as_uri()]})
+    destination = tmp_path / 'not' / 'created' / 'yet'
+
+    clone_repos_from_df(str(destination), repos_df, n_workers=2, retries=0, backoff=0)
+
+    records = read_manifest(str(destination / 'clone_manifest.jsonl'))
+    assert {name: record['status'] for name, record in records.items()} == {
+        'owner/first': 'cloned', 'owner/second': 'cloned', 'owner/missing': 'failed'}
+    assert records['owner/first']['attempts'] == 1
+    assert 'error' in records['owner/missing']
+    for name in ('first', 'second'):
+        # The clone is still a readable git repository
+        git('rev-parse', 'HEAD', cwd=destination / 'owner' / name)
+        git('status', cwd=destination / 'owner' / name)
+        assert (destination / 'owner' / name / 'module.py').read_text() == 'import os\n'
+        assert not (destination / 'owner' / name / 'README.md').exists()
+
+    # A rerun leaves the finished clones alone and only retries the failure
+    marker = destination / 'owner' / 'first' / 'marker.py'
+    marker.write_text('')
+    clone_repos_from_df(str(destination), repos_df, n_workers=2, retries=0, backoff=0)
+
+    assert marker.exists()
+    with io.open(str(destination / 'clone_manifest.jsonl')) as manifest:
+        rerun = [json.loads(line) for line in manifest][3:]
+    assert [record['nameWithOwner'] for record in rerun] == ['owner/missing']
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''Tests of the per-epoch affine permutation of the training windows'''
+import math
+
+import numpy as np
+import pytest
+
+from pycodecomplete.ml.char_encoding import affine_permute
+
+
+def coprime_multiplier(n, seed):
+    '''A multiplier close to n that is coprime with n, as WindowSequence picks them'''
+    multiplier = n - 1 - np.random.default_rng(seed).integers(0, min(1000, n - 2))
+    while math.gcd(int(multiplier), n) != 1:
+        multiplier -= 1
+    return int(multiplier)
+
+
+@pytest.mark.parametrize('n', [1, 2, 97, 1000003])
+def test_affine_permute_is_a_bijection(n):
+    for seed in range(3):
+        multiplier = coprime_multiplier(n, seed) if n > 2 else 1
+        order = affine_permute(np.arange(n), multiplier, seed % n, n)
+        assert np.array_equal(np.sort(order), np.arange(n))
+
+
+@pytest.mark.parametrize('n', [2 ** 32 + 15, 3 * 2 ** 33 + 7, 2 ** 40 + 99])
+def test_affine_permute_is_exact_above_32_bits(n):
+    '''The products of indices and multipliers close to n do not fit in
+    uint64, so this checks every value against exact integer arithmetic.
+    With a multiplier coprime to n, exact values make every epoch a bijection'''
+    rng = np.random.default_rng(0)
+    multiplier = coprime_multiplier(n, 1)
+    offset = int(rng.integers(0, n))
+    order = np.concatenate([np.arange(1000), n - 1 - np.arange(1000),
+                            rng.integers(0, n, size=10000)])
+
+    permuted = affine_permute(order, multiplier, offset, n)
+
+    expected = [(int(i) * multiplier + offset) % n for i in order]
+    assert permuted.dtype == np.int64
+    assert permuted.tolist() == expected
+    assert len(np.unique(permuted)) == len(np.unique(order))
+
+
+def test_window_sequence_positions_are_a_bijection():
+    window_sequence = pytest.importorskip('window_sequence')
+
+    def sequence(file_lengths, batch_size, epoch):
+        starts = np.concatenate([[0], np.cumsum(file_lengths)[:-1]]) + 10 * np.arange(len(file_lengths))
+        offsets = np.stack([starts, starts + file_lengths], axis=1).astype(np.int64)
+        return window_sequence.WindowSequence(np.zeros(0, dtype=np.uint8), offsets, 10,
+                                              batch_size, 4, seed=3, epoch=epoch), offsets
+
+    # Every window of a small corpus is served once per epoch
+    for epoch in range(3):
+        small, offsets = sequence(np.array([1000, 3, 2997]), 100, epoch)
+        positions = np.concatenate([small.positions(i) for i in range(len(small))])
+        expected = np.concatenate([np.arange(start, end) for start, end in offsets])
+        assert np.array_equal(np.sort(positions), expected)
+
+    # Positions of a corpus of more than 2 ** 32 windows match exact arithmetic
+    large, offsets = sequence(np.array([2 ** 32, 2 ** 33 + 5]), 512, 1)
+    multiplier, offset = large.permutation(1)
+    for idx in (0, 12345, len(large) - 1):
+        order = [(i * multiplier + offset) % large.n_windows
+                 for i in range(idx * 512, (idx + 1) * 512)]
+        expected = [i if i < 2 ** 32 else offsets[1, 0] + i - 2 ** 32 for i in order]
+        assert large.positions(idx).tolist() == expected
+
+
+def test_cached_window_sequence_shuffles_every_window_once():
+    window_sequence = pytest.importorskip('window_sequence')
+    windows = np.arange(1003 * 3, dtype=np.int64).reshape(1003, 3)
+    cached = window_sequence.CachedWindowSequence(windows, 100, 5, sparse=True,
+                                                  shuffle=True, seed=1)
+    orders = []
+    for epoch in range(2):
+        rows = np.concatenate([cached[i][0][:, 0] for i in range(len(cached))]) // 3
+        assert np.array_equal(np.sort(rows), np.arange(1003))
+        orders.append(rows)
+        cached.on_epoch_end()
+    assert not np.array_equal(orders[0], np.arange(1003))
+    assert not np.array_equal(orders[0], orders[1])
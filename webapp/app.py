@@ -9,48 +9,202 @@ Example:
 
      $ python app.py /pickled/modelfile 25
 
+    Concurrent requests are decoded together in micro-batches. The batch size,
+    batching window, queue size and per-request timeout can be set with:
+
+     $ python app.py /pickled/modelfile 25 -b 8 -w 5 -q 64 -t 10
+
+    Completions are cached per model window; set the cache size with -c
+    (0 disables the cache). Cache counters are served at /stats.
+
+    By default the 4 best completions found by beam search fill prediction_1
+    to prediction_4. Set the beam width with -k; -k 1 samples a single
+    completion instead.
+
+    The model file can also be a weight archive written by
+    pycodecomplete/ml/export_model.py. It is served by the NumPy inference
+    engine, and Keras and TensorFlow are not imported:
+
+     $ python app.py /path/to/archive 25
+
+    The model is loaded and warmed up in the background as soon as the app
+    starts; /ready answers 503 until it can serve. Given a checkpoint folder,
+    such as the one make_model.py saves to, the newest checkpoint is served,
+    and with -r the folder is polled every few seconds and newer checkpoints
+    are swapped in without a restart:
+
+     $ python app.py /path/to/save/pickled/models 25 -r 60
+
+    Requests that send a session id continue from the decoder state of the
+    session's previous text, so each keystroke only feeds the newly typed
+    characters. Set the memory budget of the states in MB with -s (0
+    disables it) and the seconds an idle session is kept with -e. Hit rate
+    and saved timesteps are served at /stats.
+
+    /predict_stream takes the same JSON and answers with server-sent events,
+    one per group of decoded characters, followed by a done event with the
+    whole prediction. A newer request from the same session cancels the
+    older one at its next decoding step.
+
+    /metrics serves request and stage latency histograms, batch sizes and the
+    cache counters in the Prometheus text format. With -P,
+    /debug/profile?seconds=N traces the decoding with cProfile for N seconds
+    and answers with the most expensive functions:
+
+     $ python app.py /path/to/archive 25 -P
+     $ curl 'localhost:8080/debug/profile?seconds=10&sort=tottime'
+
 Attributes:
     None
 
 Todo:
     * 
 '''
+import json
+import os
 import sys
 import pdb
+import threading
+import time
+from contextlib import ExitStack
 sys.path.append('..')
 
-from flask import Flask, request, render_template, jsonify
-
-from keras.models import load_model
-from keras import Sequential
+from flask import Flask, Response, g, request, render_template, jsonify, stream_with_context
 
 from pycodecomplete.ml.process_text import CharVectorizer
-from pycodecomplete.ml.code_generation import CodeGenerator
+from webapp.batching import QueueFullError, SupersededError
+from webapp.cache import CompletionCache
+from webapp.metrics import Metrics
+from webapp.model_server import ModelServer, latest_checkpoint
 
 from argparse import ArgumentParser
 
-app = Flask(__name__.split('.')[0])
+app = Flask(__name__.split('.')[0], root_path=os.path.dirname(os.path.abspath(__file__)))
 
 parser = ArgumentParser(description='PyCodeComplete WebApp')
 parser.add_argument('model_file', action='store',
-                    help='Trained RNN model file')
+                    help='Trained RNN model file, weight archive, or folder of checkpoints')
 parser.add_argument('predict_n', type=int, action='store',
                     help='Number of characters to predict')
+parser.add_argument('-b', type=int, default=8, action='store', dest='batch_size',
+                    help='Most requests decoded together')
+parser.add_argument('-w', type=float, default=5, action='store', dest='batch_wait',
+                    help='Milliseconds to wait for more requests before decoding')
+parser.add_argument('-q', type=int, default=64, action='store', dest='queue_size',
+                    help='Pending requests accepted before new ones are rejected')
+parser.add_argument('-t', type=float, default=10, action='store', dest='timeout',
+                    help='Seconds a request may wait for its completion')
+parser.add_argument('-c', type=int, default=4096, action='store', dest='cache_size',
+                    help='Completions to cache, 0 to disable caching')
+parser.add_argument('-k', type=int, default=4, action='store', dest='beam_width',
+                    help='Completions returned by beam search, 1 to sample one completion')
+parser.add_argument('-r', type=float, default=0, action='store', dest='reload_interval',
+                    help='Seconds between checks of the checkpoint folder for a newer model, 0 to never reload')
+parser.add_argument('-s', type=float, default=64, action='store', dest='session_cache_mb',
+                    help='Megabytes of decoder states cached for all sessions in total, 0 to disable')
+parser.add_argument('-e', type=float, default=600, action='store', dest='session_ttl',
+                    help='Seconds the decoder states of an idle session are kept')
+parser.add_argument('-P', action='store_true', dest='profiling',
+                    help='Serve /debug/profile?seconds=N, which profiles the decoding with cProfile')
 settings = parser.parse_args()
 
-char_vec = None
-model = None
-code_gen = None
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+MAX_PROFILE_SECONDS = 60
+
+char_vec = CharVectorizer(sequence_length=100)
+metrics = Metrics()
+profiling = threading.Lock()
+cache = None
+if settings.cache_size > 0:
+    cache = CompletionCache(maxsize=settings.cache_size,
+                            window_length=char_vec.sequence_length)
+
+server = ModelServer(char_vec,
+                     max_batch_size=settings.batch_size,
+                     max_wait=settings.batch_wait / 1000.0,
+                     max_queue_size=settings.queue_size,
+                     beam_width=settings.beam_width,
+                     on_swap=cache.clear if cache is not None else None,
+                     session_cache_bytes=int(settings.session_cache_mb * 2 ** 20),
+                     session_ttl=settings.session_ttl,
+                     metrics=metrics)
 
 
-@app.before_first_request
 def load_objects():
-    global char_vec
-    global code_gen
-    global model
-    char_vec = CharVectorizer(sequence_length=100)
-    model = load_model(settings.model_file)
-    code_gen = CodeGenerator(model, char_vec)
+    '''Load and warm up the model, then watch its folder for newer checkpoints.
+    A failure is recorded in the server status, so /ready tells why no model
+    is served, and raised'''
+    try:
+        server.load(latest_checkpoint(settings.model_file))
+    except Exception as e:
+        server.reload_error = 'Loading %s failed: %r' % (settings.model_file, e)
+        print(server.reload_error)
+        raise
+    print('Model ready')
+    watch_checkpoints()
+
+
+def watch_checkpoints():
+    '''Watch the model folder for newer checkpoints if reloading is enabled'''
+    if settings.reload_interval > 0 and os.path.isdir(settings.model_file):
+        server.watch(settings.model_file, interval=settings.reload_interval)
+
+
+def generate(text, n, diversity, session=None, timings=None):
+    '''Decode n characters after text on the batching worker'''
+    with server.acquire() as served:
+        return served.worker.submit(text, n, diversity=diversity, timeout=settings.timeout,
+                                    session=session, timings=timings)
+
+
+def generate_beam(text, n, beam_width, session=None, timings=None):
+    '''Decode the beam_width best completions of n characters after text'''
+    with server.acquire() as served:
+        return served.worker.submit(text, n, timeout=settings.timeout, beam_width=beam_width,
+                                    session=session, timings=timings)
+
+
+def server_timing(timings):
+    '''Format the queue and decode seconds of a request as a Server-Timing header'''
+    return ', '.join('%s;dur=%.2f' % (name, 1000 * seconds)
+                     for name, seconds in sorted(timings.items()))
+
+
+def read_request(user_data):
+    '''Return the text and the session id, if any, of a /predict request'''
+    session = user_data.get('session')
+    if session is not None:
+        session = str(session)[:64]
+    return str(user_data['text']), session
+
+
+def parse_json():
+    '''Return the JSON body of the request, recording the time spent parsing it'''
+    started = time.perf_counter()
+    user_data = request.get_json()
+    metrics.observe('parse_json', time.perf_counter() - started)
+    return user_data
+
+
+def server_sent_event(data, event=None):
+    '''Format data as a server-sent event'''
+    lines = ['data: %s' % json.dumps(data)]
+    if event is not None:
+        lines.insert(0, 'event: %s' % event)
+    return '\n'.join(lines) + '\n\n'
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are timed until their headers are sent
+    metrics.observe_request(request.endpoint or 'unmatched', response.status_code,
+                            time.perf_counter() - g.started)
+    return response
 
 
 @app.route('/', methods=['GET'])
@@ -77,24 +231,189 @@ def submit():
 
 @app.route('/predict', methods=['POST'])
 def sub_pre_ajax():
-    user_data = request.json
-    text = str(user_data['text'])
-
-    prediction_1 = code_gen.predict_n_with_previous(
-        text, settings.predict_n, diversity=0.1)
-    # code_gen.predict_n_with_previous(text, 20, diversity=0.2)
-    prediction_2 = None
-    # code_gen.predict_n_with_previous(text, 20, diversity=0.5)
-    prediction_3 = None
-    # code_gen.predict_n_with_previous(text, 20, diversity=1.0)
-    prediction_4 = None
+    if not server.is_ready():
+        return jsonify({'error': 'Model is loading'}), 503
+
+    text, session = read_request(parse_json())
+    timings = {}
+
+    def session_generate(text, n, diversity):
+        return generate(text, n, diversity, session=session, timings=timings)
+
+    def session_generate_beam(text, n, beam_width):
+        return generate_beam(text, n, beam_width, session=session, timings=timings)
+
+    predictions = [None] * 4
+    try:
+        if settings.beam_width > 1:
+            if cache is None:
+                candidates = session_generate_beam(text, settings.predict_n, settings.beam_width)
+            else:
+                candidates = cache.complete_beam(text, settings.predict_n,
+                                                 settings.beam_width, session_generate_beam)
+            for i, (completion, _) in enumerate(candidates[:len(predictions)]):
+                predictions[i] = text + completion
+        elif cache is None:
+            predictions[0] = text + session_generate(text, settings.predict_n, 0.1)
+        else:
+            predictions[0] = text + cache.complete(text, settings.predict_n, 0.1,
+                                                   session_generate)
+    except SupersededError as e:
+        return jsonify({'error': str(e)}), 409
+    except (QueueFullError, TimeoutError) as e:
+        return jsonify({'error': str(e)}), 503
+
     print('predict')
     # return jsonify({'prediction': prediction})
-    return jsonify({'prediction_1': prediction_1,
-                    'prediction_2': prediction_2,
-                    'prediction_3': prediction_3,
-                    'prediction_4': prediction_4})
+    started = time.perf_counter()
+    response = jsonify({'prediction_1': predictions[0],
+                        'prediction_2': predictions[1],
+                        'prediction_3': predictions[2],
+                        'prediction_4': predictions[3]})
+    metrics.observe('serialize', time.perf_counter() - started)
+    if timings:
+        response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+
+@app.route('/predict_stream', methods=['POST'])
+def predict_stream():
+    if not server.is_ready():
+        return jsonify({'error': 'Model is loading'}), 503
+
+    text, session = read_request(parse_json())
+    timings = {}
+
+    # The model is held until the stream ends, not until this function returns
+    held = ExitStack()
+    served = held.enter_context(server.acquire())
+    try:
+        chunks = served.worker.submit_stream(text, settings.predict_n, diversity=0.1,
+                                             timeout=settings.timeout, session=session,
+                                             timings=timings)
+    except QueueFullError as e:
+        held.close()
+        return jsonify({'error': str(e)}), 503
+
+    def events():
+        completion = ''
+        try:
+            for chunk in chunks:
+                completion += chunk
+                yield server_sent_event({'text': chunk})
+            yield server_sent_event({'prediction': text + completion,
+                                     'timings_ms': {name: 1000 * seconds
+                                                    for name, seconds in timings.items()}},
+                                    event='done')
+        except SupersededError as e:
+            yield server_sent_event({'error': str(e)}, event='superseded')
+        except Exception as e:
+            yield server_sent_event({'error': str(e)}, event='error')
+        finally:
+            # Also runs when the client disconnects, which cancels the completion
+            release()
+
+    def release():
+        '''Cancel the completion and let go of the model, at most once'''
+        chunks.close()
+        held.close()
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The generator never runs its finally if the response is closed before
+    # the first chunk, e.g. when the client is gone by the time it is sent
+    response.call_on_close(release)
+    return response
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    return jsonify(server.status()), 200 if server.is_ready() else 503
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    served = server.served
+    state_cache = served.worker.state_cache if served is not None else None
+    return jsonify({'cache': cache.stats() if cache is not None else None,
+                    'sessions': state_cache.stats() if state_cache is not None else None,
+                    'superseded': served.worker.superseded if served is not None else 0})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    served = server.served
+    gauges = {'model_ready': ('1 once a model is loaded and warmed up', int(served is not None))}
+    counters = {}
+    if served is not None:
+        gauges['model_loaded_timestamp_seconds'] = ('Unix time the served model was loaded',
+                                                    served.loaded_at)
+        gauges['in_flight_requests'] = ('Requests holding the served model', served.in_flight)
+        gauges['queue_depth'] = ('Completions waiting for the batching worker',
+                                 served.worker.queue.qsize())
+        counters['superseded_total'] = ('Completions cancelled by a newer request of their session',
+                                        served.worker.superseded)
+
+        state_cache = served.worker.state_cache
+        if state_cache is not None:
+            sessions = state_cache.stats()
+            gauges['session_cache_sessions'] = ('Sessions with cached decoder states',
+                                                sessions['sessions'])
+            gauges['session_cache_bytes'] = ('Bytes of cached decoder states', sessions['bytes'])
+            counters['session_cache_hits_total'] = ('Prompts continued from a cached decoder state',
+                                                    sessions['hits'])
+            counters['session_cache_misses_total'] = ('Prompts decoded from their window',
+                                                      sessions['misses'])
+            counters['session_cache_saved_timesteps_total'] = ('Timesteps not fed thanks to cached states',
+                                                               sessions['saved_timesteps'])
+
+    if cache is not None:
+        completions = cache.stats()
+        gauges['completion_cache_entries'] = ('Cached completions', completions['entries'])
+        gauges['completion_cache_prefix_windows'] = ('Windows typed into a cached completion',
+                                                     completions['prefix_windows'])
+        counters['completion_cache_hits_total'] = ('Completions served from the cache',
+                                                   completions['hits'])
+        counters['completion_cache_prefix_hits_total'] = ('Completions continuing a cached one',
+                                                          completions['prefix_hits'])
+        counters['completion_cache_misses_total'] = ('Completions decoded by the model',
+                                                     completions['misses'])
+        counters['completion_cache_saved_characters_total'] = ('Characters not decoded thanks to the cache',
+                                                               completions['saved_characters'])
+
+    return Response(metrics.render(gauges, counters),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    if not settings.profiling:
+        return jsonify({'error': 'Profiling is disabled, start the app with -P'}), 404
+    if not server.is_ready():
+        return jsonify({'error': 'Model is loading'}), 503
+
+    try:
+        seconds = float(request.args.get('seconds', 5))
+    except ValueError:
+        return jsonify({'error': 'seconds must be a number'}), 400
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return jsonify({'error': 'seconds must be above 0 and at most %d' % MAX_PROFILE_SECONDS}), 400
+    sort = request.args.get('sort', PROFILE_SORT_KEYS[0])
+    if sort not in PROFILE_SORT_KEYS:
+        return jsonify({'error': 'sort must be one of %s' % ', '.join(PROFILE_SORT_KEYS)}), 400
+
+    if not profiling.acquire(blocking=False):
+        return jsonify({'error': 'A profile is already being captured'}), 409
+    try:
+        with server.acquire() as served:
+            report = served.worker.profile(seconds, sort=sort)
+    finally:
+        profiling.release()
+    return Response(report, mimetype='text/plain')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True, threaded=False)
+    loader = threading.Thread(target=load_objects, name='model-loader')
+    loader.daemon = True
+    loader.start()
+    app.run(host='0.0.0.0', port=8080, debug=True, threaded=True, use_reloader=False)
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+'''batching.py
+
+Micro-batching inference worker for the /predict endpoint. Requests are put
+on a bounded queue and a single worker thread collects whatever arrives
+within a few milliseconds, stacks the windows into one batch and decodes
+them together with CodeGenerator.predict_batch. The hypotheses of the beam
+search requests of a batch are stacked, each request in its own block of
+rows, and decoded together with CodeGenerator.predict_beams. With a
+SessionStateCache, requests that carry a session id continue from the
+decoder state of the session's previous text and only feed the newly typed
+characters.
+
+Streamed requests receive their characters one decoding step at a time. A
+newer request from the same session cancels the older one, which stops
+being decoded at the next step instead of running to the end.
+
+The worker thread can be profiled with cProfile for a few seconds while it
+keeps serving; only the batches decoded in that time are traced.
+
+Todo:
+    *
+'''
+import cProfile
+import io
+import pstats
+import queue
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    '''Raised when a completion is submitted while the request queue is full'''
+
+
+class SupersededError(Exception):
+    '''Raised when a completion is cancelled by a newer request of the same session'''
+
+
+class PendingCompletion():
+    '''A completion request waiting for the BatchingWorker'''
+
+    def __init__(self, text, n, diversity, beam_width=1, session=None, stream=False):
+        self.text = text
+        self.n = n
+        self.diversity = diversity
+        self.beam_width = beam_width
+        self.session = session
+        self.enqueued = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.superseded = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.chunks = queue.Queue() if stream else None
+
+    def emit(self, char):
+        '''Stream a decoded character and return False once the request is cancelled'''
+        if self.chunks is not None and not self.cancelled:
+            self.chunks.put(char)
+        return not self.cancelled
+
+    def timings(self):
+        '''Seconds the request waited in the queue and was decoded for, as a
+        dictionary, empty if it was never decoded'''
+        if self.started is None or self.finished is None:
+            return {}
+        return {'queue': self.started - self.enqueued,
+                'decode': self.finished - self.started}
+
+
+class CompletionStream():
+    '''Iterator over the groups of characters of a streamed completion.
+    Closing it cancels the completion, even before the first character is read'''
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        '''Cancel the completion and stop iterating'''
+        self.request.cancelled = True
+        self.chunks.close()
+
+
+class BatchingWorker():
+    '''BatchingWorker object that decodes concurrent completion requests in batches
+
+    Parameters:
+        code_gen -- CodeGenerator used to decode the batches
+        max_batch_size -- most requests decoded together (default 8)
+        max_wait -- seconds to wait for more requests before decoding (default 0.005)
+        max_queue_size -- pending requests accepted before new ones are rejected (default 64)
+        state_cache -- SessionStateCache of the decoder states of each session (default None)
+        metrics -- Metrics recording queueing time and batch sizes (default None)
+
+    Attributes:
+        start -- start the worker thread
+        stop -- stop the worker thread once the current batch is done
+        submit -- queue a completion and block until it is decoded
+        submit_stream -- queue a completion and iterate over its characters as they are decoded
+        profile -- trace the decoding with cProfile for a few seconds and return the report
+        superseded -- requests cancelled by a newer request of the same session
+    '''
+
+    def __init__(self, code_gen, max_batch_size=8, max_wait=0.005, max_queue_size=64,
+                 state_cache=None, metrics=None):
+        '''Create a BatchingWorker object'''
+        self.code_gen = code_gen
+        self.state_cache = state_cache
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.latest = {}
+        self.lock = threading.Lock()
+        self.superseded = 0
+        self.profiler = None
+        self.profile_lock = threading.Lock()
+
+    def start(self):
+        '''Start the worker thread'''
+        self.thread = threading.Thread(target=self._run, name='batching-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the worker thread once the current batch is done'''
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, text, n, diversity=1.0, timeout=10.0, beam_width=1, session=None,
+               timings=None):
+        '''Queue a completion of n characters after text and wait for it. With a
+        beam_width above 1, return the beam_width best (completion, score) pairs.
+        session identifies the editor the text comes from, and the dictionary
+        timings is updated with the seconds spent queued and decoding
+
+        Raises:
+            QueueFullError: too many requests are already pending
+            TimeoutError: the completion was not decoded within timeout seconds
+            SupersededError: a newer request of the same session cancelled this one
+        '''
+        request = self._enqueue(PendingCompletion(text, n, diversity, beam_width=beam_width,
+                                                  session=session))
+
+        if not request.done.wait(timeout):
+            request.cancelled = True
+            raise TimeoutError('Completion not ready after %.1f seconds' % timeout)
+
+        if timings is not None:
+            timings.update(request.timings())
+        if request.superseded:
+            raise SupersededError('Completion superseded by a newer request')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def submit_stream(self, text, n, diversity=1.0, timeout=10.0, session=None,
+                      timings=None):
+        '''Queue a completion of n characters after text and return a
+        CompletionStream over groups of characters as they are decoded. Closing
+        it early, even before reading from it, cancels the completion. The dictionary timings is updated with
+        the seconds spent queued and decoding once the iterator is exhausted
+
+        Raises:
+            QueueFullError: too many requests are already pending
+        '''
+        request = self._enqueue(PendingCompletion(text, n, diversity, session=session,
+                                                  stream=True))
+        return CompletionStream(request, self._stream(request, timeout, timings))
+
+    def profile(self, seconds, sort='cumulative', limit=40):
+        '''Trace the batches decoded in the next seconds with cProfile and
+        return the limit most expensive functions, by sort, as text'''
+        profiler = cProfile.Profile()
+        self.profiler = profiler
+        time.sleep(seconds)
+        self.profiler = None
+        # Wait for a batch decoded under the profiler to finish
+        with self.profile_lock:
+            output = io.StringIO()
+            try:
+                stats = pstats.Stats(profiler, stream=output)
+            except TypeError:
+                return 'No batches were decoded in %.1f seconds\n' % seconds
+            stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+
+    def _stream(self, request, timeout, timings=None):
+        '''Yield the characters of a streamed request until it is done
+
+        Raises:
+            TimeoutError: no character was decoded within timeout seconds
+            SupersededError: a newer request of the same session cancelled this one
+        '''
+        try:
+            while True:
+                try:
+                    char = request.chunks.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError('No characters decoded for %.1f seconds' % timeout)
+                if char is None:
+                    break
+
+                chars = [char]
+                while True:
+                    try:
+                        char = request.chunks.get_nowait()
+                    except queue.Empty:
+                        break
+                    if char is None:
+                        request.chunks.put(None)
+                        break
+                    chars.append(char)
+                yield ''.join(chars)
+
+            request.done.wait()
+            if timings is not None:
+                timings.update(request.timings())
+            if request.superseded:
+                raise SupersededError('Completion superseded by a newer request')
+            if request.error is not None:
+                raise request.error
+        finally:
+            request.cancelled = True
+
+    def _enqueue(self, request):
+        '''Put request on the queue and cancel the previous request of its session
+
+        Raises:
+            QueueFullError: too many requests are already pending
+        '''
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            raise QueueFullError('%d completions already pending' % self.queue.maxsize)
+
+        if request.session is not None:
+            with self.lock:
+                previous = self.latest.get(request.session)
+                self.latest[request.session] = request
+                if previous is not None and not previous.done.is_set():
+                    previous.superseded = True
+                    previous.cancelled = True
+                    self.superseded += 1
+        return request
+
+    def _finish(self, request):
+        '''Wake up the submitter of a decoded or cancelled request'''
+        if request.session is not None:
+            with self.lock:
+                if self.latest.get(request.session) is request:
+                    del self.latest[request.session]
+        request.finished = time.time()
+        if request.chunks is not None:
+            request.chunks.put(None)
+        request.done.set()
+
+    def _collect(self):
+        '''Block for the next request, then gather more for up to max_wait seconds'''
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        '''Decode batches of pending requests until stopped'''
+        stopping = False
+        while not stopping:
+            batch = self._collect()
+            stopping = batch[-1] is None
+            for request in batch:
+                if request is not None and request.cancelled:
+                    self._finish(request)
+            batch = [request for request in batch
+                     if request is not None and not request.cancelled]
+            if not batch:
+                continue
+
+            # profile() builds its report under the lock, so a batch never
+            # enables a profiler whose report is already built
+            with self.profile_lock:
+                profiler = self.profiler
+                if profiler is None:
+                    self._decode_batch(batch)
+                    continue
+                profiler.enable()
+                try:
+                    self._decode_batch(batch)
+                finally:
+                    profiler.disable()
+
+    def _decode_batch(self, batch):
+        '''Decode the sampled requests of batch together, then the beam searches together'''
+        if self.metrics is not None:
+            self.metrics.observe_batch(len(batch))
+
+        sampled = [request for request in batch if request.beam_width == 1]
+        if sampled:
+            self._decode(sampled, self._predict_sampled)
+
+        beams = [request for request in batch if request.beam_width > 1]
+        if beams:
+            self._decode(beams, self._predict_beams)
+
+    def _prompt_states(self, requests):
+        '''PromptStates of the requests' texts, continued from the cached states
+        of their sessions, which are then updated'''
+        cached = [self.state_cache.lookup(request.session, request.text)
+                  if request.session is not None else None
+                  for request in requests]
+        prompt_states = self.code_gen.prompt_states([request.text for request in requests],
+                                                    cached)
+        for request, prompt_state, reused in zip(requests, prompt_states, cached):
+            if request.session is not None:
+                self.state_cache.store(request.session, prompt_state, reused)
+        return prompt_states
+
+    def _predict_sampled(self, requests):
+        '''Sample the completions of a batch of requests together'''
+        prompt_states = None
+        if self.state_cache is not None:
+            prompt_states = self._prompt_states(requests)
+        return self.code_gen.predict_batch([request.text for request in requests],
+                                           [request.n for request in requests],
+                                           [request.diversity for request in requests],
+                                           prompt_states=prompt_states,
+                                           on_step=lambda row, char: requests[row].emit(char))
+
+    def _predict_beams(self, requests):
+        '''Beam search the completions of a batch of requests together'''
+        prompt_states = None
+        if self.state_cache is not None:
+            prompt_states = self._prompt_states(requests)
+        return self.code_gen.predict_beams([request.text for request in requests],
+                                           [request.n for request in requests],
+                                           [request.beam_width for request in requests],
+                                           prompt_states=prompt_states,
+                                           cancelled=lambda row: requests[row].cancelled)
+
+    def _decode(self, requests, decode):
+        '''Run decode(requests) and hand each request its result or the error'''
+        started = time.time()
+        for request in requests:
+            request.started = started
+            if self.metrics is not None:
+                self.metrics.observe('queue', started - request.enqueued)
+        try:
+            for request, result in zip(requests, decode(requests)):
+                request.result = result
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                self._finish(request)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''cache.py
+
+Prefix-keyed LRU cache of completions for the /predict endpoint. While a
+user types, consecutive requests often share the same model window, or
+extend the text with characters that a previous completion already
+predicted. In the second case the rest of that completion is reused and
+only the missing tail is generated.
+
+The size of the cache is counted in completions. The windows reached by
+typing the start of a completion are kept in a separate index that points
+into the completion, and go when it is evicted.
+
+Todo:
+    *
+'''
+import threading
+from collections import OrderedDict
+
+
+class CompletionCache():
+    '''CompletionCache object that memoizes completions keyed on the model window
+
+    Parameters:
+        maxsize -- most completions kept before the least recently used is evicted (default 4096)
+        window_length -- number of trailing characters the model sees (default 100)
+
+    Attributes:
+        complete -- return a cached completion or generate and cache a new one
+        stats -- hit, prefix hit and miss counters
+        clear -- drop every entry, e.g. after the model changes
+        hits -- requests answered entirely from the cache
+        prefix_hits -- requests that reused part of an earlier completion
+        misses -- requests generated from scratch
+        saved_characters -- generated characters served from the cache
+    '''
+
+    def __init__(self, maxsize=4096, window_length=100):
+        '''Create a CompletionCache object'''
+        self.maxsize = maxsize
+        self.window_length = window_length
+        # key -> (completion, keys of the windows reached by typing its start)
+        self.entries = OrderedDict()
+        # window key -> (key of the completion it continues, characters typed)
+        self.prefixes = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.saved_characters = 0
+
+    def window(self, text):
+        '''The part of text the model conditions on'''
+        return text[-self.window_length:]
+
+    def complete(self, text, n, diversity, generate):
+        '''Return n predicted characters after text. generate(text, n, diversity)
+        is called for whatever part of the completion is not cached'''
+        key = (self.window(text), n, diversity)
+
+        with self.lock:
+            cached = self._lookup(key)
+
+        if cached is not None and len(cached) == n:
+            with self.lock:
+                self.hits += 1
+                self.saved_characters += n
+            return cached
+
+        if cached is None:
+            cached = ''
+            with self.lock:
+                self.misses += 1
+        else:
+            with self.lock:
+                self.prefix_hits += 1
+                self.saved_characters += len(cached)
+
+        completion = cached + generate(text + cached, n - len(cached), diversity)
+        self._store(key[0], n, diversity, completion)
+
+        return completion
+
+    def complete_beam(self, text, n, beam_width, generate_beam):
+        '''Return the beam_width best completions of n characters after text.
+        Beam search is deterministic, so results are cached by exact window'''
+        key = (self.window(text), n, 'beam', beam_width)
+
+        with self.lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                self.hits += 1
+                self.saved_characters += n
+                return cached
+            self.misses += 1
+
+        candidates = generate_beam(text, n, beam_width)
+
+        with self.lock:
+            self._remove(key)
+            self._insert(key, candidates, [])
+
+        return candidates
+
+    def _lookup(self, key):
+        '''Return the completion cached for key, or the rest of the completion
+        whose start was typed to reach it, marking it recently used. Must be
+        called holding the lock'''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[0]
+
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            return None
+        owner, k = prefix
+        self.entries.move_to_end(owner)
+        return self.entries[owner][0][k:]
+
+    def _insert(self, key, value, prefix_keys):
+        '''Add an entry for a key that has none and evict the least recently
+        used ones, with their prefix windows, beyond maxsize. Must be called
+        holding the lock'''
+        self.entries[key] = (value, prefix_keys)
+        while len(self.entries) > self.maxsize:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        '''Drop an entry and the prefix windows that point into it'''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for prefix_key in entry[1]:
+            if self.prefixes.get(prefix_key, (None,))[0] == key:
+                del self.prefixes[prefix_key]
+
+    def _store(self, window, n, diversity, completion):
+        '''Cache completion for window, and index the rest of it for every
+        window reached by typing the first k characters of completion'''
+        key = (window, n, diversity)
+        with self.lock:
+            self._remove(key)
+            prefix_keys = []
+            for k in range(1, n):
+                prefix_key = (self.window(window + completion[:k]), n, diversity)
+                if prefix_key != key and prefix_key not in self.prefixes:
+                    self.prefixes[prefix_key] = (key, k)
+                    prefix_keys.append(prefix_key)
+            self._insert(key, completion, prefix_keys)
+
+    def clear(self):
+        '''Drop every cached completion'''
+        with self.lock:
+            self.entries.clear()
+            self.prefixes.clear()
+
+    def stats(self):
+        '''Return the cache counters as a dictionary'''
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'prefix_windows': len(self.prefixes),
+                    'hits': self.hits,
+                    'prefix_hits': self.prefix_hits,
+                    'misses': self.misses,
+                    'saved_characters': self.saved_characters}
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''metrics.py
+
+Low-overhead instrumentation of the serving hot path, rendered in the
+Prometheus text exposition format by the /metrics endpoint. Histograms have
+fixed buckets, so observing a value is a bisect and two additions under a
+lock, and nothing is allocated per observation once a label set was seen.
+
+The stages of a request are observed as one histogram, labelled by stage:
+parsing the JSON body, waiting in the batching queue, vectorizing the
+prompt, warming up the decoder, every decoding step and sample, and
+serializing the response.
+
+Todo:
+    *
+'''
+import bisect
+import threading
+
+# 50us to 10s, about three buckets per factor of ten
+SECONDS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def format_labels(labels):
+    '''Format a tuple of (name, value) pairs as a Prometheus label set'''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class Histogram():
+    '''Histogram object that counts observations in fixed buckets per label set
+
+    Parameters:
+        name -- metric name
+        documentation -- help text of the metric
+        buckets -- increasing upper bounds of the buckets
+
+    Attributes:
+        observe -- count a value for a label set
+        render -- the metric in the Prometheus text format
+    '''
+
+    def __init__(self, name, documentation, buckets):
+        '''Create a Histogram object'''
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        '''Count value for the label set given as keyword arguments'''
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        '''Return the metric in the Prometheus text format as a list of lines'''
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self.series.items()]
+
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name,
+                                                 format_labels(key + (('le', bound),)),
+                                                 cumulative))
+            lines.append('%s_sum%s %.9g' % (self.name, format_labels(key), total))
+            lines.append('%s_count%s %d' % (self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Counter():
+    '''Counter object that counts events per label set
+
+    Parameters:
+        name -- metric name, ending in _total
+        documentation -- help text of the metric
+
+    Attributes:
+        inc -- add to the count of a label set
+        render -- the metric in the Prometheus text format
+    '''
+
+    def __init__(self, name, documentation):
+        '''Create a Counter object'''
+        self.name = name
+        self.documentation = documentation
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        '''Add amount to the count of the label set given as keyword arguments'''
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        '''Return the metric in the Prometheus text format as a list of lines'''
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s counter' % self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        lines.extend('%s%s %.9g' % (self.name, format_labels(key), value)
+                     for key, value in series)
+        return lines
+
+
+class Metrics():
+    '''Metrics object that collects the serving metrics of the webapp
+
+    Parameters:
+        prefix -- prefix of every metric name (default pycc)
+
+    Attributes:
+        observe -- record the seconds spent in a stage of a request
+        observe_request -- record the duration and status of an HTTP request
+        observe_batch -- record the size of a decoded batch
+        render -- every metric, and the given gauges, in the Prometheus text format
+    '''
+
+    def __init__(self, prefix='pycc'):
+        '''Create a Metrics object'''
+        self.prefix = prefix
+        self.stage_seconds = Histogram(prefix + '_stage_seconds',
+                                       'Seconds spent in each stage of a completion',
+                                       SECONDS_BUCKETS)
+        self.request_seconds = Histogram(prefix + '_request_seconds',
+                                         'Seconds to answer an HTTP request, by endpoint',
+                                         SECONDS_BUCKETS)
+        self.requests = Counter(prefix + '_requests_total',
+                                'HTTP requests answered, by endpoint and status')
+        self.batch_size = Histogram(prefix + '_batch_size',
+                                    'Requests decoded together in a batch',
+                                    BATCH_BUCKETS)
+
+    def observe(self, stage, seconds):
+        '''Record the seconds spent in a stage of a completion'''
+        self.stage_seconds.observe(seconds, stage=stage)
+
+    def observe_request(self, endpoint, status, seconds):
+        '''Record the duration and status of an HTTP request'''
+        self.request_seconds.observe(seconds, endpoint=endpoint)
+        self.requests.inc(endpoint=endpoint, status=status)
+
+    def observe_batch(self, size):
+        '''Record the number of requests decoded together'''
+        self.batch_size.observe(size)
+
+    def render(self, gauges=None, counters=None):
+        '''Return every metric in the Prometheus text format, followed by the
+        values counted elsewhere. gauges and counters map the name of each
+        value, without the prefix, to (help text, value); None values are left out'''
+        lines = []
+        for metric in (self.stage_seconds, self.request_seconds, self.requests,
+                       self.batch_size):
+            lines.extend(metric.render())
+
+        for kind, values in (('gauge', gauges), ('counter', counters)):
+            for name, (documentation, value) in sorted((values or {}).items()):
+                if value is None:
+                    continue
+                name = '%s_%s' % (self.prefix, name)
+                lines.extend(['# HELP %s %s' % (name, documentation),
+                              '# TYPE %s %s' % (name, kind),
+                              '%s %.9g' % (name, value)])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+'''model_server.py
+
+Model lifecycle for the webapp. A ModelServer loads the model when the
+server starts, warms it up on a few representative prompts so the first
+user does not pay for building the decoders, and reports when it is ready.
+It can watch a checkpoint folder, such as the one ModelCheckpoint saves to,
+load a newer checkpoint in the background and swap it in atomically.
+Requests that started on the old model finish on it before its batching
+worker is stopped.
+
+Todo:
+    *
+'''
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from pycodecomplete.ml.code_generation import CodeGenerator
+from pycodecomplete.ml.numpy_lstm import NumpyLSTM, is_archive
+from webapp.batching import BatchingWorker
+from webapp.session_cache import SessionStateCache
+
+WARMUP_PROMPTS = ['import ',
+                  'import numpy as np\n',
+                  'from os import path\n',
+                  'def __init__(self',
+                  'class Model(object):\n    ',
+                  'for i in range(',
+                  'if __name__ == ',
+                  "    return '"]
+
+
+def load_model(model_file):
+    '''Load a weight archive with the NumPy engine, or a Keras model file'''
+    if is_archive(model_file):
+        return NumpyLSTM(model_file)
+
+    from keras.models import load_model as load_keras_model
+    return load_keras_model(model_file)
+
+
+def latest_checkpoint(path):
+    '''Return the most recently modified model file or weight archive in the
+    folder path, or path itself when it is a file or an archive'''
+    if os.path.isfile(path) or is_archive(path):
+        return path
+
+    candidates = [os.path.join(path, name) for name in os.listdir(path)
+                  if not name.startswith('.')]
+    candidates = [candidate for candidate in candidates
+                  if os.path.isfile(candidate) or is_archive(candidate)]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+class ServedModel():
+    '''A loaded checkpoint with its CodeGenerator and BatchingWorker
+
+    Parameters:
+        model_file -- the checkpoint the model was loaded from
+        model -- trained Keras model, or NumpyLSTM
+        code_gen -- CodeGenerator of the model
+        worker -- started BatchingWorker of the code generator
+    '''
+
+    def __init__(self, model_file, model, code_gen, worker):
+        self.model_file = model_file
+        self.model = model
+        self.code_gen = code_gen
+        self.worker = worker
+        self.loaded_at = time.time()
+        self.in_flight = 0
+
+
+class ModelServer():
+    '''ModelServer object that loads, warms up and hot-reloads the served model
+
+    Parameters:
+        char_vectorizer -- CharVectorizer used to encode the input text
+        max_batch_size -- most requests decoded together (default 8)
+        max_wait -- seconds to wait for more requests before decoding (default 0.005)
+        max_queue_size -- pending requests accepted before new ones are rejected (default 64)
+        beam_width -- beam width of the warmup, 1 to warm up sampling only (default 4)
+        on_swap -- called with no arguments after a new model is swapped in (default None)
+        session_cache_bytes -- byte budget of each model's SessionStateCache, 0 to disable (default 64MB)
+        session_ttl -- seconds an unused session's states are kept (default 600)
+        metrics -- Metrics recording the stages of every completion (default None)
+
+    Attributes:
+        load -- load and warm up a checkpoint, then swap it in
+        acquire -- context manager that returns the current ServedModel
+        watch -- start a thread that loads newer checkpoints from a folder
+        is_ready -- True once a model has been loaded and warmed up
+        status -- readiness, checkpoint and load time as a dictionary
+        suspend -- stop the batching worker thread, e.g. before forking
+        resume -- start the batching worker thread again, e.g. in a forked process
+    '''
+
+    def __init__(self, char_vectorizer, max_batch_size=8, max_wait=0.005,
+                 max_queue_size=64, beam_width=4, on_swap=None,
+                 session_cache_bytes=64 * 2 ** 20, session_ttl=600.0, metrics=None):
+        '''Create a ModelServer object'''
+        self.char_vectorizer = char_vectorizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.beam_width = beam_width
+        self.on_swap = on_swap
+        self.session_cache_bytes = session_cache_bytes
+        self.session_ttl = session_ttl
+        self.metrics = metrics
+
+        self.served = None
+        self.condition = threading.Condition()
+        self.watcher = None
+        self.reload_error = None
+
+    def is_ready(self):
+        '''True once a model has been loaded and warmed up'''
+        return self.served is not None
+
+    def load(self, model_file):
+        '''Load the checkpoint model_file, warm it up and swap it in. Requests
+        already running on the previous model finish before it is stopped'''
+        model = load_model(model_file)
+        code_gen = CodeGenerator(model, self.char_vectorizer)
+        state_cache = None
+        if self.session_cache_bytes > 0:
+            # Decoder states are only valid for the model that computed them
+            state_cache = SessionStateCache(max_bytes=self.session_cache_bytes,
+                                            ttl=self.session_ttl,
+                                            window_length=self.char_vectorizer.sequence_length)
+        worker = BatchingWorker(code_gen,
+                                max_batch_size=self.max_batch_size,
+                                max_wait=self.max_wait,
+                                max_queue_size=self.max_queue_size,
+                                state_cache=state_cache,
+                                metrics=self.metrics)
+        worker.start()
+        served = ServedModel(model_file, model, code_gen, worker)
+        try:
+            self.warmup(served)
+        except Exception:
+            worker.stop()
+            raise
+        # The warmup is not a request, so only time the decoding from here on
+        code_gen.metrics = self.metrics
+
+        with self.condition:
+            previous, self.served = self.served, served
+        if self.on_swap is not None:
+            self.on_swap()
+
+        if previous is not None:
+            with self.condition:
+                self.condition.wait_for(lambda: previous.in_flight == 0)
+            previous.worker.stop()
+
+        return served
+
+    def suspend(self):
+        '''Stop the batching worker thread of the served model. Threads do not
+        survive a fork, so this is called before forking worker processes'''
+        self.served.worker.stop()
+
+    def resume(self):
+        '''Start the batching worker thread of the served model again'''
+        self.served.worker.start()
+
+    def warmup(self, served, n=10):
+        '''Decode the warmup prompts with every batch size the worker can use,
+        so the decoders are built before the first request'''
+        batch_size = 1
+        while True:
+            prompts = [WARMUP_PROMPTS[i % len(WARMUP_PROMPTS)] for i in range(batch_size)]
+            served.code_gen.predict_batch(prompts, [n] * batch_size, [1.0] * batch_size)
+            if batch_size >= self.max_batch_size:
+                break
+            batch_size *= 2
+
+        if self.beam_width > 1:
+            for prompt in WARMUP_PROMPTS:
+                served.code_gen.predict_beam(prompt, n, beam_width=self.beam_width)
+
+    @contextmanager
+    def acquire(self):
+        '''Return the current ServedModel and keep it running until released'''
+        with self.condition:
+            served = self.served
+            served.in_flight += 1
+        try:
+            yield served
+        finally:
+            with self.condition:
+                served.in_flight -= 1
+                self.condition.notify_all()
+
+    def watch(self, path, interval=30.0):
+        '''Poll path, a checkpoint folder, every interval seconds and load the
+        newest checkpoint once its size and modification time stop changing'''
+        def signature(checkpoint):
+            stat = os.stat(checkpoint)
+            return (checkpoint, stat.st_size, stat.st_mtime)
+
+        def poll():
+            loaded = signature(self.served.model_file)
+            seen = None
+            failed = None
+            while True:
+                time.sleep(interval)
+                try:
+                    checkpoint = latest_checkpoint(path)
+                    if checkpoint is None:
+                        continue
+                    current = signature(checkpoint)
+                    if current == loaded or current == failed:
+                        continue
+                    if current != seen:
+                        # Wait one more poll in case the checkpoint is still being written
+                        seen = current
+                        continue
+                    print('Loading checkpoint', checkpoint)
+                    self.load(checkpoint)
+                    loaded = current
+                    self.reload_error = None
+                except Exception as e:
+                    print('Checkpoint reload failed:', e)
+                    failed = seen
+                    self.reload_error = str(e)
+
+        self.watcher = threading.Thread(target=poll, name='checkpoint-watcher')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def status(self):
+        '''Return the readiness, checkpoint and load time as a dictionary'''
+        served = self.served
+        return {'ready': served is not None,
+                'pid': os.getpid(),
+                'model_file': served.model_file if served is not None else None,
+                'loaded_at': served.loaded_at if served is not None else None,
+                'watching': self.watcher is not None,
+                'reload_error': self.reload_error}
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+'''serve.py
+
+Pre-fork production server for the webapp. The master process loads the
+model and warms it up once, then forks worker processes that each serve
+requests from a shared listening socket with their own batching worker.
+
+A weight archive written by export_model.py is memory-mapped, so every
+worker reads the same copy of the weights from the page cache, and the
+arrays computed when the archive is loaded are shared copy-on-write.
+Keras models are loaded by every worker instead, since TensorFlow does not
+survive a fork.
+
+Each worker is pinned to its own cores and BLAS is limited to that many
+threads, so the workers do not oversubscribe the machine.
+
+Workers share nothing but the weights. Each has its own session decoder
+states, completion cache and record of the latest request of every
+session, and the kernel hands every connection to whichever worker accepts
+it first. The development server closes the connection after each response,
+so the keystrokes of one session are spread over the workers: a worker
+that did not serve the previous keystroke warms up on the whole window
+instead of feeding the new characters, finds nothing in its completion
+cache, and cannot cancel the stale request another worker is decoding.
+With session traffic, more workers therefore do not add throughput in
+proportion to the cores. For editors that send a session id, prefer fewer
+workers with more threads each (-p 1 -j 8), or run one single worker
+server per port behind a load balancer that routes each session to the
+same port.
+
+Example:
+
+    To serve an archive with one worker per 2 cores on port 8080 run:
+
+     $ python -m webapp.serve /path/to/archive 25 -p 4 -j 2
+
+    Any other option is passed to app.py, e.g. -b for the batch size:
+
+     $ python -m webapp.serve /path/to/archive 25 -p 4 -j 2 -b 16
+
+    The workers are restarted if they exit. SIGTERM or Ctrl-C stops the
+    master and its workers.
+
+Attributes:
+    THREAD_VARIABLES -- environment variables that limit the BLAS and OpenMP threads
+
+Todo:
+    *
+'''
+import os
+import signal
+import sys
+import time
+from argparse import ArgumentParser
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def limit_threads(n_threads):
+    '''Limit BLAS and OpenMP to n_threads threads. Only takes effect before
+    numpy is imported'''
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(n_threads)
+
+
+def worker_cores(worker, n_threads):
+    '''The cores worker is pinned to, n_threads consecutive cores of the ones
+    this process may run on, wrapping around when there are too few'''
+    cores = sorted(os.sched_getaffinity(0))
+    start = worker * n_threads
+    return {cores[(start + i) % len(cores)] for i in range(min(n_threads, len(cores)))}
+
+
+class PreforkServer():
+    '''PreforkServer object that forks and supervises the worker processes
+
+    Parameters:
+        app -- the webapp module, with its model already loaded unless preload is False
+        http_server -- werkzeug server bound to the listening socket
+        n_workers -- number of worker processes (default 1)
+        n_threads -- cores and BLAS threads of each worker (default 1)
+        pin -- pin every worker to its own cores (default True)
+        preload -- the model was loaded in the master before forking (default True)
+
+    Attributes:
+        run -- fork the workers and restart them until stopped
+        stop -- stop the workers
+    '''
+
+    def __init__(self, app, http_server, n_workers=1, n_threads=1, pin=True, preload=True):
+        '''Create a PreforkServer object'''
+        self.app = app
+        self.http_server = http_server
+        self.n_workers = n_workers
+        self.n_threads = n_threads
+        self.pin = pin
+        self.preload = preload
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, worker):
+        '''Fork the worker process with index worker'''
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = worker
+            return
+
+        status = 0
+        try:
+            self.serve(worker)
+        except BaseException as e:
+            print('Worker %d failed: %s' % (worker, e))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve(self, worker):
+        '''Serve requests in the forked worker process'''
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, worker_cores(worker, self.n_threads))
+
+        if self.preload:
+            self.app.server.resume()
+            self.app.watch_checkpoints()
+        else:
+            self.app.load_objects()
+        print('Worker %d serving as pid %d' % (worker, os.getpid()))
+        self.http_server.serve_forever()
+
+    def run(self):
+        '''Fork the workers, then wait for them and restart any that exit'''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in range(self.n_workers):
+            self.spawn(worker)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker = self.workers.pop(pid, None)
+            if worker is None or self.stopping:
+                continue
+            print('Worker %d exited with status %d, restarting' %
+                  (worker, os.waitstatus_to_exitcode(status)))
+            time.sleep(1.0)
+            if not self.stopping:
+                self.spawn(worker)
+
+    def stop(self, signum=None, frame=None):
+        '''Stop the workers'''
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def main():
+    parser = ArgumentParser(description='PyCodeComplete pre-fork server',
+                            epilog='Other options are passed to app.py')
+    parser.add_argument('model_file', action='store',
+                        help='Trained RNN model file, weight archive, or folder of checkpoints')
+    parser.add_argument('predict_n', type=int, action='store',
+                        help='Number of characters to predict')
+    parser.add_argument('-p', type=int, default=os.cpu_count() or 1, action='store',
+                        dest='n_workers', help='Worker processes')
+    parser.add_argument('-j', type=int, default=1, action='store', dest='n_threads',
+                        help='Cores and BLAS threads of each worker')
+    parser.add_argument('--host', default='0.0.0.0', action='store', dest='host',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, action='store', dest='port',
+                        help='Port to listen on')
+    parser.add_argument('--no-pin', action='store_false', dest='pin',
+                        help='Do not pin the workers to cores')
+
+    settings, app_args = parser.parse_known_args()
+
+    if settings.n_workers < 1 or settings.n_threads < 1:
+        arg_error(parser, 'error: Workers and threads must be at least 1')
+
+    if not os.path.exists(settings.model_file):
+        arg_error(parser, 'error: Model file not found')
+
+    # BLAS reads its thread count when numpy is first imported by the app
+    limit_threads(settings.n_threads)
+    sys.argv = ['app.py', settings.model_file, str(settings.predict_n)] + app_args
+
+    from werkzeug.serving import make_server
+
+    from webapp import app
+    from webapp.model_server import latest_checkpoint
+    from pycodecomplete.ml.numpy_lstm import is_archive
+
+    checkpoint = latest_checkpoint(settings.model_file)
+    preload = checkpoint is not None and is_archive(checkpoint)
+    if preload:
+        print('Loading Model...')
+        app.server.load(checkpoint)
+        app.server.suspend()
+
+    http_server = make_server(settings.host, settings.port, app.app, threaded=True)
+    print('Listening on %s:%d with %d workers' % (settings.host, settings.port,
+                                                 settings.n_workers))
+    PreforkServer(app, http_server,
+                  n_workers=settings.n_workers,
+                  n_threads=settings.n_threads,
+                  pin=settings.pin,
+                  preload=preload).run()
+
+
+def arg_error(parser, message):
+    parser.print_usage()
+    print('%s: %s' % (os.path.basename(__file__), message))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
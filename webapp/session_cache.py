@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''session_cache.py
+
+Per-session cache of decoder states for the /predict endpoint. While a user
+types, every request sends the whole editor text, which usually extends the
+text of the previous request. The PromptState the decoder reached after
+that text is kept per session, so the next request only feeds the newly
+typed characters instead of warming up on a whole window again.
+
+Entries expire after a time to live, and the least recently used sessions
+are evicted once the states take more than a byte budget.
+
+Todo:
+    *
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionStateCache():
+    '''SessionStateCache object that keeps recent PromptStates of every session
+
+    Parameters:
+        max_bytes -- most bytes of states kept before sessions are evicted (default 64MB)
+        ttl -- seconds an unused session is kept (default 600)
+        per_session -- PromptStates kept per session, so deleting text can
+                       still continue from an earlier prefix (default 4)
+        window_length -- number of characters a warmup window feeds (default 100)
+
+    Attributes:
+        lookup -- the cached PromptState of the longest prefix of a text
+        store -- cache the PromptState of a session's text
+        stats -- hit rate, saved timesteps and memory use
+    '''
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=600.0, per_session=4, window_length=100):
+        '''Create a SessionStateCache object'''
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.per_session = per_session
+        self.window_length = window_length
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_timesteps = 0
+
+    def lookup(self, session, text):
+        '''Return the cached PromptState of the longest prefix of text for the
+        session, or None'''
+        with self.lock:
+            self._expire()
+            entry = self.sessions.get(session)
+            if entry is None:
+                return None
+            self.sessions.move_to_end(session)
+            entry['used'] = time.time()
+
+            prefixes = [state for state in entry['states'] if text.startswith(state.text)]
+            if not prefixes:
+                return None
+            return max(prefixes, key=lambda state: len(state.text))
+
+    def store(self, session, prompt_state, reused):
+        '''Cache the PromptState of a session's text. reused is the cached
+        PromptState decoding continued from, or None after a warmup'''
+        with self.lock:
+            if reused is not None and (prompt_state is reused or
+                                       prompt_state.steps > reused.steps):
+                self.hits += 1
+                self.saved_timesteps += self.window_length - (prompt_state.steps - reused.steps)
+            else:
+                self.misses += 1
+
+            entry = self.sessions.setdefault(session, {'states': [], 'used': 0.0})
+            self.sessions.move_to_end(session)
+            entry['used'] = time.time()
+
+            if prompt_state not in entry['states']:
+                for state in [state for state in entry['states']
+                              if state.text == prompt_state.text]:
+                    entry['states'].remove(state)
+                    self.nbytes -= state.nbytes
+                entry['states'].append(prompt_state)
+                self.nbytes += prompt_state.nbytes
+            while len(entry['states']) > self.per_session:
+                self.nbytes -= entry['states'].pop(0).nbytes
+
+            while self.nbytes > self.max_bytes and self.sessions:
+                self._evict(next(iter(self.sessions)))
+
+    def _evict(self, session):
+        '''Drop every PromptState of a session'''
+        entry = self.sessions.pop(session)
+        self.nbytes -= sum(state.nbytes for state in entry['states'])
+
+    def _expire(self):
+        '''Drop the sessions unused for more than ttl seconds'''
+        deadline = time.time() - self.ttl
+        while self.sessions:
+            session, entry = next(iter(self.sessions.items()))
+            if entry['used'] >= deadline:
+                break
+            self._evict(session)
+
+    def stats(self):
+        '''Return the cache counters as a dictionary'''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'sessions': len(self.sessions),
+                    'bytes': self.nbytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'saved_timesteps': self.saved_timesteps}
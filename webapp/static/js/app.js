@@ -1,6 +1,14 @@
+// Lets the server continue from the decoder state of this page's previous text
+let session_id = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+// Keystrokes get the best completion found by beam search from /predict.
+// Open the page with ?stream to stream a sampled completion instead, which
+// shows its first characters sooner
+let streaming = new URLSearchParams(window.location.search).has('stream');
+
 let get_text_data = function () {
     let text = $("textarea#code-input").val()
-    return { 'text': text }
+    return { 'text': text, 'session': session_id }
 };
 
 let send_text_json = function (text) {
@@ -16,6 +24,55 @@ let send_text_json = function (text) {
     });
 };
 
+// Streams the prediction into the output as it is decoded. Starting a new
+// stream aborts the previous one, and the server cancels its decoding
+let current_stream = null;
+
+let stream_text_json = function (text) {
+    if (current_stream !== null) {
+        current_stream.abort();
+    }
+    let controller = new AbortController();
+    current_stream = controller;
+
+    let prediction = text['text'];
+    let buffer = '';
+    fetch('/predict_stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json; charset=utf-8' },
+        body: JSON.stringify(text),
+        signal: controller.signal
+    }).then(function (response) {
+        let reader = response.body.getReader();
+        let decoder = new TextDecoder();
+        let read = function () {
+            return reader.read().then(function (result) {
+                if (result.done) {
+                    return;
+                }
+                buffer += decoder.decode(result.value, { stream: true });
+                let events = buffer.split('\n\n');
+                buffer = events.pop();
+                events.forEach(function (event) {
+                    let data = event.split('\n').filter(function (line) {
+                        return line.startsWith('data: ');
+                    });
+                    if (data.length && !event.startsWith('event: ')) {
+                        prediction += JSON.parse(data[0].slice(6))['text'];
+                        display_prediction({ 'prediction_1': prediction });
+                    }
+                });
+                return read();
+            });
+        };
+        return read();
+    }).catch(function (error) {
+        if (error.name !== 'AbortError') {
+            console.log(error);
+        }
+    });
+};
+
 let display_prediction = function (data) {
     $("textarea.code-output").html(data['prediction_1'])
     //display_txt = display_txt.replace(/\n/g, "<br />");
@@ -35,7 +92,11 @@ $(function ()
         console.log(text)
 
         let text_json = get_text_data();
-        send_text_json(text_json);
+        if (streaming) {
+            stream_text_json(text_json);
+        } else {
+            send_text_json(text_json);
+        }
 
         
           }, 1000 );